@@ -0,0 +1,206 @@
+from datetime import timedelta
+
+import frappe
+from frappe import _
+from frappe.utils import add_months, cint, flt, get_first_day, getdate, now
+
+from .derived_balances import fetch_opening_remaining, get_movements_source, is_derived_balances
+
+ARCHIVE_CHUNK_SIZE = 5000
+
+# Горячая таблица → архив и копируемые поля
+ARCHIVE_TABLES = {
+	"Budget Operations": (
+		"Budget Operations Archive",
+		(
+			"date",
+			"budget_operation_type",
+			"organization_bank_rule",
+			"group_index",
+			"sum",
+			"expense_item",
+			"recipient_of_transit_payment",
+			"external_recipient",
+			"description",
+			"comment",
+		),
+	),
+	"Movements of Budget Operations": (
+		"Movements of Budget Operations Archive",
+		("date", "organization_bank_rule", "sum", "budget_balance_type"),
+	),
+}
+
+
+def get_sealed_until():
+	"""
+	Последний закрытый день: его остаток хранится контрольной точкой,
+	а пересчёты и правки до него не доходят. None — закрытых дней нет.
+	"""
+	sealed_until = frappe.db.get_single_value("Budget Settings", "sealed_until")
+	return getdate(sealed_until) if sealed_until else None
+
+
+def clamp_to_open_period(start_date):
+	"""
+	Сдвигает начало пересчёта за закрытый период.
+	"""
+	sealed_until = get_sealed_until()
+	if sealed_until and start_date <= sealed_until:
+		return sealed_until + timedelta(days=1)
+	return start_date
+
+
+def validate_open_period(target_date):
+	sealed_until = get_sealed_until()
+	if sealed_until and getdate(target_date) <= sealed_until:
+		frappe.throw(_("Period up to {0} is closed").format(frappe.format(sealed_until, "Date")))
+
+
+def fetch_sealed_remaining(rules):
+	"""
+	Остатки правил на конец последнего закрытого дня: {rule: remaining}.
+	"""
+	sealed_until = get_sealed_until()
+	if not sealed_until or not rules:
+		return {}
+	return dict(
+		frappe.db.sql(
+			"""
+			select organization_bank_rule, remaining
+			from `tabBudget Remaining Checkpoints`
+			where organization_bank_rule in %(rules)s and `date` = %(date)s
+			""",
+			{"rules": tuple(rules), "date": sealed_until},
+		)
+	)
+
+
+def fetch_stored_remaining(rules, on_date):
+	"""
+	Хранимый Remaining правил на конец дня on_date (последний не позже него): {rule: remaining}.
+	"""
+	if not rules:
+		return {}
+	return dict(
+		frappe.db.sql(
+			f"""
+			select m.organization_bank_rule, m.`sum`
+			from {get_movements_source(on_date)} m
+			join (
+				select organization_bank_rule, max(`date`) as `date`
+				from {get_movements_source(on_date)} r
+				where r.organization_bank_rule in %(rules)s and r.budget_balance_type = 'Remaining'
+					and r.`date` <= %(date)s
+				group by organization_bank_rule
+			) last on last.organization_bank_rule = m.organization_bank_rule and last.`date` = m.`date`
+			where m.budget_balance_type = 'Remaining'
+			""",
+			{"rules": tuple(rules), "date": on_date},
+		)
+	)
+
+
+def move_rows_to_archive(doctype, conditions, values, chunk_size=ARCHIVE_CHUNK_SIZE):
+	"""
+	Переносит строки doctype, подходящие под conditions, в архивную таблицу пачками
+	(insert ... select, затем delete) с коммитом после каждой пачки.
+	"""
+	archive_doctype, fields = ARCHIVE_TABLES[doctype]
+	columns = ", ".join(
+		f"`{field}`" for field in ("name", *fields, "creation", "modified", "owner", "modified_by")
+	)
+
+	moved = 0
+	while names := frappe.db.sql_list(
+		f"select name from `tab{doctype}` where {conditions} limit %(limit)s",
+		{**values, "limit": chunk_size},
+	):
+		frappe.db.sql(
+			f"""
+			insert into `tab{archive_doctype}` ({columns})
+			select {columns} from `tab{doctype}` where name in %(names)s
+			""",
+			{"names": tuple(names)},
+		)
+		frappe.db.delete(doctype, {"name": ("in", names)})
+		frappe.db.commit()
+		moved += len(names)
+	return moved
+
+
+def seal_period(sealed_until):
+	"""
+	Закрывает дни до sealed_until включительно: сохраняет остаток каждого правила
+	на конец этого дня контрольной точкой и переносит старые строки в архив.
+
+	Строки движений за сам закрытый день остаются в горячей таблице: от них считается
+	Balance следующего дня.
+	"""
+	rules = frappe.get_all("Organization-Bank Rules", pluck="name")
+	timestamp, user = now(), frappe.session.user
+	if is_derived_balances():
+		remaining = {
+			rule: fetch_opening_remaining(sealed_until + timedelta(days=1), rules=[rule]) for rule in rules
+		}
+	else:
+		# При хранимых остатках контрольные точки не обновляются — берём сам Remaining
+		remaining = fetch_stored_remaining(rules, sealed_until)
+
+	checkpoints = [
+		(
+			frappe.generate_hash(length=10),
+			sealed_until,
+			rule,
+			flt(remaining.get(rule)),
+			timestamp,
+			timestamp,
+			user,
+			user,
+		)
+		for rule in rules
+	]
+	frappe.db.delete("Budget Remaining Checkpoints", {"date": sealed_until})
+	if checkpoints:
+		frappe.db.bulk_insert(
+			"Budget Remaining Checkpoints",
+			[
+				"name",
+				"date",
+				"organization_bank_rule",
+				"remaining",
+				"creation",
+				"modified",
+				"owner",
+				"modified_by",
+			],
+			checkpoints,
+		)
+	frappe.db.set_single_value("Budget Settings", "sealed_until", sealed_until)
+	frappe.db.commit()
+
+	moved = move_rows_to_archive("Budget Operations", "`date` <= %(date)s", {"date": sealed_until})
+	moved += move_rows_to_archive(
+		"Movements of Budget Operations", "`date` < %(date)s", {"date": sealed_until}
+	)
+	# Пустые группы закрытого периода в архиве не нужны
+	frappe.db.delete("Budget Operation Groups", {"date": ("<=", sealed_until)})
+	frappe.db.commit()
+	return moved
+
+
+def archive_budget_history():
+	"""
+	Ежемесячно закрывает и архивирует месяцы старше Budget Settings > Archive After (Months).
+	"""
+	months = cint(frappe.db.get_single_value("Budget Settings", "archive_after_months"))
+	if not months:
+		return
+
+	sealed_until = get_first_day(add_months(getdate(), -months)) - timedelta(days=1)
+	current = get_sealed_until()
+	if current and sealed_until <= current:
+		return
+
+	moved = seal_period(sealed_until)
+	frappe.logger("adr_erp").info(f"Budget history sealed until {sealed_until}, {moved} rows archived")
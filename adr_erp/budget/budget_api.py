@@ -5,9 +5,25 @@ from itertools import chain
 import frappe
 import pytz
 from frappe import _
-from frappe.utils import add_days, flt, getdate
-
-from .utils import timed
+from frappe.utils import add_days, cint, flt, getdate, now
+
+from .archive import ARCHIVE_TABLES, clamp_to_open_period, get_sealed_until, validate_open_period
+from .derived_balances import (
+	FLOW_TYPES,
+	fetch_daily_balances,
+	is_derived_balances,
+	shift_remaining_checkpoints,
+)
+from .group_index import claim_group_index, reserve_group_indices
+from .recompute_lock import acquire_recompute_lock, release_recompute_lock, run_single_flight_recompute
+from .recurring_operations import (
+	expand_recurring_operations,
+	get_recurring_day_flows,
+	is_recurring_group_index,
+	materialize_recurring_operation,
+)
+from .scenarios import apply_scenario_to_grid_ops, evaluate_budget_scenario
+from .utils import read_from_replica, stick_to_primary, stick_version_to_primary, timed
 
 DAYS_STATUSES = {
 	"DEFAULT": "default",
@@ -28,6 +44,19 @@ PRIORITY = {
 	"ALERT": 2,
 }
 
+BUDGET_LAYOUT_CACHE_KEY = "adr_erp:budget_layout"
+BUDGET_DATA_VERSION_CACHE_KEY = "adr_erp:budget_data_version"
+# Горизонт по умолчанию, если в Budget Settings он не задан
+DEFAULT_BUDGET_HORIZON_DAYS = 30
+# Типы движений, нулевые строки которых не хранятся при разреженном хранении
+SPARSE_BALANCE_TYPES = ("Movement", "Transfer")
+BUDGET_ROWS_CACHE_KEY = "adr_erp:budget_rows"
+BUDGET_ROWS_CACHE_TTL = 5 * 60
+# Строки за более длинный период редакторы перечитывают сами
+MAX_PUSHED_ROWS_DAYS = 62
+# День последнего ежедневного сдвига горизонта правила
+HORIZON_ROLLED_CACHE_KEY = "adr_erp:horizon_rolled"
+
 
 def get_date_range(start_date, end_date):
 	"""
@@ -37,12 +66,13 @@ def get_date_range(start_date, end_date):
 	return [(start_date + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(num_days)]
 
 
-def fetch_budget_operations(organization_bank_rule_name, start_date, end_date):
+def fetch_budget_operations(organization_bank_rule_name, start_date, end_date, doctype="Budget Operations"):
 	"""
 	Получает бюджетные операции с БД за указанный период и приводит данные к необходимому виду.
+	doctype — горячая таблица или архив (Budget Operations Archive).
 	"""
 	ops = frappe.db.get_list(
-		"Budget Operations",
+		doctype,
 		filters=[
 			["date", ">=", start_date.strftime("%Y-%m-%d")],
 			["date", "<=", end_date.strftime("%Y-%m-%d")],
@@ -72,6 +102,57 @@ def fetch_budget_operations(organization_bank_rule_name, start_date, end_date):
 	return ops
 
 
+def fetch_budget_operation_groups(organization_bank_rule_name, start_date, end_date):
+	"""
+	Получает пустые группы (Budget Operation Groups) правила за период в том же виде,
+	что и fetch_budget_operations: строка редактора строится по ним без операций.
+	"""
+	groups = frappe.get_all(
+		"Budget Operation Groups",
+		filters=[
+			["date", ">=", start_date.strftime("%Y-%m-%d")],
+			["date", "<=", end_date.strftime("%Y-%m-%d")],
+			["organization_bank_rule", "=", organization_bank_rule_name],
+		],
+		fields=["date", "budget_operation_type", "group_index"],
+	)
+	for group in groups:
+		group["date"] = group["date"].strftime("%Y-%m-%d")
+		group["expense_item"] = ""
+	return groups
+
+
+def add_budget_operation_group(organization_bank_rule_name, target_date, op_type, group_index):
+	"""
+	Регистрирует пустую группу (date, type, group_index), если в ней ещё нет
+	ни операций этого типа, ни записи о группе.
+	"""
+	filters = {
+		"date": target_date,
+		"organization_bank_rule": organization_bank_rule_name,
+		"budget_operation_type": op_type,
+		"group_index": group_index,
+	}
+	if frappe.db.exists("Budget Operations", filters) or frappe.db.exists("Budget Operation Groups", filters):
+		return
+	frappe.get_doc({"doctype": "Budget Operation Groups", **filters}).insert(ignore_permissions=True)
+
+
+def remove_budget_operation_group(organization_bank_rule_name, target_date, op_type, group_index):
+	"""
+	Удаляет запись о группе: в ней появилась операция и строка строится уже по ней.
+	"""
+	frappe.db.delete(
+		"Budget Operation Groups",
+		{
+			"date": target_date,
+			"organization_bank_rule": organization_bank_rule_name,
+			"budget_operation_type": op_type,
+			"group_index": group_index,
+		},
+	)
+
+
 def get_bank_rules():
 	"""
 	Возвращает список имён правил для банка (Organization-Bank Rules).
@@ -604,40 +685,129 @@ def calculate_expense_item_metric(item_name, days_metric, organization_bank_rule
 	return f"{result:.2f} %"
 
 
-@frappe.whitelist()
-def get_budget_plannig_data_for_handsontable(organization_bank_rule_name, number_of_days):
-	result = {
-		"data": [],
-		"colHeaders": [],
-		"nestedHeaders": [],
-		"columns": [],
-		"operationTypeNames": [],
-		"daysStatuses": {},
+def get_rule_layout(organization_bank_rule_name):
+	"""
+	Возвращает макет таблицы правила: типы операций, доступные expense item'ы,
+	заголовки и колонки Handsontable.
+
+	Макет кешируется и сбрасывается при изменении правил или статей расходов
+	(см. clear_budget_layout_cache).
+	"""
+	key = f"{BUDGET_LAYOUT_CACHE_KEY}:{organization_bank_rule_name}:{frappe.local.lang}"
+	layout = frappe.cache.get_value(key)
+	if layout is None:
+		types = get_budget_operations_types()
+		rules = frappe.get_list("Organization-Bank Rules", fields=["name"], order_by="creation asc")
+		rules = [r["name"] for r in rules if r["name"] != organization_bank_rule_name]
+		items = get_available_expense_items(organization_bank_rule_name)
+		colHeaders, columns = build_columns_and_headers(types, items, rules)
+		layout = {"types": types, "items": items, "colHeaders": colHeaders, "columns": columns}
+		frappe.cache.set_value(key, layout)
+	return layout
+
+
+def clear_budget_layout_cache():
+	frappe.cache.delete_keys(BUDGET_LAYOUT_CACHE_KEY)
+
+
+def get_rule_layout_sources(organization_bank_rule_name):
+	"""
+	Возвращает исходные данные для построения колонок правила:
+	типы операций, доступные expense item'ы и заголовки/колонки Handsontable.
+	"""
+	layout = get_rule_layout(organization_bank_rule_name)
+	return layout["types"], layout["items"], layout["colHeaders"], layout["columns"]
+
+
+def build_day_rows(date_str, types, day_ops, day_moves, idx_map, num_cols):
+	"""
+	Строит строки Handsontable для одной даты.
+
+	day_ops   — операции за дату, сгруппированные по типу: {type: [op, ...]};
+	day_moves — суммы движений за дату: {budget_balance_type: sum}.
+
+	Строки отсортированы так же, как в редакторе: сначала группы, где есть План,
+	затем по порядковому номеру группы, внутри группы План→Факт.
+	"""
+	# читаем суммы из словаря (или 0 если нет)
+	metrics = {
+		"balance": day_moves.get("Balance", 0.0),
+		"remaining": day_moves.get("Remaining", 0.0),
+		"transfer": day_moves.get("Transfer", 0.0),
+		"movement": day_moves.get("Movement", 0.0),
 	}
 
-	DAYS = int(number_of_days)
-	today = date.today()
-	start_date, end_date = today - timedelta(days=DAYS), today + timedelta(days=DAYS)
-	dates = get_date_range(start_date, end_date)
+	rows = []
+	for t in types:
+		ops_list = day_ops.get(t, [])
+		if ops_list:
+			# создаём строку по каждому group_index
+			rows_by_group = {}
+			for op in ops_list:
+				gi = op.get("group_index", 0)
+				if gi not in rows_by_group:
+					rows_by_group[gi] = create_empty_row(date_str, t, idx_map, num_cols, gi)
+				# раскладываем expense_item по своим строкам
+				fill_row_from_op(rows_by_group[gi], op, idx_map)
+			rows.extend(rows_by_group.values())
+		else:
+			# ни одной операции — одна пустая строка
+			rows.append(create_empty_row(date_str, t, idx_map, num_cols, 0))
 
-	result["daysStatuses"] = fill_days_statuses(organization_bank_rule_name, dates)
+	# проставляем четыре метрики во все строки
+	for row in rows:
+		for field, value in metrics.items():
+			row[idx_map[field]] = value
+
+	type_order = {"План": 0, "Факт": 1}
+	type_idx = idx_map["budget_operation_type"]
+	group_idx = idx_map["group_index"]
+
+	# Собираем информацию, у каких групп есть хотя бы один План
+	groups_with_plan = {row[group_idx] for row in rows if row[type_idx] == "План"}
+
+	# Сортируем по трём параметрам:
+	#   a) сначала группы, где есть План (solo-факты пойдут после),
+	#   b) по порядковому номеру группы,
+	#   c) внутри группы План→Факт.
+	rows.sort(
+		key=lambda row: (
+			0 if row[group_idx] in groups_with_plan else 1,
+			row[group_idx],
+			type_order.get(row[type_idx], 2),
+		)
+	)
+	return rows
+
+
+def resolve_budget_window(number_of_days=None, from_date=None, to_date=None):
+	"""
+	Возвращает период (start_date, end_date): либо явно заданный from_date/to_date,
+	либо симметричное окно today ± number_of_days.
+	"""
+	if from_date and to_date:
+		start_date, end_date = getdate(from_date), getdate(to_date)
+	else:
+		DAYS = cint(number_of_days)
+		today = date.today()
+		start_date, end_date = today - timedelta(days=DAYS), today + timedelta(days=DAYS)
+
+	if start_date > end_date:
+		frappe.throw(_("Date from must be before date to"))
+	return start_date, end_date
 
-	# Получаем исходные данные и метаданные
-	budget_ops = fetch_budget_operations(organization_bank_rule_name, start_date, end_date)
-	types = get_budget_operations_types()
-	rules = frappe.get_list("Organization-Bank Rules", fields=["name"], order_by="creation asc")
-	rules = [r["name"] for r in rules if r["name"] != organization_bank_rule_name]
-	items = get_available_expense_items(organization_bank_rule_name)
 
-	# Заголовки и колонки
-	colHeaders, columns = build_columns_and_headers(types, items, rules)
-	result["nestedHeaders"].append({"label": _("Metrics"), "colspan": 7})
-	_nestedHeadersTemp = colHeaders[7:]
+def build_nested_headers(organization_bank_rule_name, layout):
+	"""
+	Строит верхний уровень заголовков: метрики для Credit-статей и названия для остальных.
+	"""
+	nestedHeaders = [{"label": _("Metrics"), "colspan": 7}]
+	_nestedHeadersTemp = layout["colHeaders"][7:]
 
-	for item in items:
+	for item in layout["items"]:
 		colspan = len(list(filter(lambda x: item["name"] in x, _nestedHeadersTemp)))
 		if item["entry_type"] == "Credit":
-			result["nestedHeaders"].append(
+			nestedHeaders.append(
 				{
 					"label": str(
 						calculate_expense_item_metric(
@@ -648,109 +818,215 @@ def get_budget_plannig_data_for_handsontable(organization_bank_rule_name, number
 				}
 			)
 		else:
-			result["nestedHeaders"].append({"label": item["name"], "colspan": colspan})
+			nestedHeaders.append({"label": item["name"], "colspan": colspan})
+	return nestedHeaders
 
-	result.update({"colHeaders": colHeaders, "columns": columns, "operationTypeNames": types})
+
+def build_budget_rows(organization_bank_rule_name, start_date, end_date, layout, scenario=None):
+	"""
+	Строит строки Handsontable за период [start_date, end_date].
+	scenario — наложить правки сценария и показать движения, посчитанные по нему в памяти.
+	"""
+	types, columns = layout["types"], layout["columns"]
 	idx_map = build_field_to_index(columns)
 	num_cols = len(columns)
 
-	# Группируем по (date, type)
+	# Закрытые дни окна читаются из архивных таблиц
+	sealed_until = get_sealed_until()
+	archived = bool(sealed_until and start_date <= sealed_until)
+
+	# Группируем по (date, type); пустые группы дают строки без операций
+	budget_ops = fetch_budget_operations(organization_bank_rule_name, start_date, end_date)
+	budget_ops += fetch_budget_operation_groups(organization_bank_rule_name, start_date, end_date)
+	if archived:
+		budget_ops += fetch_budget_operations(
+			organization_bank_rule_name,
+			start_date,
+			min(end_date, sealed_until),
+			ARCHIVE_TABLES["Budget Operations"][0],
+		)
+	# Повторяющиеся операции показываются виртуальными строками План без name
+	# и пустой строкой Факт той же группы
+	for op in expand_recurring_operations([organization_bank_rule_name], start_date, end_date):
+		if op.organization_bank_rule == organization_bank_rule_name:
+			day = op.date.strftime("%Y-%m-%d")
+			budget_ops.append({**op, "date": day})
+			budget_ops.append(
+				{
+					"date": day,
+					"budget_operation_type": "Факт",
+					"group_index": op.group_index,
+					"expense_item": "",
+				}
+			)
+	if scenario:
+		budget_ops = apply_scenario_to_grid_ops(
+			scenario, organization_bank_rule_name, budget_ops, start_date, end_date
+		)
 	grouped = {}
 	for op in budget_ops:
-		key = (op["date"], op["budget_operation_type"])
-		grouped.setdefault(key, []).append(op)
+		grouped.setdefault(op["date"], {}).setdefault(op["budget_operation_type"], []).append(op)
+
+	# Одинарный запрос за движениями из Movements of Budget Operations (и архива)
+	moves_doctypes = ["Movements of Budget Operations"]
+	if archived:
+		moves_doctypes.append(ARCHIVE_TABLES["Movements of Budget Operations"][0])
+	moves = []
+	for doctype in moves_doctypes:
+		moves += frappe.get_all(
+			doctype,
+			filters=[
+				["organization_bank_rule", "=", organization_bank_rule_name],
+				["date", ">=", start_date.strftime("%Y-%m-%d")],
+				["date", "<=", end_date.strftime("%Y-%m-%d")],
+			],
+			fields=["date", "budget_balance_type", "sum"],
+		)
+	# Построить словарь: date → {balance_type: sum}
+	moves_map = {}
+	for m in moves:
+		moves_map.setdefault(m.date.strftime("%Y-%m-%d"), {})[m.budget_balance_type] = m.sum
+
+	derived_start = clamp_to_open_period(start_date)
+	if is_derived_balances() and derived_start <= end_date:
+		# Balance/Remaining не хранятся — считаем нарастающим итогом от контрольной точки;
+		# в закрытых днях показываются только архивные Movement/Transfer
+		for day, values in fetch_daily_balances(
+			derived_start, end_date, rules=[organization_bank_rule_name]
+		).items():
+			moves_map[day.strftime("%Y-%m-%d")] = values
+
+	if scenario:
+		# Движения сценария считаются в памяти и никуда не пишутся
+		scenario_days = evaluate_budget_scenario(
+			scenario, [organization_bank_rule_name], start_date, end_date
+		)
+		for day, values in scenario_days.get(organization_bank_rule_name, {}).items():
+			moves_map[day.strftime("%Y-%m-%d")] = values["scenario"]
 
-	# 4) Одинарный запрос за движениями из Movements of Budget Operations
-	moves = frappe.get_all(
-		"Movements of Budget Operations",
-		filters=[
-			["organization_bank_rule", "=", organization_bank_rule_name],
-			["date", ">=", start_date.strftime("%Y-%m-%d")],
-			["date", "<=", end_date.strftime("%Y-%m-%d")],
-		],
-		fields=["date", "budget_balance_type", "sum"],
-	)
-	# 5) Построить словарь: (date, balance_type) → sum
-	moves_map = {(m.date.strftime("%Y-%m-%d"), m.budget_balance_type): m.sum for m in moves}
-
-	# 6) Для каждого dt и каждого типа строим строки
-	for dt in dates:
-		for t in types:
-			key = (dt, t)
-			ops_list = grouped.get(key, [])
-			# читаем суммы из словаря (или 0 если нет)
-			bal = moves_map.get((dt, "Balance"), 0.0)
-			rem = moves_map.get((dt, "Remaining"), 0.0)
-			trf = moves_map.get((dt, "Transfer"), 0.0)
-			mov = moves_map.get((dt, "Movement"), 0.0)
-
-			if ops_list:
-				row_count = list(set([op.get("group_index", 0) for op in ops_list]))
-				# создаём строк по каждому group_index
-				rows_for_key = [create_empty_row(dt, t, idx_map, num_cols, gi) for gi in row_count]
-				# сначала проставляем четыре метрики во все строки
-				for row in rows_for_key:
-					row[idx_map["balance"]] = bal
-					row[idx_map["remaining"]] = rem
-					row[idx_map["transfer"]] = trf
-					row[idx_map["movement"]] = mov
-				# потом раскладываем expense_item по своим строкам
-				for op in ops_list:
-					fill_row_from_op(
-						list(
-							filter(
-								lambda x: x[0] == op["date"]
-								and x[1] == op["budget_operation_type"]
-								and x[2] == op["group_index"],
-								rows_for_key,
-							)
-						)[0],
-						op,
-						idx_map,
-					)
-				result["data"].extend(rows_for_key)
+	# Для каждого dt строим строки
+	rows = []
+	for dt in get_date_range(start_date, end_date):
+		rows.extend(build_day_rows(dt, types, grouped.get(dt, {}), moves_map.get(dt, {}), idx_map, num_cols))
+	return rows
+
+
+def encode_compact_rows(rows, columns):
+	"""
+	Сжимает строки таблицы для ответа в компактном формате.
+
+	Дата и тип строки передаются кодами из словарей dates/types, остальные непустые ячейки —
+	плоским списком пар [колонка, значение]. Строковые значения тоже заменяются кодами
+	из словаря strings, такие колонки передаются отрицательными: -(колонка + 1).
+	"""
+	idx_map = build_field_to_index(columns)
+	date_idx, type_idx = idx_map["date"], idx_map["budget_operation_type"]
+	dates, types, strings = {}, {}, {}
+
+	encoded = []
+	for row in rows:
+		cells = []
+		for col, value in enumerate(row):
+			if value is None or col == date_idx or col == type_idx:
+				continue
+			if isinstance(value, str):
+				cells.append(-col - 1)
+				cells.append(strings.setdefault(value, len(strings)))
 			else:
-				# ни одной операции — одна пустая строка + метрики
-				empty = create_empty_row(dt, t, idx_map, num_cols, 0)
-				empty[idx_map["balance"]] = bal
-				empty[idx_map["remaining"]] = rem
-				empty[idx_map["transfer"]] = trf
-				empty[idx_map["movement"]] = mov
-				result["data"].append(empty)
-
-	# После того, как result['data'] уже заполнен, добавляем метаданные о группах:
-	type_order = {"План": 0, "Факт": 1}
-	date_idx = idx_map["date"]
-	type_idx = idx_map["budget_operation_type"]
-	group_idx = idx_map["group_index"]
+				cells.append(col)
+				cells.append(value)
+		encoded.append(
+			[
+				dates.setdefault(row[date_idx], len(dates)),
+				types.setdefault(row[type_idx], len(types)),
+				cells,
+			]
+		)
 
-	# 1) Собираем информацию, у каких (дата, группа) есть хотя бы один План
-	group_meta = {}
-	for row in result["data"]:
-		key = (row[date_idx], row[group_idx])
-		has_plan = group_meta.get(key, False)
-		if row[type_idx] == "План":
-			has_plan = True
-		group_meta[key] = has_plan
-
-	# 2) Сортируем по четырём параметрам:
-	#   a) по дате,
-	#   b) сначала группы, где есть План (solo-факты пойдут после, т.к. False→1),
-	#   c) по порядковому номеру группы,
-	#   d) внутри группы План→Факт.
-	result["data"].sort(
-		key=lambda row: (
-			row[date_idx],
-			0 if group_meta[(row[date_idx], row[group_idx])] else 1,
-			row[group_idx],
-			type_order.get(row[type_idx], 2),
+	return {
+		"width": len(columns),
+		"dateColumn": date_idx,
+		"typeColumn": type_idx,
+		"dates": list(dates),
+		"types": list(types),
+		"strings": list(strings),
+		"rows": encoded,
+	}
+
+
+@frappe.whitelist()
+@read_from_replica
+def get_budget_plannig_layout_for_handsontable(organization_bank_rule_name, from_date, to_date):
+	"""
+	Возвращает макет таблицы, метрики и статусы дней за период.
+	Запрашивается один раз за сессию редактора, данные затем подгружаются порциями.
+	"""
+	start_date, end_date = resolve_budget_window(from_date=from_date, to_date=to_date)
+	layout = get_rule_layout(organization_bank_rule_name)
+	return {
+		"colHeaders": layout["colHeaders"],
+		"nestedHeaders": build_nested_headers(organization_bank_rule_name, layout),
+		"columns": layout["columns"],
+		"operationTypeNames": layout["types"],
+		"daysStatuses": fill_days_statuses(organization_bank_rule_name, get_date_range(start_date, end_date)),
+	}
+
+
+@frappe.whitelist()
+@read_from_replica
+def get_budget_plannig_data_for_handsontable(
+	organization_bank_rule_name,
+	number_of_days=None,
+	from_date=None,
+	to_date=None,
+	page_size_days=None,
+	include_layout=1,
+	compact=0,
+	scenario=None,
+):
+	"""
+	Возвращает строки таблицы за период: from_date/to_date или today ± number_of_days.
+
+	page_size_days — ограничивает ответ первыми N днями периода, начало следующей
+	порции возвращается в nextFromDate.
+	include_layout — добавить в ответ макет, метрики и статусы дней.
+	compact — вернуть строки в компактном формате (см. encode_compact_rows) в compactData.
+	scenario — показать операции и движения сценария (Budget Scenarios) вместо живых.
+	"""
+	if scenario:
+		frappe.has_permission("Budget Scenarios", "read", scenario, throw=True)
+	start_date, end_date = resolve_budget_window(number_of_days, from_date, to_date)
+
+	next_from_date = None
+	if cint(page_size_days) > 0:
+		page_end_date = start_date + timedelta(days=cint(page_size_days) - 1)
+		if page_end_date < end_date:
+			next_from_date = (page_end_date + timedelta(days=1)).strftime("%Y-%m-%d")
+			end_date = page_end_date
+
+	result = {
+		"data": [],
+		"fromDate": start_date.strftime("%Y-%m-%d"),
+		"toDate": end_date.strftime("%Y-%m-%d"),
+		"nextFromDate": next_from_date,
+	}
+
+	layout = get_rule_layout(organization_bank_rule_name)
+	if cint(include_layout):
+		result.update(
+			get_budget_plannig_layout_for_handsontable(organization_bank_rule_name, start_date, end_date)
 		)
-	)
+
+	rows = build_budget_rows(organization_bank_rule_name, start_date, end_date, layout, scenario)
+	if cint(compact):
+		result["compactData"] = encode_compact_rows(rows, layout["columns"])
+	else:
+		result["data"] = rows
 	return result
 
 
 @frappe.whitelist()
-def save_budget_changes(organization_bank_rule_name, changes):
+def save_budget_changes(organization_bank_rule_name, changes, visible_to_date=None):
 	"""
 	Принимает список изменений с полями:
 	name, date, budget_type, expense_item,
@@ -759,6 +1035,9 @@ def save_budget_changes(organization_bank_rule_name, changes):
 
 	Создаёт новые Budget operation с вычисленным group_index,
 	а для существующих записей group_index не меняет.
+
+	visible_to_date — конец открытого в редакторе периода: движения до него
+	пересчитываются в первую очередь.
 	"""
 
 	def parse_changes(changes_json):
@@ -768,49 +1047,32 @@ def save_budget_changes(organization_bank_rule_name, changes):
 			return []
 
 	def count_ops(filters):
-		return frappe.db.count("Budget Operations", filters)
-
-	def get_group_indices(target_date):
-		ops = frappe.get_all(
-			"Budget Operations",
-			filters={"date": target_date, "organization_bank_rule": organization_bank_rule_name},
-			fields=["group_index"],
+		return frappe.db.count("Budget Operations", filters) + frappe.db.count(
+			"Budget Operation Groups", filters
 		)
-		return [op.group_index for op in ops if op.group_index is not None]
 
 	def next_group_index(target_date):
-		idxs = get_group_indices(target_date)
-		return max(idxs) + 1 if idxs else 0
-
-	def create_op(target_date, op_type, expense_item, group_index):
-		doc = frappe.new_doc("Budget Operations")
-		doc.date = target_date
-		doc.budget_operation_type = op_type
-		doc.organization_bank_rule = organization_bank_rule_name
-		doc.expense_item = expense_item
-		doc.group_index = group_index
-		doc.sum = flt(0)
-		doc.recipient_of_transit_payment = ""
-		doc.description = ""
-		doc.comment = ""
-		doc.external_recipient = ""
-		doc.save()
-		return doc
+		return reserve_group_indices(organization_bank_rule_name, target_date)
+
+	def add_group(target_date, op_type, group_index):
+		add_budget_operation_group(organization_bank_rule_name, target_date, op_type, group_index)
 
 	def handle_empty_change(target_date, op_type):
-		# если expense_item == ""
+		# если expense_item == "" — пустые строки не пишутся в Budget Operations,
+		# а регистрируются как группы (Budget Operation Groups)
 		# 1) при отсут. любых записей – создаём пару план/факт с group_index=0
 		if count_ops({"date": target_date, "organization_bank_rule": organization_bank_rule_name}) == 0:
-			create_op(target_date, "План", "", 0)
-			create_op(target_date, "Факт", "", 0)
+			add_group(target_date, "План", 0)
+			add_group(target_date, "Факт", 0)
+			claim_group_index(organization_bank_rule_name, target_date, 0)
 
 		# 2) создаём пустые на новом group_index
 		gi = next_group_index(target_date)
 		if op_type == "План":
-			create_op(target_date, "План", "", gi)
-			create_op(target_date, "Факт", "", gi)
+			add_group(target_date, "План", gi)
+			add_group(target_date, "Факт", gi)
 		else:
-			create_op(target_date, "Факт", "", gi)
+			add_group(target_date, "Факт", gi)
 
 	def find_existing_doc(name, target_date=None, op_type=None, group_index=None):
 		try:
@@ -851,22 +1113,21 @@ def save_budget_changes(organization_bank_rule_name, changes):
 			else find_existing_empty_doc(target_date, organization_bank_rule_name, op_type, group_index)
 		)
 
+		if not doc and is_recurring_group_index(group_index):
+			# Правка в группе повторяющейся операции: сначала сохраняем её План
+			materialized = materialize_recurring_operation(
+				organization_bank_rule_name, target_date, group_index
+			)
+			# Другая статья в группе повторения — отдельная операция, План повторения остаётся
+			if materialized and op_type == "План" and materialized.expense_item == expense_item:
+				doc = materialized
+
 		if not doc:
 			# вычисляем новый group_index, если не задан
 			if group_index is None:
-				# только для этого date+type
-				idxs = frappe.get_all(
-					"Budget Operations",
-					filters={
-						"date": target_date,
-						"budget_operation_type": op_type,
-						"organization_bank_rule": organization_bank_rule_name,
-					},
-					fields=["group_index"],
-				)
-
-				idxs = [o.group_index for o in idxs if o.group_index is not None]
-				group_index = max(idxs) + 1 if idxs else 0
+				group_index = next_group_index(target_date)
+			else:
+				claim_group_index(organization_bank_rule_name, target_date, group_index)
 
 			doc = frappe.new_doc("Budget Operations")
 			doc.date = target_date
@@ -882,37 +1143,25 @@ def save_budget_changes(organization_bank_rule_name, changes):
 		doc.comment = ch.get("comment") or ""
 		doc.external_recipient = ch.get("external_recipient") or ""
 		doc.save()
+		# группа больше не пустая — строка строится по операции
+		remove_budget_operation_group(
+			organization_bank_rule_name, target_date, doc.budget_operation_type, doc.group_index
+		)
 
 		# если это План – убеждаемся, что для того же group_index есть Факт
 		if doc.budget_operation_type == "План":
-			exists = frappe.get_all(
-				"Budget Operations",
-				filters={
-					"date": target_date,
-					"budget_operation_type": "Факт",
-					"organization_bank_rule": organization_bank_rule_name,
-					"group_index": doc.group_index,
-				},
-				limit=1,
-			)
-			if not exists:
-				create_op(target_date, "Факт", "", doc.group_index)
+			add_group(target_date, "Факт", doc.group_index)
 
-	payload_calculate_movements = {}
-	uniq_organization_bank_rule_names = []
-	recipients_of_transit_payment = []
-	max_date = None
+	recipients_of_transit_payment = set()
 	min_date = None
+	max_date = None
 	# --- основная логика ---
 	for ch in parse_changes(changes):
 		target_date = ch.get("date")
 		_target_date = getdate(target_date)
-		if max_date is None:
-			max_date = _target_date
-		if min_date is None:
-			min_date = _target_date
-		max_date = _target_date if _target_date < max_date else max_date
-		min_date = _target_date if _target_date > min_date else min_date
+		validate_open_period(_target_date)
+		min_date = _target_date if min_date is None or _target_date < min_date else min_date
+		max_date = _target_date if max_date is None or _target_date > max_date else max_date
 
 		op_type = ch.get("budget_type")
 		expense_item = ch.get("expense_item") or ""
@@ -922,76 +1171,178 @@ def save_budget_changes(organization_bank_rule_name, changes):
 			handle_empty_change(target_date, op_type)
 		else:
 			handle_non_empty_change(ch)
-			recipients_of_transit_payment.append(recipient_of_transit_payment)
+			if recipient_of_transit_payment:
+				recipients_of_transit_payment.add(recipient_of_transit_payment)
+
+	stick_to_primary()
+	if min_date is None:
+		return {"success": True}
 
 	frappe.enqueue(
 		"adr_erp.budget.budget_api.sub_computing",
 		queue="short",
 		timeout=600,
-		recipients_of_transit_payment=recipients_of_transit_payment,
-		payload_calculate_movements=payload_calculate_movements,
-		max_date=max_date,
-		min_date=min_date,
-		uniq_organization_bank_rule_names=uniq_organization_bank_rule_names,
+		enqueue_after_commit=True,
 		organization_bank_rule_name=organization_bank_rule_name,
+		recipients_of_transit_payment=sorted(recipients_of_transit_payment),
+		from_date=min_date,
+		to_date=max_date,
+		visible_to_date=visible_to_date,
 	)
 
 	return {"success": True}
 
 
-@frappe.whitelist()
+def get_budget_horizon_days():
+	"""
+	Сколько дней вперёд от сегодня поддерживаются движения (Budget Settings).
+	"""
+	return cint(frappe.db.get_single_value("Budget Settings", "horizon_days")) or DEFAULT_BUDGET_HORIZON_DAYS
+
+
+def get_budget_horizon_end():
+	"""
+	Последний день горизонта планирования, до которого поддерживаются движения.
+	"""
+	return datetime.now(pytz.timezone("Europe/Moscow")).date() + timedelta(days=get_budget_horizon_days())
+
+
+def get_last_budget_date(organization_bank_rule_name):
+	"""
+	Последняя дата, на которую у правила есть операции или движения.
+	"""
+	return frappe.db.sql(
+		"""
+		select max(`date`) from (
+			select max(`date`) as `date` from `tabBudget Operations` where organization_bank_rule = %(rule)s
+			union all
+			select max(`date`) from `tabMovements of Budget Operations` where organization_bank_rule = %(rule)s
+		) t
+		""",
+		{"rule": organization_bank_rule_name},
+	)[0][0]
+
+
+def get_recompute_end_date(organization_bank_rule_name):
+	last_date = get_last_budget_date(organization_bank_rule_name)
+	horizon_end = get_budget_horizon_end()
+	return max(horizon_end, last_date) if last_date else horizon_end
+
+
 def sub_computing(
-	recipients_of_transit_payment,
-	payload_calculate_movements,
-	max_date,
-	min_date,
-	uniq_organization_bank_rule_names,
 	organization_bank_rule_name,
+	recipients_of_transit_payment,
+	from_date,
+	to_date,
+	visible_to_date=None,
 ):
+	"""
+	Быстрая фаза пересчёта после сохранения: от первой изменённой даты до конца
+	открытого в редакторе периода. Остальное — в deferred_computing на очереди long.
+	"""
+	from_date, to_date = getdate(from_date), getdate(to_date)
+	interactive_to_date = max(to_date, getdate(visible_to_date)) if visible_to_date else to_date
+
+	recompute_movements_range(organization_bank_rule_name, from_date, interactive_to_date)
+	publish_budget_change(organization_bank_rule_name, from_date, interactive_to_date)
+
+	frappe.enqueue(
+		"adr_erp.budget.budget_api.deferred_computing",
+		queue="long",
+		timeout=3600,
+		organization_bank_rule_name=organization_bank_rule_name,
+		recipients_of_transit_payment=recipients_of_transit_payment,
+		from_date=from_date,
+		tail_from_date=add_days(interactive_to_date, 1),
+	)
+	return True
+
+
+def deferred_computing(organization_bank_rule_name, recipients_of_transit_payment, from_date, tail_from_date):
+	"""
+	Отложенная фаза пересчёта: хвост горизонта правила после открытого периода
+	и получатели транзитных платежей — с первой изменённой даты.
+	"""
+	tail_from_date = getdate(tail_from_date)
+	end_date = get_recompute_end_date(organization_bank_rule_name)
+	if tail_from_date <= end_date:
+		recompute_movements_range(organization_bank_rule_name, tail_from_date, end_date)
+		publish_budget_change(organization_bank_rule_name, tail_from_date, end_date)
+
 	for recipient_of_transit_payment in recipients_of_transit_payment:
-		if recipient_of_transit_payment != "":
-			payload_calculate_movements[f"{max_date}_{min_date}_{recipient_of_transit_payment}"] = {
-				"min_date": min_date,
-				"target_date": max_date,
-				"organization_bank_rule_name": recipient_of_transit_payment,
-			}
-			if recipient_of_transit_payment not in uniq_organization_bank_rule_names:
-				uniq_organization_bank_rule_names.append(recipient_of_transit_payment)
-
-	key = f"{max_date}_{min_date}_{organization_bank_rule_name}"
-	if key not in payload_calculate_movements:
-		payload_calculate_movements[key] = {
-			"min_date": min_date,
-			"target_date": max_date,
-			"organization_bank_rule_name": organization_bank_rule_name,
-		}
+		recipient_end_date = get_recompute_end_date(recipient_of_transit_payment)
+		recompute_movements_range(recipient_of_transit_payment, from_date, recipient_end_date)
+		publish_budget_change(recipient_of_transit_payment, from_date, recipient_end_date)
 
-		if organization_bank_rule_name not in uniq_organization_bank_rule_names:
-			uniq_organization_bank_rule_names.append(organization_bank_rule_name)
 
-	for payload_calculate_movement in payload_calculate_movements:
-		calculate_movements_of_budget_operations(
-			payload_calculate_movements[payload_calculate_movement]["organization_bank_rule_name"],
-			payload_calculate_movements[payload_calculate_movement]["target_date"],
-			compute_all=False,
-			min_target_data=payload_calculate_movements[payload_calculate_movement]["min_date"],
-		)
-		publish_budget_change(
-			payload_calculate_movements[payload_calculate_movement]["organization_bank_rule_name"]
-		)
-		frappe.enqueue(
-			"adr_erp.tasks.prepare_budget_movement_data",
-			queue="short",
-			timeout=600,
-			rule=payload_calculate_movements[payload_calculate_movement]["organization_bank_rule_name"],
-			target_date=payload_calculate_movements[payload_calculate_movement]["min_date"],
-		)
+def get_budget_data_version():
+	"""
+	Возвращает номер версии данных движений. Меняется после каждого пересчёта,
+	поэтому годится как часть ключа кеша для отчётов по движениям.
+	"""
+	return cint(frappe.cache.get(frappe.cache.make_key(BUDGET_DATA_VERSION_CACHE_KEY)))
 
-	return True
+
+def bump_budget_data_version():
+	frappe.cache.incr(frappe.cache.make_key(BUDGET_DATA_VERSION_CACHE_KEY))
 
 
-def publish_budget_change(organization_bank_rule_name):
+def push_budget_rows(organization_bank_rule_name, from_date, to_date):
+	"""
+	Строит строки таблицы за пересчитанный период один раз на стороне задачи и кладёт их
+	в кеш на BUDGET_ROWS_CACHE_TTL: редакторы забирают готовые строки по токену,
+	а не перестраивают таблицу каждый сам. Слишком длинный период не кладётся.
+	"""
+	from_date, to_date = getdate(from_date), getdate(to_date)
+	if (to_date - from_date).days + 1 > MAX_PUSHED_ROWS_DAYS:
+		return {}
+
+	layout = get_rule_layout(organization_bank_rule_name)
+	rows = build_budget_rows(organization_bank_rule_name, from_date, to_date, layout)
+	token = frappe.generate_hash(length=16)
+	frappe.cache.set_value(
+		f"{BUDGET_ROWS_CACHE_KEY}:{token}",
+		encode_compact_rows(rows, layout["columns"]),
+		expires_in_sec=BUDGET_ROWS_CACHE_TTL,
+	)
+	return {
+		"rowsToken": token,
+		"fromDate": from_date.strftime("%Y-%m-%d"),
+		"toDate": to_date.strftime("%Y-%m-%d"),
+	}
+
+
+@frappe.whitelist(methods=["GET"])
+def get_pushed_budget_rows(rows_token):
+	"""
+	Возвращает строки, подготовленные задачей пересчёта (push_budget_rows),
+	в компактном формате или None, если они уже истекли.
+	"""
+	frappe.has_permission("Budget Operations", "read", throw=True)
+	return frappe.cache.get_value(f"{BUDGET_ROWS_CACHE_KEY}:{rows_token}")
+
+
+def publish_budget_change(organization_bank_rule_name, from_date=None, to_date=None):
+	"""
+	Сообщает редакторам об изменении данных правила. Если задан пересчитанный период,
+	к сообщению прикладывается токен готовых строк за него.
+	"""
 	channel = "budget_data_updated"
+	# Редакторы перечитывают данные с этой версией — такие чтения идут на основную базу
+	data_version = get_budget_data_version()
+	stick_version_to_primary(data_version)
+	message = {"organization_bank_rule_name": organization_bank_rule_name, "dataVersion": data_version}
+	if from_date and to_date:
+		message.update(push_budget_rows(organization_bank_rule_name, from_date, to_date))
+	frappe.publish_realtime(event=channel, message=message, user=None)
+
+
+def publish_budget_layout_change(organization_bank_rule_name=None):
+	"""
+	Сообщает редакторам, что изменились колонки таблицы: редактор перечитывает макет и данные.
+	Без имени правила — касается всех правил.
+	"""
+	channel = "budget_layout_updated"
 	frappe.publish_realtime(
 		event=channel, message={"organization_bank_rule_name": organization_bank_rule_name}, user=None
 	)
@@ -1134,6 +1485,12 @@ def calculate_movement_type_movement_of_budget_operations(organization_bank_rule
 					elif entry_type in ["Credit", _("Credit")]:
 						current_budget_operations_movements -= budget_operation.sum
 
+	if target_date >= today_msk:
+		# Виртуальные повторения — только План, их Факт всегда сохранён вместе с Планом
+		current_budget_operations_movements += get_recurring_day_flows(
+			organization_bank_rule_name, target_date
+		)[0]
+
 	return {
 		"current_budget_operations_movements": current_budget_operations_movements,
 	}
@@ -1153,7 +1510,7 @@ def calculate_transfer_type_movement_of_budget_operations(organization_bank_rule
 				["date", "=", target_date],
 				["sum", ">", 0],
 				["budget_operation_type", "=", "План"],
-				["recipient_of_transit_payment", "=", "organization_bank_rule_name"],
+				["recipient_of_transit_payment", "=", organization_bank_rule_name],
 			],
 			fields=[
 				"name",
@@ -1244,6 +1601,11 @@ def calculate_transfer_type_movement_of_budget_operations(organization_bank_rule
 				if budget_operation.budget_operation_type == allowed_budget_operation_type:
 					current_budget_operations_transfers += budget_operation.sum
 
+	if target_date >= today_msk:
+		current_budget_operations_transfers += get_recurring_day_flows(
+			organization_bank_rule_name, target_date
+		)[1]
+
 	return {
 		"current_budget_operations_transfers": current_budget_operations_transfers,
 	}
@@ -1271,10 +1633,18 @@ def calculate_remaining_type_movement_of_budget_operations(organization_bank_rul
 	}
 
 
+def is_sparse_movements_storage():
+	"""
+	Разреженное хранение: нулевые Movement/Transfer не хранятся, отсутствующая строка означает 0.
+	"""
+	return bool(cint(frappe.db.get_single_value("Budget Settings", "sparse_movements_storage")))
+
+
 def save_movement_of_budget_operations(target_date, organization_bank_rule, sum, budget_balance_type):
 	"""
 	Если для заданной (date, organization_bank_rule, budget_balance_type)
 	запись существует — обновляем её, иначе создаём новую.
+	При разреженном хранении нулевые Movement/Transfer удаляются.
 	"""
 
 	total = flt(sum or 0)
@@ -1287,9 +1657,18 @@ def save_movement_of_budget_operations(target_date, organization_bank_rule, sum,
 	}
 
 	# 2) Поищем существующую запись
-	existing_name = frappe.db.get_value("Movements of Budget Operations", filters, "name")
+	existing_name, previous = frappe.db.get_value(
+		"Movements of Budget Operations", filters, ["name", "sum"]
+	) or (None, 0)
+
+	if budget_balance_type in FLOW_TYPES and is_derived_balances():
+		# Остатки выводятся при чтении — вместо каскада по дням сдвигаем контрольные точки
+		shift_remaining_checkpoints(organization_bank_rule, target_date, total - flt(previous))
 
 	if existing_name:
+		if total == 0 and budget_balance_type in SPARSE_BALANCE_TYPES and is_sparse_movements_storage():
+			frappe.db.delete("Movements of Budget Operations", {"name": existing_name})
+			return
 		# 3a) Обновляем существующий документ
 		doc = frappe.get_doc("Movements of Budget Operations", existing_name)
 		doc.sum = total
@@ -1352,6 +1731,16 @@ CALC_MAP = {
 }
 
 
+def get_stored_calc_map():
+	"""
+	Типы движений, которые пересчитываются и хранятся по дням:
+	при выводимом хранении — только Movement/Transfer.
+	"""
+	if is_derived_balances():
+		return {label: calc for label, calc in CALC_MAP.items() if label in FLOW_TYPES}
+	return CALC_MAP
+
+
 def build_full_date_range(
 	raw_target_date, organization_bank_rule_name, compute_all=False, min_target_data=None
 ):
@@ -1389,20 +1778,145 @@ def build_full_date_range(
 	return full_dates
 
 
+def recompute_movements_range(organization_bank_rule_name, start_date, end_date):
+	"""
+	Пересчитывает движения правила за [start_date, end_date]. Параллельные запросы по одному
+	правилу не запускаются одновременно: они расширяют диапазон уже идущего пересчёта.
+	"""
+	# Закрытый период не пересчитывается
+	start_date, end_date = clamp_to_open_period(getdate(start_date)), getdate(end_date)
+	if start_date > end_date:
+		return
+	calc_map = get_stored_calc_map()
+
+	def recompute(range_start, range_end, heartbeat):
+		selected_date = range_start
+		while selected_date <= range_end:
+			if not heartbeat():
+				return False
+			for label, (calc_fn, result_key) in calc_map.items():
+				data = calc_fn(organization_bank_rule_name, selected_date)
+				save_movement_of_budget_operations(
+					selected_date,
+					organization_bank_rule_name,
+					data[result_key],
+					label,
+				)
+			selected_date += timedelta(days=1)
+		bump_budget_data_version()
+		return True
+
+	run_single_flight_recompute(organization_bank_rule_name, start_date, end_date, recompute)
+
+
 def calculate_movements_of_budget_operations(
 	organization_bank_rule_name, target_date, compute_all=False, min_target_data=None
 ):
 	full_dates = build_full_date_range(target_date, organization_bank_rule_name, compute_all, min_target_data)
+	if full_dates:
+		recompute_movements_range(organization_bank_rule_name, full_dates[0], full_dates[-1])
 
-	for selected_date in full_dates:
-		for label, (calc_fn, result_key) in CALC_MAP.items():
-			data = calc_fn(organization_bank_rule_name, selected_date)
-			save_movement_of_budget_operations(
-				selected_date,
-				organization_bank_rule_name,
-				data[result_key],
-				label,
-			)
+
+def carry_remaining_forward(organization_bank_rule_name, today, horizon_end):
+	"""
+	Переносит остаток сегодняшнего дня на Balance/Remaining последующих дней по уже сохранённым
+	Movement/Transfer (пишутся только изменившиеся строки); день horizon_end считается полностью.
+	"""
+	stored = {}
+	for row in frappe.db.sql(
+		"""
+		select `date`, budget_balance_type, `sum`
+		from `tabMovements of Budget Operations`
+		where organization_bank_rule = %s and `date` >= %s
+		""",
+		(organization_bank_rule_name, today),
+		as_dict=True,
+	):
+		stored.setdefault(row.date, {})[row.budget_balance_type] = flt(row.sum)
+
+	remaining = stored.get(today, {}).get("Remaining", 0)
+	end_date = max([horizon_end, *stored])
+	selected_date = today + timedelta(days=1)
+	while selected_date <= end_date:
+		stored_day = stored.get(selected_date, {})
+		if selected_date == horizon_end:
+			movement = calculate_movement_type_movement_of_budget_operations(
+				organization_bank_rule_name, selected_date
+			)["current_budget_operations_movements"]
+			transfer = calculate_transfer_type_movement_of_budget_operations(
+				organization_bank_rule_name, selected_date
+			)["current_budget_operations_transfers"]
+		else:
+			movement = stored_day.get("Movement", 0)
+			transfer = stored_day.get("Transfer", 0)
+
+		values = {
+			"Balance": remaining,
+			"Movement": movement,
+			"Transfer": transfer,
+			"Remaining": remaining + movement + transfer,
+		}
+		for label, value in values.items():
+			if flt(value, 2) != flt(stored_day.get(label), 2):
+				save_movement_of_budget_operations(selected_date, organization_bank_rule_name, value, label)
+		remaining = values["Remaining"]
+		selected_date += timedelta(days=1)
+
+
+def roll_movements_of_budget_operations(organization_bank_rule_name, today, horizon_end):
+	"""
+	Ежедневный сдвиг горизонта без полного пересчёта правила:
+	  — вчера переходит с «Факт поверх План» на чистый Факт, сегодня — с План на «Факт поверх План»,
+	    поэтому оба дня пересчитываются полностью;
+	  — изменение остатка переносится на последующие дни (carry_remaining_forward),
+	    а при выводимом хранении остатков достаточно движений нового дня горизонта.
+	Сдвиг верен, только если прошлый был вчера: после пропущенных дней (или если дата прошлого
+	сдвига неизвестна) правило пересчитывается обычным путём от дня прошлого сдвига.
+	"""
+	rolled_key = f"{HORIZON_ROLLED_CACHE_KEY}:{organization_bank_rule_name}"
+	last_rolled = frappe.cache.get_value(rolled_key)
+	yesterday = today - timedelta(days=1)
+	token = None
+	if last_rolled and getdate(last_rolled) == yesterday:
+		token = acquire_recompute_lock(organization_bank_rule_name)
+	if token is None:
+		# Пропущены дни или правило сейчас пересчитывается — досчитываем обычным путём,
+		# диапазон сольётся с текущим. День прошлого сдвига ещё хранится как «Факт поверх План»
+		recompute_movements_range(
+			organization_bank_rule_name,
+			min(getdate(last_rolled), yesterday) if last_rolled else yesterday,
+			get_recompute_end_date(organization_bank_rule_name),
+		)
+		frappe.cache.set_value(rolled_key, str(today))
+		return
+
+	try:
+		calc_map = get_stored_calc_map()
+		for selected_date in (yesterday, today):
+			for label, (calc_fn, result_key) in calc_map.items():
+				data = calc_fn(organization_bank_rule_name, selected_date)
+				save_movement_of_budget_operations(
+					selected_date, organization_bank_rule_name, data[result_key], label
+				)
+
+		if is_derived_balances():
+			for label, (calc_fn, result_key) in calc_map.items():
+				data = calc_fn(organization_bank_rule_name, horizon_end)
+				save_movement_of_budget_operations(
+					horizon_end, organization_bank_rule_name, data[result_key], label
+				)
+		else:
+			carry_remaining_forward(organization_bank_rule_name, today, horizon_end)
+
+		# Следующий владелец блокировки должен видеть зафиксированный сдвиг
+		frappe.db.commit()
+		bump_budget_data_version()
+		frappe.cache.set_value(rolled_key, str(today))
+	finally:
+		pending = release_recompute_lock(organization_bank_rule_name, token)
+
+	if pending:
+		recompute_movements_range(organization_bank_rule_name, *pending)
 
 
 # def publish_budget_change_by_update_budget_operation(doc, method):
@@ -1452,70 +1966,256 @@ def generate_new_name(doctype, doc):
 	return apply_format(pattern, {"organization": doc.organization, "bank": doc.bank})
 
 
+# Таблицы, ссылки которых на правило переписываются порциями при переименовании
+# Большие таблицы со ссылкой на правило: переписываются порциями, а не в rename_doc
+RULE_LINK_FIELDS = (
+	("Budget Operations", "organization_bank_rule"),
+	("Budget Operations", "recipient_of_transit_payment"),
+	("Movements of Budget Operations", "organization_bank_rule"),
+	("Budget Operations Archive", "organization_bank_rule"),
+	("Budget Operations Archive", "recipient_of_transit_payment"),
+	("Movements of Budget Operations Archive", "organization_bank_rule"),
+	("Budget Operation Groups", "organization_bank_rule"),
+	("Budget Remaining Checkpoints", "organization_bank_rule"),
+	("Budget Forecast Snapshots", "organization_bank_rule"),
+)
+RENAME_CHUNK_SIZE = 5000
+
+
+def enqueue_rules_rename_cascade(rule_names):
+	if not rule_names:
+		return
+	frappe.enqueue(
+		"adr_erp.budget.budget_api.rename_organization_bank_rules_cascade",
+		queue="long",
+		timeout=3600,
+		enqueue_after_commit=True,
+		rule_names=rule_names,
+		user=frappe.session.user,
+	)
+
+
+def rewrite_rule_link_in_chunks(doctype, fieldname, old_name, new_name):
+	"""
+	Переписывает ссылку old_name → new_name в doctype порциями по первичному ключу,
+	фиксируя транзакцию после каждой порции, чтобы не держать блокировки на всей таблице.
+	"""
+	while names := frappe.db.sql_list(
+		f"select name from `tab{doctype}` where `{fieldname}` = %s limit {RENAME_CHUNK_SIZE}",
+		old_name,
+	):
+		frappe.db.sql(
+			f"update `tab{doctype}` set `{fieldname}` = %s where name in %s",
+			(new_name, tuple(names)),
+		)
+		frappe.db.commit()
+
+
+def rename_rule_links_and_doc(old_rule_name, new_rule_name):
+	"""
+	Переписывает ссылки на правило порциями и переименовывает само правило.
+
+	Порции выбираются по старому имени, поэтому прерванное переименование
+	продолжается повторным запуском с того же места. Если переименование упало,
+	уже переписанные порции возвращаются на старое имя: ссылки не остаются
+	на правило, которого нет.
+	"""
+	if frappe.db.exists("Organization-Bank Rules", new_rule_name):
+		frappe.throw(
+			_("Organization-Bank Rule {0} already exists, {1} was not renamed").format(
+				new_rule_name, old_rule_name
+			)
+		)
+	try:
+		for doctype, fieldname in RULE_LINK_FIELDS:
+			rewrite_rule_link_in_chunks(doctype, fieldname, old_rule_name, new_rule_name)
+		frappe.rename_doc("Organization-Bank Rules", old_rule_name, new_rule_name, merge=False)
+		frappe.db.commit()
+	except Exception:
+		frappe.db.rollback()
+		for doctype, fieldname in RULE_LINK_FIELDS:
+			rewrite_rule_link_in_chunks(doctype, fieldname, new_rule_name, old_rule_name)
+		raise
+
+
+def rename_organization_bank_rules_cascade(rule_names, user=None):
+	"""
+	Фоновое переименование правил после переименования организации или банка.
+
+	Ссылки в больших таблицах переписываются порциями, после чего само правило
+	переименовывается через rename_doc (в горячих таблицах ему уже нечего менять).
+	Таблица редактора обновляется один раз в конце.
+	"""
+	frappe.flags.in_budget_rename_cascade = True
+	try:
+		renames = []
+		for old_rule_name in rule_names:
+			rule = frappe.get_doc("Organization-Bank Rules", old_rule_name)
+			new_rule_name = generate_new_name(rule.doctype, rule)
+			if new_rule_name != old_rule_name:
+				renames.append((old_rule_name, new_rule_name))
+
+		for idx, (old_rule_name, new_rule_name) in enumerate(renames):
+			frappe.publish_realtime(
+				"budget_rename_progress",
+				{"done": idx, "total": len(renames), "rule": old_rule_name},
+				user=user,
+			)
+			rename_rule_links_and_doc(old_rule_name, new_rule_name)
+	finally:
+		frappe.flags.in_budget_rename_cascade = False
+
+	frappe.publish_realtime(
+		"budget_rename_progress", {"done": len(renames), "total": len(renames)}, user=user
+	)
+	clear_budget_layout_cache()
+	publish_budget_page_refresh()
+
+
 def publish_budget_change_by_rename_organization(doc, method, after_rename, before_rename, merge):
-	rule_name = frappe.get_all("Organization-Bank Rules", filters={"organization": doc.name}, pluck="name")
-	for old_rule_name in rule_name:
-		rule = frappe.get_doc("Organization-Bank Rules", old_rule_name)
-		new_rule_name = generate_new_name(rule.doctype, rule)
-		frappe.rename_doc(rule.doctype, old_rule_name, new_rule_name, merge=False)
+	rule_names = frappe.get_all("Organization-Bank Rules", filters={"organization": doc.name}, pluck="name")
+	enqueue_rules_rename_cascade(rule_names)
 
 
 def publish_budget_change_by_rename_bank(doc, method, after_rename, before_rename, merge):
-	rule_name = frappe.get_all("Organization-Bank Rules", filters={"bank": doc.name}, pluck="name")
-	for old_rule_name in rule_name:
-		rule = frappe.get_doc("Organization-Bank Rules", old_rule_name)
-		new_rule_name = generate_new_name(rule.doctype, rule)
-		frappe.rename_doc(rule.doctype, old_rule_name, new_rule_name, merge=False)
+	rule_names = frappe.get_all("Organization-Bank Rules", filters={"bank": doc.name}, pluck="name")
+	enqueue_rules_rename_cascade(rule_names)
 
 
 def append_new_expense_item_to_all_organization_bank_rules(expense_item):
 	"""
 	Добавляет ссылку на новый Expense Item ко всем записям в Organization-Bank Rules.
 	Если запись уже содержит этот Expense Item — пропускает её.
+
+	Строки дочерней таблицы вставляются одним bulk insert, без сохранения каждого
+	правила (и без realtime-события на каждое правило).
 	"""
-	rules = frappe.get_all("Organization-Bank Rules", pluck="name")
+	rules = frappe.db.sql(
+		"""
+		select r.name, ifnull(max(l.idx), 0) as max_idx
+		from `tabOrganization-Bank Rules` r
+		left join `tabLink Expenses Items` l
+			on l.parent = r.name
+			and l.parenttype = 'Organization-Bank Rules'
+			and l.parentfield = 'available_expense_items'
+		where not exists (
+			select 1 from `tabLink Expenses Items` x
+			where x.parent = r.name
+				and x.parenttype = 'Organization-Bank Rules'
+				and x.link_expense_item = %(expense_item)s
+		)
+		group by r.name
+		""",
+		{"expense_item": expense_item.name},
+		as_dict=True,
+	)
+	if not rules:
+		return
 
-	for rule_name in rules:
-		rule = frappe.get_doc("Organization-Bank Rules", rule_name)
-		if expense_item not in rule.available_expense_items:
-			rule_row = rule.append("available_expense_items", {})
-			rule_row.link_expense_item = frappe.get_doc("Expense Items", expense_item.name)
-			rule.save()
+	timestamp, user = now(), frappe.session.user
+	frappe.db.bulk_insert(
+		"Link Expenses Items",
+		[
+			"name",
+			"parent",
+			"parenttype",
+			"parentfield",
+			"idx",
+			"link_expense_item",
+			"creation",
+			"modified",
+			"owner",
+			"modified_by",
+			"docstatus",
+		],
+		[
+			(
+				frappe.generate_hash(length=10),
+				rule.name,
+				"Organization-Bank Rules",
+				"available_expense_items",
+				rule.max_idx + 1,
+				expense_item.name,
+				timestamp,
+				timestamp,
+				user,
+				user,
+				0,
+			)
+			for rule in rules
+		],
+	)
+	# Открытые формы правил должны перечитать документ, а не перезаписать его старой версией
+	frappe.db.sql(
+		"update `tabOrganization-Bank Rules` set modified = %s where name in %s",
+		(timestamp, tuple(rule.name for rule in rules)),
+	)
+
+	clear_budget_layout_cache()
+	publish_budget_layout_change()
+
+
+def recompute_expense_item_cascade(expense_item, is_transit=False):
+	"""
+	Фоновый пересчёт после изменения Expense Item: по одному пересчёту на каждого
+	получателя транзита — с самой ранней даты операций по этой статье.
+	"""
+	parents = frappe.get_all(
+		"Link Expenses Items", filters={"link_expense_item": expense_item}, pluck="parent", distinct=True
+	)
+	if not parents:
+		return
+
+	if is_transit:
+		recipients = frappe.db.sql(
+			"""
+			select recipient_of_transit_payment, min(`date`)
+			from `tabBudget Operations`
+			where organization_bank_rule in %(rules)s
+				and expense_item = %(expense_item)s
+				and ifnull(recipient_of_transit_payment, '') != ''
+			group by recipient_of_transit_payment
+			""",
+			{"rules": tuple(parents), "expense_item": expense_item},
+		)
+		for recipient_of_transit_payment, min_date in recipients:
+			calculate_movements_of_budget_operations(recipient_of_transit_payment, min_date, True)
+			publish_budget_change(recipient_of_transit_payment)
+
+	# Изменение статьи может поменять колонки всех правил, где она доступна
+	publish_budget_layout_change()
 
 
 def publish_budget_change_by_update_expense_item(doc, method):
+	clear_budget_layout_cache()
 	is_new = getattr(doc, "flags", None) and doc.flags.in_insert
 	if is_new:
 		append_new_expense_item_to_all_organization_bank_rules(doc)
+		return
 
-	parents = frappe.get_all("Link Expenses Items", filters={"link_expense_item": doc.name}, pluck="parent")
-	links = frappe.get_all("Organization-Bank Rules", filters={"name": ["in", parents]}, fields=["name"])
-	for rule in links:
-		if doc.is_transit and rule.recipient_of_transit_payment != "":
-			all_budget_operations = frappe.get_all(
-				"Budget Operations",
-				filters=[
-					["organization_bank_rule", "=", rule.name],
-					["recipient_of_transit_payment", "!=", ""],  # только заполненные
-				],
-				fields=["date", "recipient_of_transit_payment"],
-				distinct=True,
-			)
-			for budget_operation in all_budget_operations:
-				calculate_movements_of_budget_operations(
-					budget_operation.recipient_of_transit_payment, budget_operation.date, True
-				)
-				publish_budget_change(budget_operation.recipient_of_transit_payment)
-		publish_budget_change(rule.name)
+	frappe.enqueue(
+		"adr_erp.budget.budget_api.recompute_expense_item_cascade",
+		queue="long",
+		timeout=3600,
+		enqueue_after_commit=True,
+		expense_item=doc.name,
+		is_transit=bool(doc.is_transit),
+	)
 
 
 def publish_budget_change_by_update_organization_bank_rule(doc, method):
-	publish_budget_change(doc.name)
+	clear_budget_layout_cache()
+	publish_budget_layout_change(doc.name)
 
 
 def publish_budget_change_by_rename_organization_bank_rule(doc, method, after_rename, before_rename, merge):
+	# При каскадном переименовании таблица обновляется один раз в конце
+	if frappe.flags.in_budget_rename_cascade:
+		return
+	clear_budget_layout_cache()
 	publish_budget_page_refresh()
 
 
 def publish_budget_change_by_trash_organization_bank_rule(doc, method):
+	clear_budget_layout_cache()
 	publish_budget_page_refresh()
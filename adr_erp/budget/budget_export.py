@@ -0,0 +1,214 @@
+import csv
+import io
+import tempfile
+from datetime import timedelta
+
+import frappe
+from frappe import _
+from openpyxl import Workbook
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import wrap_file
+
+from .archive import clamp_to_open_period
+from .budget_api import build_day_rows, build_field_to_index, get_rule_layout_sources, resolve_budget_window
+from .derived_balances import fetch_daily_balances, is_derived_balances
+from .recurring_operations import expand_recurring_operations
+from .utils import read_from_replica
+
+EXPORT_FORMATS = {
+	"xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+	"csv": "text/csv; charset=utf-8",
+}
+
+# Одним потоком читаем и движения, и операции: сначала движения за дату (src = 0),
+# затем операции (src = 1) и пустые группы (src = 2), чтобы к моменту сборки строк
+# метрики дня уже были известны. Закрытые дни читаются из архивных таблиц.
+EXPORT_STREAM_QUERY = """
+	select `date`, 0 as src, budget_balance_type as budget_operation_type, `sum`,
+		null as group_index, null as name, null as expense_item,
+		null as recipient_of_transit_payment, null as external_recipient,
+		null as description, null as comment
+	from `tabMovements of Budget Operations`
+	where organization_bank_rule = %(rule)s and `date` between %(from_date)s and %(to_date)s
+	union all
+	select `date`, 0 as src, budget_balance_type as budget_operation_type, `sum`,
+		null as group_index, null as name, null as expense_item,
+		null as recipient_of_transit_payment, null as external_recipient,
+		null as description, null as comment
+	from `tabMovements of Budget Operations Archive`
+	where organization_bank_rule = %(rule)s and `date` between %(from_date)s and %(to_date)s
+	union all
+	select `date`, 1 as src, budget_operation_type, `sum`,
+		group_index, name, expense_item,
+		recipient_of_transit_payment, external_recipient,
+		description, comment
+	from `tabBudget Operations`
+	where organization_bank_rule = %(rule)s and `date` between %(from_date)s and %(to_date)s
+	union all
+	select `date`, 1 as src, budget_operation_type, `sum`,
+		group_index, name, expense_item,
+		recipient_of_transit_payment, external_recipient,
+		description, comment
+	from `tabBudget Operations Archive`
+	where organization_bank_rule = %(rule)s and `date` between %(from_date)s and %(to_date)s
+	union all
+	select `date`, 2 as src, budget_operation_type, null as `sum`,
+		group_index, null as name, null as expense_item,
+		null as recipient_of_transit_payment, null as external_recipient,
+		null as description, null as comment
+	from `tabBudget Operation Groups`
+	where organization_bank_rule = %(rule)s and `date` between %(from_date)s and %(to_date)s
+	order by `date`, src
+"""
+
+
+def iter_budget_days(organization_bank_rule_name, start_date, end_date):
+	"""
+	Читает движения и операции правила серверным курсором и отдаёт их по дням:
+	(date, {type: [op, ...]}, {budget_balance_type: sum}).
+
+	В памяти одновременно находится только один день.
+	"""
+	rows = frappe.db.sql(
+		EXPORT_STREAM_QUERY,
+		{"rule": organization_bank_rule_name, "from_date": start_date, "to_date": end_date},
+		as_dict=True,
+		as_iterator=True,
+	)
+
+	current_date, day_ops, day_moves = None, {}, {}
+	for row in rows:
+		if row.date != current_date:
+			if current_date is not None:
+				yield current_date, day_ops, day_moves
+			current_date, day_ops, day_moves = row.date, {}, {}
+
+		if row.src == 0:
+			day_moves[row.budget_operation_type] = row.sum
+			continue
+
+		# Приводим операцию к тому же виду, что и fetch_budget_operations
+		row.date = row.date.strftime("%Y-%m-%d")
+		for field in ("expense_item", "description", "comment", "recipient_of_transit_payment"):
+			row[field] = row.get(field) or ""
+		day_ops.setdefault(row.budget_operation_type, []).append(row)
+
+	if current_date is not None:
+		yield current_date, day_ops, day_moves
+
+
+def iter_export_rows(organization_bank_rule_name, start_date, end_date, types, idx_map, num_cols):
+	"""
+	Отдаёт строки таблицы в том же виде, что и редактор, за каждый день периода,
+	включая дни без операций и движений.
+	"""
+	# При выводимом хранении Balance/Remaining не хранятся — берём нарастающий итог
+	# за открытую часть периода
+	derived_start = clamp_to_open_period(start_date)
+	derived = (
+		fetch_daily_balances(derived_start, end_date, rules=[organization_bank_rule_name])
+		if is_derived_balances() and derived_start <= end_date
+		else {}
+	)
+
+	# Повторяющиеся операции не хранятся: как и в редакторе, добавляем их виртуальными
+	# строками План и пустой строкой Факт той же группы
+	recurring = {}
+	for op in expand_recurring_operations([organization_bank_rule_name], start_date, end_date):
+		if op.organization_bank_rule == organization_bank_rule_name:
+			day_ops = recurring.setdefault(op.date, {})
+			op.date = op.date.strftime("%Y-%m-%d")
+			day_ops.setdefault("План", []).append(op)
+			day_ops.setdefault("Факт", []).append(
+				frappe._dict(
+					date=op.date, budget_operation_type="Факт", group_index=op.group_index, expense_item=""
+				)
+			)
+
+	def day_rows(day, day_ops, day_moves):
+		for op_type, ops in recurring.get(day, {}).items():
+			day_ops.setdefault(op_type, []).extend(ops)
+		return build_day_rows(
+			day.strftime("%Y-%m-%d"), types, day_ops, derived.get(day, day_moves), idx_map, num_cols
+		)
+
+	day = start_date
+	for row_date, day_ops, day_moves in iter_budget_days(organization_bank_rule_name, start_date, end_date):
+		while day < row_date:
+			yield from day_rows(day, {}, {})
+			day += timedelta(days=1)
+		yield from day_rows(row_date, day_ops, day_moves)
+		day = row_date + timedelta(days=1)
+
+	while day <= end_date:
+		yield from day_rows(day, {}, {})
+		day += timedelta(days=1)
+
+
+def write_csv(fileobj, headers, rows):
+	# utf-8-sig — чтобы Excel корректно открыл кириллицу
+	text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="", write_through=True)
+	writer = csv.writer(text)
+	writer.writerow(headers)
+	for row in rows:
+		writer.writerow(row)
+	text.detach()
+
+
+def write_xlsx(fileobj, headers, rows):
+	# write_only: строки сразу сбрасываются во временный файл, а не копятся в памяти
+	workbook = Workbook(write_only=True)
+	sheet = workbook.create_sheet(_("Budget"))
+	sheet.append(headers)
+	for row in rows:
+		sheet.append(row)
+	workbook.save(fileobj)
+
+
+@frappe.whitelist()
+@read_from_replica
+def export_budget_data(organization_bank_rule_name, from_date, to_date, file_format="xlsx"):
+	"""
+	Выгружает таблицу редактора за период [from_date, to_date] в XLSX или CSV.
+
+	Строки пишутся во временный файл по мере чтения из БД, поэтому расход памяти
+	не зависит от длины периода.
+	"""
+	frappe.has_permission("Budget Operations", "export", throw=True)
+
+	if file_format not in EXPORT_FORMATS:
+		frappe.throw(_("Unsupported export format: {0}").format(file_format))
+
+	start_date, end_date = resolve_budget_window(from_date=from_date, to_date=to_date)
+
+	types, items, colHeaders, columns = get_rule_layout_sources(organization_bank_rule_name)
+	idx_map = build_field_to_index(columns)
+	num_cols = len(columns)
+
+	# Служебные колонки с идентификаторами операций в выгрузку не попадают
+	hidden_fields = {f"{item['name']}_name" for item in items}
+	export_idx = [idx for idx, col in enumerate(columns) if col["field"] not in hidden_fields]
+	headers = [colHeaders[idx] for idx in export_idx]
+	rows = (
+		[row[idx] for idx in export_idx]
+		for row in iter_export_rows(
+			organization_bank_rule_name, start_date, end_date, types, idx_map, num_cols
+		)
+	)
+
+	fileobj = tempfile.TemporaryFile()
+	with frappe.db.unbuffered_cursor():
+		if file_format == "csv":
+			write_csv(fileobj, headers, rows)
+		else:
+			write_xlsx(fileobj, headers, rows)
+	fileobj.seek(0)
+
+	filename = f"{organization_bank_rule_name} {start_date} - {end_date}.{file_format}".replace("/", "-")
+	response = Response(
+		wrap_file(frappe.local.request.environ, fileobj),
+		mimetype=EXPORT_FORMATS[file_format],
+		direct_passthrough=True,
+	)
+	response.headers.set("Content-Disposition", "attachment", filename=filename)
+	return response
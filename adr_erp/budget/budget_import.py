@@ -0,0 +1,428 @@
+import csv
+import json
+import math
+import os
+from collections import Counter
+from itertools import islice
+
+import frappe
+from frappe import _
+from frappe.utils import cint, flt, getdate, now
+from openpyxl import load_workbook
+
+from .archive import get_sealed_until
+from .budget_api import (
+	fetch_budget_operation_groups,
+	get_available_expense_items,
+	remove_budget_operation_group,
+)
+from .cash_flow_cube import mark_cash_flow_cube_dirty
+from .group_index import claim_group_index, reserve_group_indices
+from .recurring_operations import (
+	expand_recurring_operations,
+	is_recurring_group_index,
+	materialize_recurring_operation,
+)
+from .utils import stick_to_primary
+
+IMPORT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+# Пустая группа Факт из Budget Operation Groups: операции нет, заполнение — новая строка
+EMPTY_FACT_GROUP = "empty"
+
+# Заголовки выписки → поля Budget Operations.
+# Принимаются как имена полей, так и подписи (в т.ч. переведённые).
+COLUMN_ALIASES = {
+	"date": ("date", "Date", "Дата"),
+	"expense_item": ("expense_item", "Expense item", "Статья расходов"),
+	"sum": ("sum", "Sum", "Сумма"),
+	"external_recipient": ("external_recipient", "External Recipient", "Внешний получатель"),
+	"recipient_of_transit_payment": (
+		"recipient_of_transit_payment",
+		"Recipient of transit payment (Organization-Bank Rule)",
+		"Transit",
+		"Транзит",
+	),
+	"description": ("description", "Description", "Описание"),
+	"comment": ("comment", "Comment", "Комментарий"),
+	"group_index": ("group_index", "Group index", "Group Index"),
+}
+
+INSERT_FIELDS = (
+	"date",
+	"budget_operation_type",
+	"organization_bank_rule",
+	"group_index",
+	"sum",
+	"expense_item",
+	"recipient_of_transit_payment",
+	"external_recipient",
+	"description",
+	"comment",
+	"creation",
+	"modified",
+	"owner",
+	"modified_by",
+	"docstatus",
+	"idx",
+)
+
+
+def build_header_map(header, column_map=None):
+	"""
+	Сопоставляет индексы колонок выписки полям Budget Operations.
+
+	column_map — явное сопоставление {заголовок выписки: поле}, имеет приоритет
+	над стандартными алиасами.
+	"""
+	aliases = {}
+	for field, names in COLUMN_ALIASES.items():
+		for name in names:
+			aliases[name.strip().lower()] = field
+	for column, field in (column_map or {}).items():
+		aliases[column.strip().lower()] = field
+
+	header_map = {}
+	for idx, title in enumerate(header):
+		field = aliases.get(str(title or "").strip().lower())
+		if field and field not in header_map.values():
+			header_map[idx] = field
+
+	missing = {"date", "expense_item", "sum"} - set(header_map.values())
+	if missing:
+		frappe.throw(_("Bank statement is missing required columns: {0}").format(", ".join(sorted(missing))))
+	return header_map
+
+
+def iter_raw_rows(file_path):
+	"""
+	Построчно читает CSV или XLSX, не загружая файл целиком.
+	"""
+	if file_path.lower().endswith(".xlsx"):
+		workbook = load_workbook(file_path, read_only=True, data_only=True)
+		try:
+			yield from workbook.active.iter_rows(values_only=True)
+		finally:
+			workbook.close()
+		return
+
+	with open(file_path, encoding="utf-8-sig", newline="") as f:
+		sample = f.read(4096)
+		f.seek(0)
+		try:
+			dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+		except csv.Error:
+			dialect = csv.excel
+		yield from csv.reader(f, dialect)
+
+
+def iter_statement_rows(file_path, column_map=None):
+	"""
+	Отдаёт строки выписки в виде (номер строки, {поле: значение}).
+	"""
+	raw_rows = iter_raw_rows(file_path)
+	header = next(raw_rows, None)
+	if header is None:
+		return
+	header_map = build_header_map(header, column_map)
+
+	for line_no, raw in enumerate(raw_rows, start=2):
+		if not raw or all(value in (None, "") for value in raw):
+			continue
+		yield line_no, {field: raw[idx] for idx, field in header_map.items() if idx < len(raw)}
+
+
+def parse_statement_amount(value):
+	"""
+	Разбирает сумму выписки: число из xlsx или строку вида "1234,56", "1 234,56"
+	(пробел или неразрывный пробел между разрядами), "1.234,56", "1,234.56".
+	Возвращает модуль суммы или None, если сумму разобрать нельзя.
+	"""
+	if isinstance(value, int | float):
+		return abs(flt(value))
+	text = "".join(str(value or "").split()).replace("'", "")
+	if "," in text and "." in text:
+		# Десятичный разделитель — тот, что правее, другой разделяет разряды
+		grouping = "." if text.rfind(",") > text.rfind(".") else ","
+		text = text.replace(grouping, "").replace(",", ".")
+	elif text.count(",") == 1:
+		text = text.replace(",", ".")
+	elif text.count(",") > 1 or text.count(".") > 1:
+		text = text.replace(",", "").replace(".", "")
+	try:
+		amount = abs(float(text))
+	except ValueError:
+		return None
+	return amount if math.isfinite(amount) else None
+
+
+def normalize_statement_row(row, expense_items, rule_names):
+	"""
+	Проверяет строку выписки и приводит её к виду операции Факт.
+	Возвращает (операция, текст ошибки).
+	"""
+	try:
+		target_date = getdate(row.get("date"))
+	except Exception:
+		target_date = None
+	if not target_date:
+		return None, _("Invalid date: {0}").format(row.get("date"))
+	sealed_until = get_sealed_until()
+	if sealed_until and target_date <= sealed_until:
+		return None, _("Period up to {0} is closed").format(frappe.format(sealed_until, "Date"))
+
+	expense_item = str(row.get("expense_item") or "").strip()
+	if expense_item not in expense_items:
+		return None, _("Expense item {0} is not available for this rule").format(expense_item)
+
+	recipient = str(row.get("recipient_of_transit_payment") or "").strip()
+	if recipient and recipient not in rule_names:
+		return None, _("Unknown recipient of transit payment: {0}").format(recipient)
+	if recipient and not expense_items[expense_item]:
+		return None, _("Expense item {0} is not transit").format(expense_item)
+
+	amount = parse_statement_amount(row.get("sum"))
+	if not amount:
+		return None, _("Invalid sum: {0}").format("" if row.get("sum") is None else row.get("sum"))
+
+	group_index = row.get("group_index")
+	return {
+		"date": target_date,
+		"expense_item": expense_item,
+		"sum": amount,
+		"recipient_of_transit_payment": recipient,
+		"external_recipient": str(row.get("external_recipient") or "").strip(),
+		"description": str(row.get("description") or ""),
+		"comment": str(row.get("comment") or ""),
+		"group_index": None if group_index in (None, "") else cint(group_index),
+	}, None
+
+
+def fetch_day_groups(organization_bank_rule_name, dates):
+	"""
+	Одним запросом получает группы операций за указанные даты:
+	  plans — {(date, expense_item): [group_index, ...]} для План (включая виртуальные
+	          повторяющиеся операции),
+	  facts — {(date, group_index): {expense_item: name}} для Факт; пустая группа Факт
+	          записана под статьёй "" со значением EMPTY_FACT_GROUP.
+	"""
+	ops = frappe.db.sql(
+		"""
+		select name, `date`, budget_operation_type, ifnull(expense_item, '') as expense_item, group_index
+		from `tabBudget Operations`
+		where organization_bank_rule = %(rule)s and `date` in %(dates)s
+		order by `date`, group_index
+		""",
+		{"rule": organization_bank_rule_name, "dates": tuple(dates)},
+		as_dict=True,
+	)
+
+	plans, facts = {}, {}
+	for op in ops:
+		if op.budget_operation_type == "План":
+			if op.expense_item:
+				plans.setdefault((op.date, op.expense_item), []).append(op.group_index)
+		else:
+			facts.setdefault((op.date, op.group_index), {})[op.expense_item] = op.name
+
+	for group in fetch_budget_operation_groups(organization_bank_rule_name, min(dates), max(dates)):
+		day = getdate(group["date"])
+		if group["budget_operation_type"] == "Факт" and day in dates:
+			facts.setdefault((day, group["group_index"]), {}).setdefault("", EMPTY_FACT_GROUP)
+
+	for op in expand_recurring_operations([organization_bank_rule_name], min(dates), max(dates)):
+		if op.organization_bank_rule == organization_bank_rule_name and op.date in dates:
+			plans.setdefault((op.date, op.expense_item), []).append(op.group_index)
+	return plans, facts
+
+
+def build_insert_row(organization_bank_rule_name, target_date, group_index, values, timestamp, user):
+	return (
+		target_date,
+		"Факт",
+		organization_bank_rule_name,
+		group_index,
+		values["sum"],
+		values["expense_item"],
+		values["recipient_of_transit_payment"],
+		values["external_recipient"],
+		values["description"],
+		values["comment"],
+		timestamp,
+		timestamp,
+		user,
+		user,
+		0,
+		0,
+	)
+
+
+def import_statement_batch(organization_bank_rule_name, batch):
+	"""
+	Раскладывает пачку операций Факт по существующим группам План и сохраняет их:
+	новые строки — одним bulk insert, совпавшие Факт — обновлением.
+	"""
+	plans, facts = fetch_day_groups(organization_bank_rule_name, {op["date"] for op in batch})
+
+	timestamp, user = now(), frappe.session.user
+	inserts, new_groups = [], []
+	# Наибольший явно занятый group_index по дням — счётчик резервирования поднимается до него
+	claimed = {}
+	for op in batch:
+		target_date, expense_item = op["date"], op["expense_item"]
+		group_index = op["group_index"]
+
+		if group_index is None:
+			# Первая группа План с этой статьёй, у которой ещё нет Факта по ней
+			group_index = next(
+				(
+					gi
+					for gi in plans.get((target_date, expense_item), [])
+					if expense_item not in facts.get((target_date, gi), {})
+				),
+				None,
+			)
+		if group_index is not None and facts.get((target_date, group_index), {}).get(expense_item) is True:
+			# Статья в группе уже занята строкой из этой же выписки — нужна новая группа
+			group_index = None
+
+		values = {
+			"expense_item": expense_item,
+			"sum": op["sum"],
+			"recipient_of_transit_payment": op["recipient_of_transit_payment"],
+			"external_recipient": op["external_recipient"],
+			"description": op["description"],
+			"comment": op["comment"],
+		}
+		if group_index is None:
+			new_groups.append((target_date, values))
+			continue
+
+		if is_recurring_group_index(group_index):
+			# Факт в группе повторяющейся операции — её План сохраняется
+			materialize_recurring_operation(organization_bank_rule_name, target_date, group_index)
+
+		group_facts = facts.setdefault((target_date, group_index), {})
+		# Факт по этой статье — обновляем на месте; пустая группа заполняется новой строкой
+		existing = group_facts.get(expense_item)
+		placeholder = None if existing else group_facts.pop("", None)
+		if placeholder == EMPTY_FACT_GROUP:
+			remove_budget_operation_group(organization_bank_rule_name, target_date, "Факт", group_index)
+		elif placeholder:
+			# Пустая строка-заготовка, ещё не перенесённая в Budget Operation Groups
+			existing = placeholder
+		if existing:
+			frappe.db.set_value("Budget Operations", existing, values)
+			group_facts[expense_item] = existing
+			continue
+
+		group_facts[expense_item] = True
+		claimed[target_date] = max(claimed.get(target_date, group_index), group_index)
+		inserts.append(
+			build_insert_row(organization_bank_rule_name, target_date, group_index, values, timestamp, user)
+		)
+
+	for target_date, group_index in claimed.items():
+		claim_group_index(organization_bank_rule_name, target_date, group_index)
+	# Новые группы: один диапазон group_index на дату
+	next_free = {
+		target_date: reserve_group_indices(organization_bank_rule_name, target_date, count)
+		for target_date, count in Counter(target_date for target_date, _values in new_groups).items()
+	}
+	for target_date, values in new_groups:
+		inserts.append(
+			build_insert_row(
+				organization_bank_rule_name, target_date, next_free[target_date], values, timestamp, user
+			)
+		)
+		next_free[target_date] += 1
+
+	if inserts:
+		frappe.db.bulk_insert("Budget Operations", INSERT_FIELDS, inserts)
+	# bulk insert и set_value обходят doc_events — помечаем месяцы куба явно
+	mark_cash_flow_cube_dirty(organization_bank_rule_name, {op["date"] for op in batch})
+
+
+@frappe.whitelist()
+def import_bank_statement(organization_bank_rule_name, file_url, column_map=None):
+	"""
+	Ставит в очередь импорт банковской выписки (CSV/XLSX) как операций Факт.
+	"""
+	frappe.has_permission("Budget Operations", "create", throw=True)
+	file_path = frappe.get_doc("File", {"file_url": file_url}).get_full_path()
+	if not os.path.exists(file_path):
+		frappe.throw(_("File {0} not found").format(file_url))
+
+	if isinstance(column_map, str):
+		column_map = json.loads(column_map or "{}")
+
+	frappe.enqueue(
+		"adr_erp.budget.budget_import.run_bank_statement_import",
+		queue="long",
+		timeout=3600,
+		organization_bank_rule_name=organization_bank_rule_name,
+		file_path=file_path,
+		column_map=column_map,
+		user=frappe.session.user,
+	)
+	return {"success": True}
+
+
+def run_bank_statement_import(organization_bank_rule_name, file_path, column_map=None, user=None):
+	"""
+	Потоково импортирует выписку пачками по IMPORT_BATCH_SIZE строк и
+	запускает один пересчёт на каждое затронутое правило с самой ранней даты.
+	"""
+	expense_items = {
+		item["name"]: item["is_transit"] for item in get_available_expense_items(organization_bank_rule_name)
+	}
+	rule_names = set(frappe.get_all("Organization-Bank Rules", pluck="name"))
+
+	affected_rules = {}
+	imported, errors = 0, []
+	rows = iter_statement_rows(file_path, column_map)
+	while batch_rows := list(islice(rows, IMPORT_BATCH_SIZE)):
+		batch = []
+		for line_no, row in batch_rows:
+			op, error = normalize_statement_row(row, expense_items, rule_names)
+			if error:
+				if len(errors) < MAX_REPORTED_ERRORS:
+					errors.append(_("Line {0}: {1}").format(line_no, error))
+				continue
+			batch.append(op)
+			for rule in (organization_bank_rule_name, op["recipient_of_transit_payment"]):
+				if rule and (rule not in affected_rules or op["date"] < affected_rules[rule]):
+					affected_rules[rule] = op["date"]
+
+		if batch:
+			import_statement_batch(organization_bank_rule_name, batch)
+			imported += len(batch)
+		frappe.db.commit()
+		frappe.publish_realtime(
+			"budget_import_progress",
+			{"organization_bank_rule_name": organization_bank_rule_name, "imported": imported},
+			user=user,
+		)
+
+	stick_to_primary(user)
+
+	# Один пересчёт на правило — с самой ранней импортированной даты
+	for rule, min_date in affected_rules.items():
+		frappe.enqueue(
+			"adr_erp.tasks.prepare_budget_movement_data",
+			queue="long",
+			timeout=3600,
+			rule=rule,
+			target_date=min_date,
+		)
+
+	frappe.publish_realtime(
+		"budget_import_finished",
+		{
+			"organization_bank_rule_name": organization_bank_rule_name,
+			"imported": imported,
+			"errors": errors,
+		},
+		user=user,
+	)
+	return {"imported": imported, "errors": errors}
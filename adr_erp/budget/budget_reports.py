@@ -0,0 +1,174 @@
+import json
+
+import frappe
+from frappe import _
+from frappe.utils import flt
+
+from .archive import ARCHIVE_TABLES, get_sealed_until
+from .budget_api import get_budget_data_version, get_date_range, resolve_budget_window
+from .derived_balances import fetch_daily_balances, is_derived_balances
+from .utils import read_from_replica
+
+CASH_POSITION_CACHE_KEY = "adr_erp:cash_position"
+CASH_POSITION_CACHE_TTL = 60 * 60
+
+BALANCE_TYPES = ("Balance", "Remaining", "Transfer", "Movement")
+
+# Группировка отчёта План/Факт: по группам (без свёртки), по дням или по месяцам
+VARIANCE_PERIODS = {"Group": None, "Day": "%%Y-%%m-%%d", "Month": "%%Y-%%m-01"}
+
+
+def fetch_cash_position(start_date, end_date, organization=None):
+	"""
+	Одним GROUP BY по Movements of Budget Operations (и архиву закрытых дней) суммирует
+	движения всех правил организации (или всех организаций) по дням и типам.
+	"""
+	conditions = ["m.`date` between %(from_date)s and %(to_date)s"]
+	if organization:
+		conditions.append("r.organization = %(organization)s")
+
+	return frappe.db.sql(
+		f"""
+		select m.`date`, m.budget_balance_type, sum(m.`sum`) as total
+		from (
+			select `date`, organization_bank_rule, budget_balance_type, `sum`
+			from `tabMovements of Budget Operations`
+			union all
+			select `date`, organization_bank_rule, budget_balance_type, `sum`
+			from `tabMovements of Budget Operations Archive`
+		) m
+		join `tabOrganization-Bank Rules` r on r.name = m.organization_bank_rule
+		where {" and ".join(conditions)}
+		group by m.`date`, m.budget_balance_type
+		""",
+		{"from_date": start_date, "to_date": end_date, "organization": organization},
+		as_dict=True,
+	)
+
+
+@frappe.whitelist()
+@read_from_replica
+def get_consolidated_cash_position(organization=None, from_date=None, to_date=None, number_of_days=None):
+	"""
+	Возвращает Balance/Remaining/Transfer/Movement по дням, просуммированные
+	по всем правилам организации, а если организация не задана — по всем организациям.
+
+	Результат кешируется до следующего пересчёта движений (по версии данных).
+	"""
+	frappe.has_permission("Movements of Budget Operations", "read", throw=True)
+	start_date, end_date = resolve_budget_window(number_of_days, from_date, to_date)
+
+	key = (
+		f"{CASH_POSITION_CACHE_KEY}:{get_budget_data_version()}:{organization or ''}:{start_date}:{end_date}"
+	)
+	result = frappe.cache.get_value(key)
+	if result is not None:
+		return result
+
+	totals = {}
+	if is_derived_balances():
+		# Balance/Remaining не хранятся — нарастающий итог по всем правилам организации
+		for day, values in fetch_daily_balances(start_date, end_date, organization=organization).items():
+			totals[day.strftime("%Y-%m-%d")] = values
+	else:
+		for row in fetch_cash_position(start_date, end_date, organization):
+			totals.setdefault(row.date.strftime("%Y-%m-%d"), {})[row.budget_balance_type] = flt(row.total)
+
+	result = {
+		"organization": organization,
+		"fromDate": start_date.strftime("%Y-%m-%d"),
+		"toDate": end_date.strftime("%Y-%m-%d"),
+		"data": [
+			{"date": dt, **{t.lower(): totals.get(dt, {}).get(t, 0.0) for t in BALANCE_TYPES}}
+			for dt in get_date_range(start_date, end_date)
+		],
+	}
+	frappe.cache.set_value(key, result, expires_in_sec=CASH_POSITION_CACHE_TTL)
+	return result
+
+
+def get_budget_operations_source(start_date):
+	"""
+	Таблица операций для отчёта: горячая, а если период задевает закрытые дни, — вместе с архивом.
+	"""
+	sealed_until = get_sealed_until()
+	if not sealed_until or start_date > sealed_until:
+		return "`tabBudget Operations`"
+	archive_doctype = ARCHIVE_TABLES["Budget Operations"][0]
+	fields = "organization_bank_rule, `date`, group_index, expense_item, budget_operation_type, `sum`"
+	return f"""(
+		select {fields} from `tabBudget Operations`
+		union all
+		select {fields} from `tab{archive_doctype}`
+	)"""
+
+
+def fetch_plan_fact_variance(rules, start_date, end_date, period="Month"):
+	"""
+	Сопоставляет План и Факт по группам (rule, date, group_index, expense_item) одним запросом
+	с условной агрегацией по индексу (правило, дата, тип) и сворачивает их по статьям и периоду.
+	"""
+	if period not in VARIANCE_PERIODS:
+		frappe.throw(_("Unknown period {0}").format(period))
+	if not rules:
+		return []
+
+	groups = f"""
+		select o.organization_bank_rule, o.`date`, o.group_index, o.expense_item,
+			sum(case when o.budget_operation_type = 'План' then o.`sum` else 0 end) as plan,
+			sum(case when o.budget_operation_type = 'Факт' then o.`sum` else 0 end) as fact
+		from {get_budget_operations_source(start_date)} o
+		where o.organization_bank_rule in %(rules)s
+			and o.`date` between %(from_date)s and %(to_date)s
+			and o.budget_operation_type in ('План', 'Факт')
+			and ifnull(o.expense_item, '') != ''
+		group by o.organization_bank_rule, o.`date`, o.group_index, o.expense_item
+	"""
+	period_format = VARIANCE_PERIODS[period]
+	if period_format is None:
+		query = f"{groups} order by o.`date`, o.organization_bank_rule, o.group_index, o.expense_item"
+	else:
+		query = f"""
+			select date_format(g.`date`, '{period_format}') as period, g.expense_item,
+				sum(g.plan) as plan, sum(g.fact) as fact, count(*) as groups_count
+			from ({groups}) g
+			group by period, g.expense_item
+			order by period, g.expense_item
+		"""
+
+	rows = frappe.db.sql(
+		query,
+		{"rules": tuple(rules), "from_date": start_date, "to_date": end_date},
+		as_dict=True,
+	)
+	for row in rows:
+		row.plan, row.fact = flt(row.plan, 2), flt(row.fact, 2)
+		row.variance = flt(row.fact - row.plan, 2)
+		row.variance_percent = flt(row.variance / row.plan * 100, 2) if row.plan else None
+	return rows
+
+
+@frappe.whitelist()
+@read_from_replica
+def get_plan_fact_variance(rules=None, from_date=None, to_date=None, number_of_days=None, period="Month"):
+	"""
+	Отклонения Факта от Плана по правилам rules (по умолчанию все): абсолютные и в процентах,
+	по группам или свёрнутые по статьям за день/месяц.
+	"""
+	frappe.has_permission("Budget Operations", "read", throw=True)
+	if isinstance(rules, str):
+		rules = json.loads(rules)
+	if not rules:
+		rules = frappe.get_all("Organization-Bank Rules", pluck="name")
+	start_date, end_date = resolve_budget_window(number_of_days, from_date, to_date)
+
+	rows = fetch_plan_fact_variance(rules, start_date, end_date, period)
+	for row in rows:
+		if "date" in row:
+			row.date = row.date.strftime("%Y-%m-%d")
+	return {
+		"fromDate": start_date.strftime("%Y-%m-%d"),
+		"toDate": end_date.strftime("%Y-%m-%d"),
+		"period": period,
+		"data": rows,
+	}
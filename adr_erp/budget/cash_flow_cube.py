@@ -0,0 +1,221 @@
+import frappe
+from frappe.utils import get_first_day, get_last_day, getdate, now
+
+CUBE_DOCTYPE = "Budget Cash Flow Cube"
+CUBE_DIRTY_CACHE_KEY = "adr_erp:cash_flow_cube:dirty"
+CUBE_REFRESH_JOB_ID = "adr_erp:cash_flow_cube:refresh"
+CUBE_INSERT_CHUNK_SIZE = 5000
+CUBE_FIELDS = (
+	"month",
+	"organization",
+	"bank",
+	"expense_item",
+	"entry_type",
+	"budget_operation_type",
+	"sum",
+	"operations_count",
+)
+
+# Операции горячей таблицы и архива, агрегированные по ячейкам куба.
+# Пустые группы (без статьи) в куб не попадают.
+CUBE_AGGREGATE_QUERY = """
+	select
+		date_format(o.`date`, '%%Y-%%m-01') as month,
+		r.organization,
+		r.bank,
+		o.expense_item,
+		e.entry_type,
+		o.budget_operation_type,
+		sum(o.`sum`) as `sum`,
+		count(*) as operations_count
+	from (
+		select `date`, organization_bank_rule, expense_item, budget_operation_type, `sum`
+		from `tabBudget Operations`
+		where {conditions}
+		union all
+		select `date`, organization_bank_rule, expense_item, budget_operation_type, `sum`
+		from `tabBudget Operations Archive`
+		where {conditions}
+	) o
+	join `tabOrganization-Bank Rules` r on r.name = o.organization_bank_rule
+	join `tabExpense Items` e on e.name = o.expense_item
+	where {rule_conditions}
+	group by month, r.organization, r.bank, o.expense_item, e.entry_type, o.budget_operation_type
+"""
+
+
+def get_cube_cell_key(organization, bank, month):
+	return f"{organization}|{bank}|{getdate(month)}"
+
+
+def mark_cash_flow_cube_dirty(organization_bank_rule_name, dates):
+	"""
+	Помечает месяцы правила как устаревшие в кубе и ставит в очередь их пересборку.
+	Ячейки куба ключуются по организации и банку правила.
+	"""
+	organization, bank = frappe.db.get_value(
+		"Organization-Bank Rules", organization_bank_rule_name, ["organization", "bank"]
+	) or (None, None)
+	if not organization or not bank:
+		return
+	mark_cube_cells_dirty({get_cube_cell_key(organization, bank, get_first_day(d)) for d in dates})
+
+
+def mark_cube_cells_dirty(cells):
+	if not cells:
+		return
+	frappe.cache.sadd(CUBE_DIRTY_CACHE_KEY, *cells)
+	frappe.enqueue(
+		"adr_erp.budget.cash_flow_cube.refresh_dirty_cube_cells",
+		queue="short",
+		job_id=CUBE_REFRESH_JOB_ID,
+		deduplicate=True,
+		enqueue_after_commit=True,
+	)
+
+
+def pop_dirty_cube_cells():
+	cells = set()
+	while (cell := frappe.cache.spop(CUBE_DIRTY_CACHE_KEY)) is not None:
+		cells.add(frappe.safe_decode(cell))
+	return cells
+
+
+def fetch_cube_rows(conditions, rule_conditions, values):
+	return frappe.db.sql(
+		CUBE_AGGREGATE_QUERY.format(conditions=conditions, rule_conditions=rule_conditions),
+		values,
+		as_dict=True,
+	)
+
+
+def insert_cube_rows(rows):
+	timestamp, user = now(), frappe.session.user
+	frappe.db.bulk_insert(
+		CUBE_DOCTYPE,
+		["name", *CUBE_FIELDS, "creation", "modified", "owner", "modified_by"],
+		[
+			(
+				frappe.generate_hash(length=10),
+				*(row[field] for field in CUBE_FIELDS),
+				timestamp,
+				timestamp,
+				user,
+				user,
+			)
+			for row in rows
+		],
+		chunk_size=CUBE_INSERT_CHUNK_SIZE,
+	)
+
+
+def refresh_cube_cell(organization, bank, month):
+	"""
+	Пересобирает ячейки куба одной организации и банка за месяц.
+	"""
+	month = getdate(month)
+	values = {
+		"from_date": month,
+		"to_date": get_last_day(month),
+		"organization": organization,
+		"bank": bank,
+	}
+	rows = fetch_cube_rows(
+		"`date` between %(from_date)s and %(to_date)s",
+		"r.organization = %(organization)s and r.bank = %(bank)s",
+		values,
+	)
+	frappe.db.delete(CUBE_DOCTYPE, {"month": month, "organization": organization, "bank": bank})
+	if rows:
+		insert_cube_rows(rows)
+
+
+def refresh_dirty_cube_cells():
+	"""
+	Пересобирает помеченные ячейки куба; вызывается фоновой задачей после изменений операций.
+	"""
+	cells = pop_dirty_cube_cells()
+	for cell in sorted(cells):
+		organization, bank, month = cell.split("|")
+		refresh_cube_cell(organization, bank, month)
+	frappe.db.commit()
+	return len(cells)
+
+
+@frappe.whitelist()
+def rebuild_cash_flow_cube():
+	"""
+	Полностью пересобирает куб по всем операциям, включая архив.
+	"""
+	frappe.only_for("System Manager")
+	frappe.enqueue(
+		"adr_erp.budget.cash_flow_cube.run_cash_flow_cube_rebuild",
+		queue="long",
+		timeout=3600,
+		job_id=f"{CUBE_REFRESH_JOB_ID}:full",
+		deduplicate=True,
+	)
+	return {"success": True}
+
+
+def run_cash_flow_cube_rebuild():
+	# Помеченные ячейки пересобираются полной пересборкой
+	pop_dirty_cube_cells()
+	rows = fetch_cube_rows("1 = 1", "1 = 1", {})
+	frappe.db.delete(CUBE_DOCTYPE)
+	if rows:
+		insert_cube_rows(rows)
+	frappe.db.commit()
+	frappe.logger("adr_erp").info(f"Cash flow cube rebuilt: {len(rows)} cells")
+
+
+def mark_cube_dirty_by_budget_operation(doc, method):
+	"""
+	doc_events Budget Operations: помечает месяц операции (и прежний месяц при переносе).
+	"""
+	dates = {doc.date}
+	rules = {doc.organization_bank_rule}
+	before = doc.get_doc_before_save() if method == "on_update" else None
+	if before:
+		dates.add(before.date)
+		rules.add(before.organization_bank_rule)
+	for rule in rules:
+		if rule:
+			mark_cash_flow_cube_dirty(rule, {getdate(d) for d in dates if d})
+
+
+def mark_cube_dirty_by_organization_bank_rule(doc, method):
+	"""
+	Смена организации или банка правила переносит его операции в другие ячейки куба.
+	"""
+	if not (doc.has_value_changed("organization") or doc.has_value_changed("bank")):
+		return
+	before = doc.get_doc_before_save()
+	if not before:
+		return
+	months = frappe.db.sql_list(
+		"""
+		select distinct date_format(`date`, '%%Y-%%m-01') from (
+			select `date` from `tabBudget Operations` where organization_bank_rule = %(rule)s
+			union all
+			select `date` from `tabBudget Operations Archive` where organization_bank_rule = %(rule)s
+		) t
+		""",
+		{"rule": doc.name},
+	)
+	mark_cube_cells_dirty(
+		{
+			get_cube_cell_key(organization, bank, month)
+			for organization, bank in ((before.organization, before.bank), (doc.organization, doc.bank))
+			if organization and bank
+			for month in months
+		}
+	)
+
+
+def sync_cube_entry_type(doc, method):
+	"""
+	Тип статьи хранится в кубе как измерение — обновляем его на месте.
+	"""
+	if doc.has_value_changed("entry_type"):
+		frappe.db.set_value(CUBE_DOCTYPE, {"expense_item": doc.name}, "entry_type", doc.entry_type)
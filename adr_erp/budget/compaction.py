@@ -0,0 +1,114 @@
+import frappe
+from frappe.utils import now
+
+from .budget_api import SPARSE_BALANCE_TYPES, is_sparse_movements_storage
+
+COMPACTION_CHUNK_SIZE = 5000
+
+GROUP_FIELDS = ["name", "date", "organization_bank_rule", "budget_operation_type", "group_index"]
+
+
+def fetch_group_slots(doctype, rules, dates, non_empty_only=False):
+	"""
+	Возвращает занятые слоты (rule, date, type, group_index) по правилам и датам пачки.
+	"""
+	condition = "and ifnull(expense_item, '') != ''" if non_empty_only else ""
+	return set(
+		frappe.db.sql(
+			f"""
+			select distinct organization_bank_rule, `date`, budget_operation_type, group_index
+			from `tab{doctype}`
+			where organization_bank_rule in %(rules)s and `date` in %(dates)s {condition}
+			""",
+			{"rules": tuple(rules), "dates": tuple(dates)},
+		)
+	)
+
+
+def compact_budget_operation_placeholders(chunk_size=COMPACTION_CHUNK_SIZE):
+	"""
+	Переносит пустые строки-заготовки Budget Operations (expense_item = "", sum = 0)
+	в Budget Operation Groups и удаляет их пачками по chunk_size с коммитом после каждой.
+	Слот переносится, только если в нём нет других операций и записи о группе.
+	"""
+	removed = 0
+	while True:
+		placeholders = frappe.db.sql(
+			"""
+			select name, organization_bank_rule, `date`, budget_operation_type, group_index
+			from `tabBudget Operations`
+			where ifnull(expense_item, '') = '' and ifnull(`sum`, 0) = 0
+			limit %s
+			""",
+			chunk_size,
+			as_dict=True,
+		)
+		if not placeholders:
+			break
+
+		rules = {p.organization_bank_rule for p in placeholders}
+		dates = {p.date for p in placeholders}
+		occupied = fetch_group_slots("Budget Operations", rules, dates, non_empty_only=True)
+		occupied |= fetch_group_slots("Budget Operation Groups", rules, dates)
+
+		timestamp, user = now(), frappe.session.user
+		groups = []
+		for p in placeholders:
+			slot = (p.organization_bank_rule, p.date, p.budget_operation_type, p.group_index)
+			if slot in occupied:
+				continue
+			occupied.add(slot)
+			groups.append(
+				(
+					frappe.generate_hash(length=10),
+					p.date,
+					p.organization_bank_rule,
+					p.budget_operation_type,
+					p.group_index,
+					timestamp,
+					timestamp,
+					user,
+					user,
+				)
+			)
+
+		if groups:
+			frappe.db.bulk_insert(
+				"Budget Operation Groups",
+				[*GROUP_FIELDS, "creation", "modified", "owner", "modified_by"],
+				groups,
+			)
+		frappe.db.delete("Budget Operations", {"name": ("in", [p.name for p in placeholders])})
+		frappe.db.commit()
+		removed += len(placeholders)
+
+	if removed:
+		frappe.logger("adr_erp").info(f"Compacted {removed} placeholder Budget Operations")
+	return removed
+
+
+def compact_zero_movements(chunk_size=COMPACTION_CHUNK_SIZE):
+	"""
+	При разреженном хранении удаляет уже сохранённые нулевые Movement/Transfer
+	пачками по chunk_size с коммитом после каждой.
+	"""
+	if not is_sparse_movements_storage():
+		return 0
+
+	removed = 0
+	while names := frappe.db.sql_list(
+		"""
+		select name
+		from `tabMovements of Budget Operations`
+		where budget_balance_type in %(types)s and `sum` = 0
+		limit %(limit)s
+		""",
+		{"types": SPARSE_BALANCE_TYPES, "limit": chunk_size},
+	):
+		frappe.db.delete("Movements of Budget Operations", {"name": ("in", names)})
+		frappe.db.commit()
+		removed += len(names)
+
+	if removed:
+		frappe.logger("adr_erp").info(f"Compacted {removed} zero Movements of Budget Operations")
+	return removed
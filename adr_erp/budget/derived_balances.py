@@ -0,0 +1,309 @@
+from datetime import timedelta
+
+import frappe
+from frappe.utils import cint, flt, getdate, now
+
+# Хранимые по дням типы движений; Balance/Remaining при выводимом хранении считаются из них
+FLOW_TYPES = ("Movement", "Transfer")
+DERIVED_TYPES = ("Balance", "Remaining")
+
+
+def is_derived_balances():
+	"""
+	Выводимое хранение: по дням хранятся только Movement/Transfer, а Balance/Remaining
+	считаются при чтении нарастающим итогом от ближайшей контрольной точки.
+	"""
+	return bool(cint(frappe.db.get_single_value("Budget Settings", "derived_balances")))
+
+
+def get_rule_condition(alias, rules=None, organization=None):
+	"""
+	Условие отбора движений: по списку правил или по правилам организации (или все правила).
+	"""
+	if rules is not None:
+		return f"{alias}.organization_bank_rule in %(rules)s"
+	if organization:
+		return (
+			f"{alias}.organization_bank_rule in "
+			"(select name from `tabOrganization-Bank Rules` where organization = %(organization)s)"
+		)
+	return "1 = 1"
+
+
+def get_movements_source(from_date):
+	"""
+	Таблица движений для чтения с from_date: горячая, а если период задевает закрытые дни, —
+	вместе с архивом (движения закрытых дней, кроме последнего, перенесены туда).
+	"""
+	from .archive import ARCHIVE_TABLES, get_sealed_until
+
+	sealed_until = get_sealed_until()
+	if not sealed_until or getdate(from_date) > sealed_until:
+		return "`tabMovements of Budget Operations`"
+	archive_doctype = ARCHIVE_TABLES["Movements of Budget Operations"][0]
+	fields = "organization_bank_rule, `date`, budget_balance_type, `sum`"
+	return f"""(
+		select {fields} from `tabMovements of Budget Operations`
+		union all
+		select {fields} from `tab{archive_doctype}`
+	)"""
+
+
+def fetch_opening_remaining(before_date, rules=None, organization=None):
+	"""
+	Остаток на конец дня перед before_date, просуммированный по правилам:
+	последняя контрольная точка каждого правила до before_date плюс движения после неё.
+	"""
+	if rules is not None and not rules:
+		return 0.0
+
+	values = {"before_date": before_date, "rules": tuple(rules or ()), "organization": organization}
+	checkpoints = f"""
+		select c.organization_bank_rule, c.`date`, c.remaining
+		from `tabBudget Remaining Checkpoints` c
+		join (
+			select organization_bank_rule, max(`date`) as `date`
+			from `tabBudget Remaining Checkpoints` c
+			where c.`date` < %(before_date)s and {get_rule_condition("c", rules, organization)}
+			group by organization_bank_rule
+		) last on last.organization_bank_rule = c.organization_bank_rule and last.`date` = c.`date`
+	"""
+	return flt(
+		frappe.db.sql(
+			f"""
+			select
+				(select ifnull(sum(cp.remaining), 0) from ({checkpoints}) cp)
+				+ (
+					select ifnull(sum(m.`sum`), 0)
+					from {get_movements_source(getdate(before_date) - timedelta(days=1))} m
+					left join ({checkpoints}) cp on cp.organization_bank_rule = m.organization_bank_rule
+					where m.budget_balance_type in ('Movement', 'Transfer')
+						and m.`date` < %(before_date)s
+						and m.`date` > ifnull(cp.`date`, '0001-01-01')
+						and {get_rule_condition("m", rules, organization)}
+				)
+			""",
+			values,
+		)[0][0]
+	)
+
+
+def fetch_daily_balances(start_date, end_date, rules=None, organization=None):
+	"""
+	Возвращает Balance/Movement/Transfer/Remaining за каждый день периода, просуммированные
+	по правилам: {date: {budget_balance_type: сумма}}.
+
+	Remaining — остаток на начало периода плюс нарастающий итог движений
+	(SUM() OVER (ORDER BY date)), Balance — Remaining за вычетом движений дня.
+	"""
+	start_date, end_date = getdate(start_date), getdate(end_date)
+	opening = fetch_opening_remaining(start_date, rules, organization)
+
+	flows = {}
+	if rules is None or rules:
+		for row in frappe.db.sql(
+			f"""
+			select m.`date`,
+				sum(case when m.budget_balance_type = 'Movement' then m.`sum` else 0 end) as movement,
+				sum(case when m.budget_balance_type = 'Transfer' then m.`sum` else 0 end) as transfer,
+				sum(sum(m.`sum`)) over (order by m.`date`) as running
+			from {get_movements_source(start_date)} m
+			where m.budget_balance_type in ('Movement', 'Transfer')
+				and m.`date` between %(start_date)s and %(end_date)s
+				and {get_rule_condition("m", rules, organization)}
+			group by m.`date`
+			""",
+			{
+				"start_date": start_date,
+				"end_date": end_date,
+				"rules": tuple(rules or ()),
+				"organization": organization,
+			},
+			as_dict=True,
+		):
+			flows[row.date] = row
+
+	result = {}
+	running = 0.0
+	day = start_date
+	while day <= end_date:
+		row = flows.get(day)
+		movement = flt(row.movement) if row else 0.0
+		transfer = flt(row.transfer) if row else 0.0
+		if row:
+			running = flt(row.running)
+		remaining = opening + running
+		result[day] = {
+			"Balance": remaining - movement - transfer,
+			"Movement": movement,
+			"Transfer": transfer,
+			"Remaining": remaining,
+		}
+		day += timedelta(days=1)
+	return result
+
+
+def shift_remaining_checkpoints(organization_bank_rule_name, from_date, delta):
+	"""
+	Движение дня from_date изменилось на delta: сдвигает контрольные точки с этого дня.
+	Остальные дни при выводимом хранении не трогаются.
+	"""
+	if not flt(delta, 2):
+		return
+	frappe.db.sql(
+		"""
+		update `tabBudget Remaining Checkpoints`
+		set remaining = remaining + %(delta)s
+		where organization_bank_rule = %(rule)s and `date` >= %(from_date)s
+		""",
+		{"delta": delta, "rule": organization_bank_rule_name, "from_date": from_date},
+	)
+
+
+def rebuild_remaining_checkpoints(rules=None, locked=False):
+	"""
+	Пересобирает контрольные точки правил: остаток на последний день с движениями
+	каждого месяца, одним запросом с нарастающим итогом на правило.
+	Точки закрытого периода (до sealed_until включительно) не трогаются, итог считается от них.
+
+	Без locked каждое правило пересобирается под его блокировкой пересчёта, иначе
+	параллельное сохранение сдвинет точки, которые тут же перезапишутся старыми значениями.
+	Правила, которые сейчас пересчитываются, пропускаются до следующей пересборки.
+	"""
+	from .archive import fetch_sealed_remaining, get_sealed_until
+	from .recompute_lock import acquire_recompute_lock, release_recompute_lock, renew_recompute_locks
+
+	if rules is None:
+		rules = frappe.get_all("Organization-Bank Rules", pluck="name")
+
+	sealed_until = get_sealed_until()
+	sealed_remaining = fetch_sealed_remaining(rules)
+	for rule in rules:
+		if locked:
+			rebuild_rule_checkpoints(rule, sealed_until, flt(sealed_remaining.get(rule)))
+			continue
+
+		token = acquire_recompute_lock(rule)
+		if token is None:
+			continue
+		try:
+			rebuild_rule_checkpoints(
+				rule,
+				sealed_until,
+				flt(sealed_remaining.get(rule)),
+				heartbeat=lambda rule=rule, token=token: not renew_recompute_locks({rule: token}),
+			)
+			frappe.db.commit()
+		finally:
+			pending = release_recompute_lock(rule, token)
+		if pending:
+			from .budget_api import recompute_movements_range
+
+			recompute_movements_range(rule, *pending)
+
+
+def rebuild_rule_checkpoints(rule, sealed_until, opening, heartbeat=None):
+	"""
+	Контрольные точки одного правила после sealed_until от остатка opening.
+	heartbeat продлевает блокировку правила перед записью; если она потеряна,
+	прочитанный итог мог устареть и точки не перезаписываются.
+	"""
+	timestamp, user = now(), frappe.session.user
+	month_ends = {}
+	for row in frappe.db.sql(
+		"""
+		select `date`, sum(sum(`sum`)) over (order by `date`) as running
+		from `tabMovements of Budget Operations`
+		where organization_bank_rule = %(rule)s and budget_balance_type in ('Movement', 'Transfer')
+			and `date` > %(sealed_until)s
+		group by `date`
+		order by `date`
+		""",
+		{"rule": rule, "sealed_until": sealed_until or "0001-01-01"},
+		as_dict=True,
+	):
+		row.running = opening + flt(row.running)
+		month_ends[(row.date.year, row.date.month)] = row
+
+	if heartbeat and not heartbeat():
+		return
+
+	frappe.db.delete(
+		"Budget Remaining Checkpoints",
+		{"organization_bank_rule": rule, "date": (">", sealed_until or "0001-01-01")},
+	)
+	if month_ends:
+		frappe.db.bulk_insert(
+			"Budget Remaining Checkpoints",
+			[
+				"name",
+				"date",
+				"organization_bank_rule",
+				"remaining",
+				"creation",
+				"modified",
+				"owner",
+				"modified_by",
+			],
+			[
+				(
+					frappe.generate_hash(length=10),
+					row.date,
+					rule,
+					flt(row.running),
+					timestamp,
+					timestamp,
+					user,
+					user,
+				)
+				for row in month_ends.values()
+			],
+		)
+
+
+def drop_stored_derived_balances(chunk_size=5000):
+	"""
+	После перехода на выводимое хранение удаляет хранимые Balance/Remaining пачками.
+	"""
+	while names := frappe.db.sql_list(
+		"""
+		select name
+		from `tabMovements of Budget Operations`
+		where budget_balance_type in %(types)s
+		limit %(limit)s
+		""",
+		{"types": DERIVED_TYPES, "limit": chunk_size},
+	):
+		frappe.db.delete("Movements of Budget Operations", {"name": ("in", names)})
+		frappe.db.commit()
+
+
+def switch_to_derived_balances():
+	"""
+	Переход на выводимое хранение: контрольные точки строятся по уже сохранённым
+	Movement/Transfer, затем хранимые Balance/Remaining удаляются.
+	"""
+	rebuild_remaining_checkpoints()
+	drop_stored_derived_balances()
+
+
+def drop_open_remaining_checkpoints():
+	"""
+	После возврата к хранимым остаткам контрольные точки открытого периода больше
+	не сдвигаются и устаревают — удаляем их, точки закрытого периода остаются.
+	"""
+	from .archive import get_sealed_until
+
+	sealed_until = get_sealed_until()
+	frappe.db.delete(
+		"Budget Remaining Checkpoints",
+		{"date": (">", sealed_until)} if sealed_until else None,
+	)
+
+
+def refresh_remaining_checkpoints():
+	"""
+	Еженедельная пересборка контрольных точек при выводимом хранении.
+	"""
+	if is_derived_balances():
+		rebuild_remaining_checkpoints()
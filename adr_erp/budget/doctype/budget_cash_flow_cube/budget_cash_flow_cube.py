@@ -0,0 +1,15 @@
+# Copyright (c) 2026, GeorgyTaskabulov and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class BudgetCashFlowCube(Document):
+	# Сумма операций за месяц по организации, банку, статье и типу (План/Факт).
+	# Ведётся adr_erp.budget.cash_flow_cube, вручную не редактируется
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Budget Cash Flow Cube", ["month", "organization", "bank"])
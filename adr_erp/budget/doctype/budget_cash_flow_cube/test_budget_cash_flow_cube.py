@@ -0,0 +1,29 @@
+# Copyright (c) 2026, GeorgyTaskabulov and Contributors
+# See license.txt
+
+# import frappe
+from frappe.tests import IntegrationTestCase, UnitTestCase
+
+# On IntegrationTestCase, the doctype test records and all
+# link-field test record dependencies are recursively loaded
+# Use these module variables to add/remove to/from that list
+EXTRA_TEST_RECORD_DEPENDENCIES = []  # eg. ["User"]
+IGNORE_TEST_RECORD_DEPENDENCIES = []  # eg. ["User"]
+
+
+class UnitTestBudgetCashFlowCube(UnitTestCase):
+	"""
+	Unit tests for BudgetCashFlowCube.
+	Use this class for testing individual functions and methods.
+	"""
+
+	pass
+
+
+class IntegrationTestBudgetCashFlowCube(IntegrationTestCase):
+	"""
+	Integration tests for BudgetCashFlowCube.
+	Use this class for testing interactions between multiple components.
+	"""
+
+	pass
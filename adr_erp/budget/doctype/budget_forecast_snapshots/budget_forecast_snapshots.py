@@ -0,0 +1,15 @@
+# Copyright (c) 2026, GeorgyTaskabulov and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class BudgetForecastSnapshots(Document):
+	# Ежедневный снимок прогноза правила: полный (is_keyframe) или дельта к предыдущему.
+	# Ведётся adr_erp.budget.forecast_snapshots, вручную не редактируется
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Budget Forecast Snapshots", ["organization_bank_rule", "snapshot_date"])
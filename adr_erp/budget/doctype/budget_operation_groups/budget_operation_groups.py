@@ -0,0 +1,15 @@
+# Copyright (c) 2026, GeorgyTaskabulov and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class BudgetOperationGroups(Document):
+	# Пустая группа (date, type, group_index) правила: строка редактора без операций.
+	# Хранится, пока в группе нет ни одной операции этого типа.
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Budget Operation Groups", ["organization_bank_rule", "date"])
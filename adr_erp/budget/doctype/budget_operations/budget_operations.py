@@ -1,9 +1,16 @@
 # Copyright (c) 2025, GeorgyTaskabulov and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 
 class BudgetOperations(Document):
 	pass
+
+
+def on_doctype_update():
+	# Основной путь доступа редактора и пересчёта: правило → дата → тип
+	frappe.db.add_index("Budget Operations", ["organization_bank_rule", "date", "budget_operation_type"])
+	# Поиск транзитных платежей в адрес правила
+	frappe.db.add_index("Budget Operations", ["recipient_of_transit_payment", "date"])
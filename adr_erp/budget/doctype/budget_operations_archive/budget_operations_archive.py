@@ -0,0 +1,14 @@
+# Copyright (c) 2026, GeorgyTaskabulov and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class BudgetOperationsArchive(Document):
+	# Строки закрытого периода, перенесённые из Budget Operations
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Budget Operations Archive", ["organization_bank_rule", "date"])
@@ -0,0 +1,8 @@
+// Copyright (c) 2026, GeorgyTaskabulov and contributors
+// For license information, please see license.txt
+
+// frappe.ui.form.on("Budget Remaining Checkpoints", {
+// 	refresh(frm) {
+
+// 	},
+// });
@@ -0,0 +1,14 @@
+# Copyright (c) 2026, GeorgyTaskabulov and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class BudgetRemainingCheckpoints(Document):
+	# Остаток правила на конец дня: от него считаются Balance/Remaining при выводимом хранении
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Budget Remaining Checkpoints", ["organization_bank_rule", "date"])
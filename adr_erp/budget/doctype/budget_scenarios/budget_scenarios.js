@@ -0,0 +1,39 @@
+// Copyright (c) 2026, GeorgyTaskabulov and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on("Budget Scenarios", {
+	refresh(frm) {
+		if (frm.is_new()) return;
+		frm.add_custom_button(__("Show Balances"), () => {
+			frappe
+				.call("adr_erp.budget.scenarios.get_budget_scenario_balances", { scenario: frm.doc.name })
+				.then(({ message }) => {
+					const rows = Object.entries(message.rules).flatMap(([rule, days]) =>
+						days
+							.filter((day) => day.remainingDelta)
+							.map(
+								(day) =>
+									`<tr><td>${frappe.utils.escape_html(rule)}</td><td>${frappe.datetime.str_to_user(
+										day.date
+									)}</td><td>${format_currency(day.live.Remaining)}</td><td>${format_currency(
+										day.scenario.Remaining
+									)}</td><td>${format_currency(day.remainingDelta)}</td></tr>`
+							)
+					);
+					frappe.msgprint({
+						title: __("Remaining by Scenario"),
+						message: rows.length
+							? `<table class="table table-bordered"><thead><tr><th>${__(
+									"Organization-Bank Rule"
+							  )}</th><th>${__("Date")}</th><th>${__("Live")}</th><th>${__(
+									"Scenario"
+							  )}</th><th>${__("Difference")}</th></tr></thead><tbody>${rows.join(
+									""
+							  )}</tbody></table>`
+							: __("The scenario does not change Remaining"),
+						wide: true,
+					});
+				});
+		});
+	},
+});
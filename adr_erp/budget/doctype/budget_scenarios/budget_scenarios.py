@@ -0,0 +1,15 @@
+# Copyright (c) 2026, GeorgyTaskabulov and contributors
+# For license information, please see license.txt
+
+# import frappe
+from frappe.model.document import Document
+
+from adr_erp.budget.scenarios import validate_scenario_change
+
+
+class BudgetScenarios(Document):
+	# Сценарий «что если»: правки поверх живых Budget Operations, считаются только в памяти
+
+	def validate(self):
+		for change in self.changes:
+			validate_scenario_change(change)
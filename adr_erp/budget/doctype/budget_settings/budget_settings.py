@@ -0,0 +1,39 @@
+# Copyright (c) 2026, GeorgyTaskabulov and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+from adr_erp.budget.derived_balances import drop_open_remaining_checkpoints
+
+
+class BudgetSettings(Document):
+	def on_update(self):
+		# Ежедневный сдвиг досчитывает только один новый день — при смене горизонта нужен полный пересчёт
+		if self.has_value_changed("horizon_days"):
+			frappe.enqueue(
+				"adr_erp.tasks.prepare_budget_movement_data",
+				queue="long",
+				timeout=3600,
+				enqueue_after_commit=True,
+			)
+		if self.has_value_changed("derived_balances"):
+			if not self.derived_balances:
+				drop_open_remaining_checkpoints()
+			# Включение — строим контрольные точки и удаляем хранимые остатки,
+			# выключение — остатки снова нужно посчитать и сохранить по всем дням
+			frappe.enqueue(
+				"adr_erp.budget.derived_balances.switch_to_derived_balances"
+				if self.derived_balances
+				else "adr_erp.tasks.prepare_budget_movement_data",
+				queue="long",
+				timeout=6 * 60 * 60,
+				enqueue_after_commit=True,
+			)
+		if self.has_value_changed("sparse_movements_storage") and self.sparse_movements_storage:
+			frappe.enqueue(
+				"adr_erp.budget.compaction.compact_zero_movements",
+				queue="long",
+				timeout=6 * 60 * 60,
+				enqueue_after_commit=True,
+			)
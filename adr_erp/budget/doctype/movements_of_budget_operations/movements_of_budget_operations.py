@@ -1,9 +1,16 @@
 # Copyright (c) 2025, GeorgyTaskabulov and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 
 class MovementsofBudgetOperations(Document):
 	pass
+
+
+def on_doctype_update():
+	# Основной путь доступа редактора и пересчёта: правило → дата → тип
+	frappe.db.add_index(
+		"Movements of Budget Operations", ["organization_bank_rule", "date", "budget_balance_type"]
+	)
@@ -0,0 +1,8 @@
+// Copyright (c) 2026, GeorgyTaskabulov and contributors
+// For license information, please see license.txt
+
+// frappe.ui.form.on("Recurring Budget Operations", {
+// 	refresh(frm) {
+
+// 	},
+// });
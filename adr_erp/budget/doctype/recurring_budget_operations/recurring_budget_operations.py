@@ -0,0 +1,46 @@
+# Copyright (c) 2026, GeorgyTaskabulov and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+from frappe.utils import getdate
+
+from adr_erp.budget.ledger import get_today_msk
+
+
+class RecurringBudgetOperations(Document):
+	# Повторяющаяся операция План: в пересчёте и редакторе разворачивается виртуально,
+	# сохраняется только правленое повторение (см. adr_erp.budget.recurring_operations)
+
+	def validate(self):
+		if self.end_date and getdate(self.end_date) < getdate(self.start_date):
+			frappe.throw(_("End Date cannot be before Start Date"))
+
+	def on_update(self):
+		self.enqueue_recompute()
+
+	def on_trash(self):
+		self.enqueue_recompute()
+
+	def enqueue_recompute(self):
+		"""
+		Пересчитывает движения правила и получателя транзита (в том числе прежних)
+		с первого затронутого дня, но не раньше сегодня: прошлые дни считаются по Факту.
+		"""
+		before = self.get_doc_before_save()
+		docs = [self, before] if before else [self]
+		from_date = max(min(getdate(doc.start_date) for doc in docs), get_today_msk())
+
+		rules = {
+			rule for doc in docs for rule in (doc.organization_bank_rule, doc.recipient_of_transit_payment)
+		}
+		for rule in sorted(filter(None, rules)):
+			frappe.enqueue(
+				"adr_erp.tasks.prepare_budget_movement_data",
+				queue="long",
+				timeout=3600,
+				enqueue_after_commit=True,
+				rule=rule,
+				target_date=from_date,
+			)
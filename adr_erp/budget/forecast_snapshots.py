@@ -0,0 +1,360 @@
+import base64
+import json
+import zlib
+from datetime import timedelta
+
+import frappe
+from frappe.utils import flt, getdate, now
+
+from .derived_balances import fetch_daily_balances, is_derived_balances
+from .recurring_operations import expand_recurring_operations
+
+SNAPSHOT_DOCTYPE = "Budget Forecast Snapshots"
+FORECAST_SNAPSHOT_CACHE_KEY = "adr_erp:forecast_snapshot"
+FORECAST_SNAPSHOT_CACHE_TTL = 24 * 60 * 60
+# Через сколько дельт пишется полный снимок: ограничивает цепочку при восстановлении
+FORECAST_KEYFRAME_INTERVAL = 30
+
+
+def empty_forecast_state():
+	# plan: {(date, expense_item): сумма План}, flows: {date: Movement + Transfer},
+	# opening: Remaining на конец дня перед start, Remaining дней [start, end] выводится из flows
+	return {"plan": {}, "flows": {}, "opening": 0.0, "start": None, "end": None}
+
+
+def fetch_forecast_state(organization_bank_rule_name, start_date, end_date):
+	"""
+	Текущий прогноз правила на горизонте: суммы План по дням и статьям (с повторяющимися
+	операциями), потоки по дням и остаток на начало горизонта.
+	"""
+	state = empty_forecast_state()
+	state["start"], state["end"] = str(start_date), str(end_date)
+	for day, expense_item, value in frappe.db.sql(
+		"""
+		select `date`, expense_item, sum(`sum`)
+		from `tabBudget Operations`
+		where organization_bank_rule = %(rule)s and budget_operation_type = 'План'
+			and `date` between %(start_date)s and %(end_date)s and ifnull(expense_item, '') != ''
+		group by `date`, expense_item
+		""",
+		{"rule": organization_bank_rule_name, "start_date": start_date, "end_date": end_date},
+	):
+		state["plan"][(str(day), expense_item)] = flt(value, 2)
+	for op in expand_recurring_operations([organization_bank_rule_name], start_date, end_date):
+		if op.organization_bank_rule == organization_bank_rule_name:
+			key = (str(op.date), op.expense_item)
+			state["plan"][key] = flt(state["plan"].get(key, 0) + op.sum, 2)
+
+	if is_derived_balances():
+		balances = fetch_daily_balances(start_date, end_date, rules=[organization_bank_rule_name])
+		state["opening"] = flt(balances[start_date]["Balance"], 2)
+		flows = ((day, values["Movement"] + values["Transfer"]) for day, values in balances.items())
+	else:
+		state["opening"] = flt(
+			frappe.db.get_value(
+				"Movements of Budget Operations",
+				{
+					"organization_bank_rule": organization_bank_rule_name,
+					"date": start_date,
+					"budget_balance_type": "Balance",
+				},
+				"sum",
+			),
+			2,
+		)
+		flows = frappe.db.sql(
+			"""
+			select `date`, sum(`sum`)
+			from `tabMovements of Budget Operations`
+			where organization_bank_rule = %(rule)s and budget_balance_type in ('Movement', 'Transfer')
+				and `date` between %(start_date)s and %(end_date)s
+			group by `date`
+			""",
+			{"rule": organization_bank_rule_name, "start_date": start_date, "end_date": end_date},
+		)
+	for day, value in flows:
+		if flt(value, 2):
+			state["flows"][str(day)] = flt(value, 2)
+	return state
+
+
+def get_forecast_remaining(state):
+	"""
+	Remaining по дням горизонта снимка: остаток на начало плюс нарастающий итог потоков.
+	"""
+	remaining = {}
+	if not state["start"]:
+		return remaining
+	running, day, end_date = state["opening"], getdate(state["start"]), getdate(state["end"])
+	while day <= end_date:
+		running = flt(running + state["flows"].get(str(day), 0), 2)
+		remaining[str(day)] = running
+		day += timedelta(days=1)
+	return remaining
+
+
+def encode_forecast_blob(state, removed_plan=(), removed_flows=()):
+	"""
+	Сжатый колоночный блоб: даты и статьи хранятся словарями один раз,
+	ячейки — параллельными массивами индексов и значений. Остаток на начало
+	и границы горизонта — по одному числу на снимок.
+	"""
+	dates, items = {}, {}
+
+	def date_idx(day):
+		return dates.setdefault(day, len(dates))
+
+	def item_idx(item):
+		return items.setdefault(item, len(items))
+
+	plan = sorted(state["plan"].items())
+	flows = sorted(state["flows"].items())
+	removed_plan, removed_flows = sorted(removed_plan), sorted(removed_flows)
+	payload = {
+		"opening": state["opening"],
+		"start": state["start"],
+		"end": state["end"],
+		"plan": {
+			"date": [date_idx(day) for (day, _item), _value in plan],
+			"item": [item_idx(item) for (_day, item), _value in plan],
+			"value": [value for _key, value in plan],
+		},
+		"flows": {
+			"date": [date_idx(day) for day, _value in flows],
+			"value": [value for _day, value in flows],
+		},
+		"removedPlan": {
+			"date": [date_idx(day) for day, _item in removed_plan],
+			"item": [item_idx(item) for _day, item in removed_plan],
+		},
+		"removedFlows": {"date": [date_idx(day) for day in removed_flows]},
+	}
+	payload["dates"], payload["items"] = list(dates), list(items)
+	raw = json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode()
+	return base64.b64encode(zlib.compress(raw, 9)).decode()
+
+
+def decode_forecast_blob(data):
+	payload = json.loads(zlib.decompress(base64.b64decode(data)))
+	dates, items = payload["dates"], payload["items"]
+	plan, flows, removed_flows = payload["plan"], payload["flows"], payload["removedFlows"]
+	removed_plan = payload["removedPlan"]
+	return (
+		{
+			"plan": {
+				(dates[d], items[i]): value
+				for d, i, value in zip(plan["date"], plan["item"], plan["value"], strict=True)
+			},
+			"flows": {dates[d]: value for d, value in zip(flows["date"], flows["value"], strict=True)},
+			"opening": payload["opening"],
+			"start": payload["start"],
+			"end": payload["end"],
+		},
+		[(dates[d], items[i]) for d, i in zip(removed_plan["date"], removed_plan["item"], strict=True)],
+		[dates[d] for d in removed_flows["date"]],
+	)
+
+
+def apply_forecast_blob(state, data, is_keyframe):
+	decoded, removed_plan, removed_flows = decode_forecast_blob(data)
+	if is_keyframe:
+		return decoded
+	for key in removed_plan:
+		state["plan"].pop(key, None)
+	for day in removed_flows:
+		state["flows"].pop(day, None)
+	state["plan"].update(decoded["plan"])
+	state["flows"].update(decoded["flows"])
+	state["opening"], state["start"], state["end"] = decoded["opening"], decoded["start"], decoded["end"]
+	return state
+
+
+def diff_forecast_section(old, new):
+	changed = {key: value for key, value in new.items() if old.get(key) != value}
+	removed = [key for key in old if key not in new]
+	return changed, removed
+
+
+def get_snapshot_cache_key(organization_bank_rule_name, snapshot_date):
+	return f"{FORECAST_SNAPSHOT_CACHE_KEY}:{organization_bank_rule_name}:{snapshot_date}"
+
+
+def get_last_keyframe_date(organization_bank_rule_name, before_date):
+	return frappe.db.get_value(
+		SNAPSHOT_DOCTYPE,
+		{
+			"organization_bank_rule": organization_bank_rule_name,
+			"is_keyframe": 1,
+			"snapshot_date": ("<=", before_date),
+		},
+		"snapshot_date",
+		order_by="snapshot_date desc",
+	)
+
+
+def get_forecast_state(organization_bank_rule_name, as_of_date):
+	"""
+	Восстанавливает прогноз правила на дату as_of_date: последний полный снимок
+	не позже неё и дельты после него. Возвращает (дата снимка, состояние) или (None, None).
+	"""
+	as_of_date = getdate(as_of_date)
+	keyframe_date = get_last_keyframe_date(organization_bank_rule_name, as_of_date)
+	if not keyframe_date:
+		return None, None
+
+	snapshots = frappe.get_all(
+		SNAPSHOT_DOCTYPE,
+		filters=[
+			["organization_bank_rule", "=", organization_bank_rule_name],
+			["snapshot_date", ">=", keyframe_date],
+			["snapshot_date", "<=", as_of_date],
+		],
+		fields=["snapshot_date", "is_keyframe", "data"],
+		order_by="snapshot_date",
+	)
+	snapshot_date = snapshots[-1].snapshot_date
+	# Снимки неизменяемы: восстановленное состояние можно кешировать по дате
+	cache_key = get_snapshot_cache_key(organization_bank_rule_name, snapshot_date)
+	cached = frappe.cache.get_value(cache_key)
+	if cached is not None:
+		return snapshot_date, cached
+
+	state = empty_forecast_state()
+	for snapshot in snapshots:
+		state = apply_forecast_blob(state, snapshot.data, snapshot.is_keyframe)
+	frappe.cache.set_value(cache_key, state, expires_in_sec=FORECAST_SNAPSHOT_CACHE_TTL)
+	return snapshot_date, state
+
+
+def take_forecast_snapshot(organization_bank_rule_name, snapshot_date, horizon_end):
+	"""
+	Снимает прогноз правила на горизонте [snapshot_date, horizon_end]. Пишется дельта
+	к предыдущему снимку, а каждый FORECAST_KEYFRAME_INTERVAL-й снимок — полностью.
+	"""
+	snapshot_date = getdate(snapshot_date)
+	current = fetch_forecast_state(organization_bank_rule_name, snapshot_date, horizon_end)
+
+	# Повторный запуск за день заменяет снимок этого дня
+	frappe.db.delete(
+		SNAPSHOT_DOCTYPE,
+		{"organization_bank_rule": organization_bank_rule_name, "snapshot_date": snapshot_date},
+	)
+	frappe.cache.delete_value(get_snapshot_cache_key(organization_bank_rule_name, snapshot_date))
+
+	previous_date, previous = get_forecast_state(
+		organization_bank_rule_name, snapshot_date - timedelta(days=1)
+	)
+	chain_length = (
+		frappe.db.count(
+			SNAPSHOT_DOCTYPE,
+			{
+				"organization_bank_rule": organization_bank_rule_name,
+				"is_keyframe": 0,
+				"snapshot_date": (">", get_last_keyframe_date(organization_bank_rule_name, previous_date)),
+			},
+		)
+		if previous is not None
+		else 0
+	)
+
+	is_keyframe = previous is None or chain_length + 1 >= FORECAST_KEYFRAME_INTERVAL
+	if is_keyframe:
+		data = encode_forecast_blob(current)
+		changes_count = len(current["plan"]) + len(current["flows"])
+	else:
+		# Дельта растёт с числом изменённых ячеек, а не с длиной горизонта:
+		# Remaining не хранится, сдвиг остатка — одно число opening
+		plan, removed_plan = diff_forecast_section(previous["plan"], current["plan"])
+		flows, removed_flows = diff_forecast_section(previous["flows"], current["flows"])
+		data = encode_forecast_blob({**current, "plan": plan, "flows": flows}, removed_plan, removed_flows)
+		changes_count = len(plan) + len(removed_plan) + len(flows) + len(removed_flows)
+
+	timestamp, user = now(), frappe.session.user
+	frappe.db.bulk_insert(
+		SNAPSHOT_DOCTYPE,
+		[
+			"name",
+			"snapshot_date",
+			"organization_bank_rule",
+			"is_keyframe",
+			"changes_count",
+			"data",
+			"creation",
+			"modified",
+			"owner",
+			"modified_by",
+		],
+		[
+			(
+				frappe.generate_hash(length=10),
+				snapshot_date,
+				organization_bank_rule_name,
+				int(is_keyframe),
+				changes_count,
+				data,
+				timestamp,
+				timestamp,
+				user,
+				user,
+			)
+		],
+	)
+	frappe.cache.set_value(
+		get_snapshot_cache_key(organization_bank_rule_name, snapshot_date),
+		current,
+		expires_in_sec=FORECAST_SNAPSHOT_CACHE_TTL,
+	)
+
+
+def format_forecast_state(state):
+	return {
+		"plan": [
+			{"date": day, "expense_item": item, "sum": value}
+			for (day, item), value in sorted(state["plan"].items())
+		],
+		"remaining": [
+			{"date": day, "sum": value} for day, value in sorted(get_forecast_remaining(state).items())
+		],
+	}
+
+
+@frappe.whitelist(methods=["GET"])
+def get_forecast_snapshot(organization_bank_rule_name, as_of_date):
+	"""
+	Прогноз правила, каким он был на дату as_of_date.
+	"""
+	frappe.has_permission("Budget Operations", "read", throw=True)
+	snapshot_date, state = get_forecast_state(organization_bank_rule_name, as_of_date)
+	if state is None:
+		return None
+	return {"snapshotDate": snapshot_date, **format_forecast_state(state)}
+
+
+@frappe.whitelist(methods=["GET"])
+def diff_forecast_snapshots(organization_bank_rule_name, from_date, to_date):
+	"""
+	Сравнивает прогнозы правила на две даты: только изменившиеся ячейки
+	со старым и новым значением (None — ячейки не было).
+	"""
+	frappe.has_permission("Budget Operations", "read", throw=True)
+	_old_date, old = get_forecast_state(organization_bank_rule_name, from_date)
+	_new_date, new = get_forecast_state(organization_bank_rule_name, to_date)
+	old, new = old or empty_forecast_state(), new or empty_forecast_state()
+
+	plan = [
+		{
+			"date": day,
+			"expense_item": item,
+			"old": old["plan"].get((day, item)),
+			"new": new["plan"].get((day, item)),
+		}
+		for day, item in sorted(old["plan"].keys() | new["plan"].keys())
+		if old["plan"].get((day, item)) != new["plan"].get((day, item))
+	]
+	old_remaining, new_remaining = get_forecast_remaining(old), get_forecast_remaining(new)
+	remaining = [
+		{"date": day, "old": old_remaining.get(day), "new": new_remaining.get(day)}
+		for day in sorted(old_remaining.keys() | new_remaining.keys())
+		if old_remaining.get(day) != new_remaining.get(day)
+	]
+	return {"plan": plan, "remaining": remaining}
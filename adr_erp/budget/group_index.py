@@ -0,0 +1,79 @@
+import frappe
+from frappe.utils import cint, getdate
+
+from .recurring_operations import RECURRING_GROUP_INDEX_BASE
+
+GROUP_INDEX_CACHE_KEY = "adr_erp:group_index"
+# Счётчик живёт сутки после последнего резервирования, затем снова берётся из БД
+GROUP_INDEX_TTL = 24 * 60 * 60
+
+
+# KEYS[1] — счётчик; ARGV: индекс, ttl. Поднимает счётчик до индекса, если он меньше.
+CLAIM_GROUP_INDEX_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '-1')
+if tonumber(ARGV[1]) > current then
+	redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+	return tonumber(ARGV[1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return current
+"""
+
+
+def get_max_group_index(organization_bank_rule_name, target_date):
+	# Группы повторяющихся операций имеют свой диапазон индексов и счётчик не сдвигают
+	return frappe.db.sql(
+		"""
+		select max(group_index) from (
+			select max(group_index) as group_index from `tabBudget Operations`
+			where organization_bank_rule = %(rule)s and `date` = %(date)s and group_index < %(base)s
+			union all
+			select max(group_index) from `tabBudget Operation Groups`
+			where organization_bank_rule = %(rule)s and `date` = %(date)s and group_index < %(base)s
+		) t
+		""",
+		{"rule": organization_bank_rule_name, "date": target_date, "base": RECURRING_GROUP_INDEX_BASE},
+	)[0][0]
+
+
+def reserve_group_indices(organization_bank_rule_name, target_date, count=1):
+	"""
+	Атомарно резервирует count последовательных group_index для (rule, date)
+	и возвращает первый из них.
+
+	Счётчик хранится в Redis (последний выданный индекс) и при отсутствии
+	инициализируется максимальным group_index из БД, поэтому два редактора,
+	добавляющие строки в один день, никогда не получат одинаковый индекс.
+	"""
+	key = get_group_index_counter(organization_bank_rule_name, target_date)
+	last = frappe.cache.incrby(key, count)
+	frappe.cache.expire(key, GROUP_INDEX_TTL)
+	return last - count + 1
+
+
+def claim_group_index(organization_bank_rule_name, target_date, group_index):
+	"""
+	Отмечает group_index, выбранный в обход reserve_group_indices (группа 0 первого дня,
+	индекс из файла импорта): счётчик поднимается до него, чтобы следующие
+	резервирования этот индекс не выдали.
+	"""
+	if group_index is None or cint(group_index) >= RECURRING_GROUP_INDEX_BASE:
+		return
+	key = get_group_index_counter(organization_bank_rule_name, target_date)
+	frappe.cache.register_script(CLAIM_GROUP_INDEX_SCRIPT)(
+		keys=[key], args=[cint(group_index), GROUP_INDEX_TTL]
+	)
+
+
+def get_group_index_counter(organization_bank_rule_name, target_date):
+	"""
+	Ключ счётчика (rule, date); при отсутствии он инициализируется максимальным group_index из БД.
+	"""
+	target_date = getdate(target_date)
+	key = frappe.cache.make_key(f"{GROUP_INDEX_CACHE_KEY}:{organization_bank_rule_name}:{target_date}")
+
+	if not frappe.cache.exists(key):
+		seed = get_max_group_index(organization_bank_rule_name, target_date)
+		# nx: если счётчик успел создать другой процесс, его значение не перетираем
+		frappe.cache.set(key, -1 if seed is None else seed, ex=GROUP_INDEX_TTL, nx=True)
+	return key
@@ -0,0 +1,121 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import frappe
+import pytz
+from frappe import _
+from frappe.utils import flt
+
+BALANCE_TYPES = ("Balance", "Movement", "Transfer", "Remaining")
+
+
+def get_today_msk():
+	return datetime.now(pytz.timezone("Europe/Moscow")).date()
+
+
+def fetch_ledger_operations(rules, start_date=None, end_date=None):
+	"""
+	Одним запросом получает все операции с ненулевой суммой, которые влияют на движения
+	правил rules: собственные операции правил и транзитные платежи в их адрес.
+	rules=None — операции всех правил. Повторяющиеся операции добавляются виртуально.
+	"""
+	from .recurring_operations import expand_recurring_operations
+
+	conditions = ["o.`sum` > 0"]
+	if rules is not None:
+		if not rules:
+			return []
+		conditions.append(
+			"(o.organization_bank_rule in %(rules)s or o.recipient_of_transit_payment in %(rules)s)"
+		)
+	if start_date:
+		conditions.append("o.`date` >= %(start_date)s")
+	if end_date:
+		conditions.append("o.`date` <= %(end_date)s")
+
+	ops = frappe.db.sql(
+		f"""
+		select o.name, o.organization_bank_rule, o.`date`, o.budget_operation_type, o.`sum`,
+			ifnull(o.expense_item, '') as expense_item, o.group_index,
+			ifnull(o.recipient_of_transit_payment, '') as recipient_of_transit_payment,
+			e.entry_type
+		from `tabBudget Operations` o
+		left join `tabExpense Items` e on e.name = o.expense_item
+		where {" and ".join(conditions)}
+		""",
+		{"rules": tuple(rules or ()), "start_date": start_date, "end_date": end_date},
+		as_dict=True,
+	)
+	return ops + expand_recurring_operations(rules, start_date, end_date)
+
+
+def get_entry_sign(entry_type):
+	if entry_type in ["Debit", _("Debit")]:
+		return 1
+	if entry_type in ["Credit", _("Credit")]:
+		return -1
+	return 0
+
+
+def aggregate_daily_flows(ops, today):
+	"""
+	Сворачивает операции в дневные потоки по тем же правилам, что и
+	calculate_movement_type_* и calculate_transfer_type_*:
+	  — будущие дни считаются по План, прошедшие — по Факт;
+	  — сегодня внутри группы (expense_item, group_index) берётся Факт, если он есть, иначе План.
+
+	Возвращает (movements, transfers): {(rule, date): сумма}.
+	"""
+	# Группы за сегодня, в которых есть Факт
+	movement_fact_groups = set()
+	transfer_fact_groups = set()
+	for op in ops:
+		if op.date == today and op.budget_operation_type == "Факт":
+			group = (op.organization_bank_rule, op.expense_item, op.group_index)
+			movement_fact_groups.add(group)
+			transfer_fact_groups.add((*group, op.recipient_of_transit_payment))
+
+	movements, transfers = defaultdict(float), defaultdict(float)
+	for op in ops:
+		group = (op.organization_bank_rule, op.expense_item, op.group_index)
+		if op.date > today:
+			movement_type = transfer_type = "План"
+		elif op.date < today:
+			movement_type = transfer_type = "Факт"
+		else:
+			movement_type = "Факт" if group in movement_fact_groups else "План"
+			transfer_type = (
+				"Факт" if (*group, op.recipient_of_transit_payment) in transfer_fact_groups else "План"
+			)
+
+		if op.budget_operation_type == movement_type:
+			movements[(op.organization_bank_rule, op.date)] += get_entry_sign(op.entry_type) * op.sum
+		if op.recipient_of_transit_payment and op.budget_operation_type == transfer_type:
+			transfers[(op.recipient_of_transit_payment, op.date)] += op.sum
+
+	return movements, transfers
+
+
+def compute_rule_ledger(rule, start_date, end_date, movements, transfers, opening_remaining=0):
+	"""
+	Считает Balance/Movement/Transfer/Remaining правила по дням периода:
+	Balance — остаток предыдущего дня, Remaining = Balance + Movement + Transfer.
+
+	Возвращает {date: {budget_balance_type: сумма}}.
+	"""
+	result = {}
+	remaining = flt(opening_remaining)
+	day = start_date
+	while day <= end_date:
+		balance = remaining
+		movement = movements.get((rule, day), 0)
+		transfer = transfers.get((rule, day), 0)
+		remaining = balance + movement + transfer
+		result[day] = {
+			"Balance": balance,
+			"Movement": movement,
+			"Transfer": transfer,
+			"Remaining": remaining,
+		}
+		day += timedelta(days=1)
+	return result
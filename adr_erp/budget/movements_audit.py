@@ -0,0 +1,221 @@
+import json
+from datetime import timedelta
+from itertools import chain
+
+import frappe
+from frappe.utils import flt
+
+from .archive import fetch_sealed_remaining, get_sealed_until
+from .budget_api import (
+	bump_budget_data_version,
+	publish_budget_change,
+	recompute_movements_range,
+	save_movement_of_budget_operations,
+)
+from .derived_balances import FLOW_TYPES, is_derived_balances
+from .ledger import (
+	BALANCE_TYPES,
+	aggregate_daily_flows,
+	compute_rule_ledger,
+	fetch_ledger_operations,
+	get_today_msk,
+)
+from .recompute_lock import acquire_recompute_lock, release_recompute_lock, renew_recompute_locks
+
+AUDIT_BATCH_SIZE = 50
+MAX_REPORTED_DRIFTS = 500
+# Точность поля Currency
+DRIFT_TOLERANCE = 0.005
+
+
+def fetch_stored_movements(rules):
+	"""
+	Возвращает сохранённые движения правил: {rule: {date: {budget_balance_type: sum}}}.
+	"""
+	stored = {}
+	for row in frappe.db.sql(
+		"""
+		select organization_bank_rule, `date`, budget_balance_type, `sum`
+		from `tabMovements of Budget Operations`
+		where organization_bank_rule in %(rules)s
+		""",
+		{"rules": tuple(rules)},
+		as_dict=True,
+	):
+		stored.setdefault(row.organization_bank_rule, {}).setdefault(row.date, {})[
+			row.budget_balance_type
+		] = flt(row.sum)
+	return stored
+
+
+def get_first_flow_dates(movements, transfers):
+	"""
+	Возвращает первую дату с ненулевым потоком для каждого правила: {rule: date}.
+	"""
+	first_dates = {}
+	for rule, day in chain(movements, transfers):
+		if rule not in first_dates or day < first_dates[rule]:
+			first_dates[rule] = day
+	return first_dates
+
+
+def find_rule_drifts(rule, stored, movements, transfers, first_flow_date=None, sealed=None):
+	"""
+	Сравнивает сохранённые движения правила с пересчитанными в памяти за период
+	от первой операции/движения до последнего сохранённого дня.
+
+	sealed — (последний закрытый день, остаток на его конец): сверка начинается после него.
+	"""
+	opening_remaining = 0
+	if sealed:
+		sealed_until, opening_remaining = sealed
+		stored = {day: values for day, values in stored.items() if day > sealed_until}
+	if not stored:
+		return []
+	start_date = min(stored) if first_flow_date is None else min(min(stored), first_flow_date)
+	if sealed:
+		start_date = sealed_until + timedelta(days=1)
+	end_date = max(stored)
+
+	drifts = []
+	# При выводимом хранении Balance/Remaining не хранятся и не сверяются
+	balance_types = FLOW_TYPES if is_derived_balances() else BALANCE_TYPES
+	expected = compute_rule_ledger(rule, start_date, end_date, movements, transfers, opening_remaining)
+	for day, values in expected.items():
+		stored_day = stored.get(day, {})
+		for balance_type in balance_types:
+			expected_sum = flt(values[balance_type], 2)
+			stored_sum = stored_day.get(balance_type)
+			# Отсутствующая строка равнозначна нулю
+			if abs(flt(stored_sum) - expected_sum) > DRIFT_TOLERANCE:
+				drifts.append(
+					{
+						"organization_bank_rule": rule,
+						"date": day,
+						"budget_balance_type": balance_type,
+						"stored": stored_sum,
+						"expected": expected_sum,
+					}
+				)
+	return drifts
+
+
+def repair_rule_drifts(rule, today, sealed):
+	"""
+	Исправляет расхождения правила под его блокировкой пересчёта. Расхождения ищутся
+	заново уже под блокировкой: пересчёт, закончившийся после первой сверки, мог их убрать.
+	Возвращает исправленные расхождения или None, если правило сейчас пересчитывается —
+	идущий пересчёт сам перезапишет его движения.
+	"""
+	token = acquire_recompute_lock(rule)
+	if token is None:
+		return None
+	try:
+		movements, transfers = aggregate_daily_flows(fetch_ledger_operations([rule]), today)
+		drifts = find_rule_drifts(
+			rule,
+			fetch_stored_movements([rule]).get(rule, {}),
+			movements,
+			transfers,
+			get_first_flow_dates(movements, transfers).get(rule),
+			sealed,
+		)
+		# Пока сверяли, блокировка могла истечь — тогда правило мог пересчитать другой процесс
+		lock_lost = bool(renew_recompute_locks({rule: token}))
+		if not lock_lost:
+			for drift in drifts:
+				save_movement_of_budget_operations(
+					drift["date"], rule, drift["expected"], drift["budget_balance_type"]
+				)
+			frappe.db.commit()
+	finally:
+		pending = release_recompute_lock(rule, token)
+
+	if pending:
+		recompute_movements_range(rule, *pending)
+	return None if lock_lost else drifts
+
+
+def audit_rules(rules, repair=False):
+	"""
+	Проверяет движения правил пачками по AUDIT_BATCH_SIZE и, если repair,
+	перезаписывает только разошедшиеся строки. Правила, которые сейчас
+	пересчитываются, не исправляются.
+	"""
+	today = get_today_msk()
+	sealed_until = get_sealed_until()
+	all_drifts, repaired_rules, skipped_rules = [], set(), set()
+
+	for idx in range(0, len(rules), AUDIT_BATCH_SIZE):
+		batch = rules[idx : idx + AUDIT_BATCH_SIZE]
+		ops = fetch_ledger_operations(batch)
+		movements, transfers = aggregate_daily_flows(ops, today)
+		stored = fetch_stored_movements(batch)
+		first_dates = get_first_flow_dates(movements, transfers)
+		sealed_remaining = fetch_sealed_remaining(batch)
+
+		for rule in batch:
+			sealed = (sealed_until, flt(sealed_remaining.get(rule))) if sealed_until else None
+			drifts = find_rule_drifts(
+				rule,
+				stored.get(rule, {}),
+				movements,
+				transfers,
+				first_dates.get(rule),
+				sealed,
+			)
+			if repair and drifts:
+				repaired = repair_rule_drifts(rule, today, sealed)
+				if repaired is None:
+					skipped_rules.add(rule)
+				else:
+					drifts = repaired
+					if repaired:
+						repaired_rules.add(rule)
+			all_drifts.extend(drifts)
+
+	if skipped_rules:
+		frappe.logger("adr_erp").info(
+			f"Movements audit skipped {len(skipped_rules)} rules being recomputed: {sorted(skipped_rules)}"
+		)
+	if repaired_rules:
+		bump_budget_data_version()
+		for rule in repaired_rules:
+			publish_budget_change(rule)
+
+	return all_drifts
+
+
+@frappe.whitelist()
+def audit_movements(rules=None, repair=0):
+	"""
+	Сверяет Movements of Budget Operations с операциями и возвращает расхождения
+	по (rule, date, type). rules — список правил (по умолчанию все),
+	repair — исправить разошедшиеся строки.
+	"""
+	frappe.has_permission("Movements of Budget Operations", "write" if int(repair) else "read", throw=True)
+	if isinstance(rules, str):
+		rules = json.loads(rules)
+	if not rules:
+		rules = frappe.get_all("Organization-Bank Rules", pluck="name")
+
+	drifts = audit_rules(rules, repair=bool(int(repair)))
+	return {
+		"checkedRules": len(rules),
+		"driftCount": len(drifts),
+		"affectedRules": sorted({d["organization_bank_rule"] for d in drifts}),
+		"drifts": [{**d, "date": d["date"].strftime("%Y-%m-%d")} for d in drifts[:MAX_REPORTED_DRIFTS]],
+	}
+
+
+def audit_and_repair_movements():
+	"""
+	Ежедневная сверка движений всех правил с точечным исправлением расхождений.
+	"""
+	rules = frappe.get_all("Organization-Bank Rules", pluck="name")
+	drifts = audit_rules(rules, repair=True)
+	if drifts:
+		frappe.logger("adr_erp").info(
+			f"Movements audit repaired {len(drifts)} rows in "
+			f"{len({d['organization_bank_rule'] for d in drifts})} rules"
+		)
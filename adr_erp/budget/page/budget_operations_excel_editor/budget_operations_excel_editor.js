@@ -82,7 +82,7 @@ const PageContent = Class.extend({
 						: organization_bank_rules_select[0];
 
 				window.current_number_of_days_select =
-					savedDays && +savedDays >= 1 && +savedDays <= 99 ? savedDays : "7";
+					savedDays && +savedDays >= 1 && +savedDays <= 365 ? savedDays : "7";
 
 				this.page.set_indicator(__("Online"), "green");
 				this.page.add_field({
@@ -116,7 +116,7 @@ const PageContent = Class.extend({
 					},
 				});
 
-				const nums = Array.from({ length: 99 }, (_, i) => i + 1).join("\n");
+				const nums = Array.from({ length: 365 }, (_, i) => i + 1).join("\n");
 				this.page.add_field({
 					label: __("Select number of days"),
 					fieldtype: "Select",
@@ -138,6 +138,22 @@ const PageContent = Class.extend({
 					},
 				});
 
+				this.page.add_field({
+					label: __("Budget Scenario"),
+					fieldtype: "Link",
+					fieldname: "budget_scenario_select",
+					options: "Budget Scenarios",
+					change() {
+						// Со сценарием таблица показывает остатки «что если» и открыта только на чтение
+						window.current_budget_scenario = this.get_value() || null;
+						window.setup_excel_editor_table(
+							window.current_organization_bank_rules_select,
+							window.current_number_of_days_select,
+							true
+						);
+					},
+				});
+
 				// Функция загрузки комментария из БД
 				const loadComment = () => {
 					frappe.db
@@ -307,6 +323,123 @@ const PageContent = Class.extend({
 					});
 				});
 
+				// Кнопка выгрузки таблицы за произвольный период в XLSX/CSV
+				this.page.add_button(__("Export"), () => {
+					if (!window.current_organization_bank_rules_select) {
+						frappe.msgprint(__("No Organization Bank Rule selected."));
+						return;
+					}
+					const dialog = new frappe.ui.Dialog({
+						title: __("Export for: {0}", [
+							window.current_organization_bank_rules_select,
+						]),
+						fields: [
+							{
+								label: __("Date from"),
+								fieldname: "from_date",
+								fieldtype: "Date",
+								reqd: 1,
+								default: frappe.datetime.add_days(frappe.datetime.get_today(), -30),
+							},
+							{
+								label: __("Date to"),
+								fieldname: "to_date",
+								fieldtype: "Date",
+								reqd: 1,
+								default: frappe.datetime.add_days(frappe.datetime.get_today(), 30),
+							},
+							{
+								label: __("Format"),
+								fieldname: "file_format",
+								fieldtype: "Select",
+								options: "xlsx\ncsv",
+								default: "xlsx",
+							},
+						],
+						primary_action_label: __("Export"),
+						primary_action: (values) => {
+							const params = $.param({
+								organization_bank_rule_name:
+									window.current_organization_bank_rules_select,
+								...values,
+							});
+							window.open(
+								`/api/method/adr_erp.budget.budget_export.export_budget_data?${params}`
+							);
+							dialog.hide();
+						},
+					});
+					dialog.show();
+				});
+
+				// Кнопка импорта банковской выписки как операций Факт
+				this.page.add_button(__("Import bank statement"), () => {
+					if (!window.current_organization_bank_rules_select) {
+						frappe.msgprint(__("No Organization Bank Rule selected."));
+						return;
+					}
+					const dialog = new frappe.ui.Dialog({
+						title: __("Import bank statement for: {0}", [
+							window.current_organization_bank_rules_select,
+						]),
+						fields: [
+							{
+								label: __("Bank statement (CSV/XLSX)"),
+								fieldname: "file_url",
+								fieldtype: "Attach",
+								reqd: 1,
+							},
+						],
+						primary_action_label: __("Import"),
+						primary_action: (values) => {
+							frappe.call({
+								method: "adr_erp.budget.budget_import.import_bank_statement",
+								args: {
+									organization_bank_rule_name:
+										window.current_organization_bank_rules_select,
+									file_url: values.file_url,
+								},
+								callback: () => {
+									frappe.show_alert({
+										message: __("Import started"),
+										indicator: "blue",
+									});
+									dialog.hide();
+								},
+							});
+						},
+					});
+					dialog.show();
+				});
+
+				frappe.realtime.on("budget_import_progress", (msg) => {
+					this.page.set_indicator(__("Imported {0} rows", [msg.imported]), "blue");
+				});
+
+				frappe.realtime.on("budget_import_finished", (msg) => {
+					this.page.set_indicator(__("Online"), "green");
+					frappe.msgprint({
+						title: __("Import finished"),
+						message: [__("Imported {0} rows", [msg.imported]), ...msg.errors].join(
+							"<br>"
+						),
+						indicator: msg.errors.length ? "orange" : "green",
+					});
+				});
+
+				frappe.realtime.on("budget_rename_progress", (msg) => {
+					if (msg.done >= msg.total) {
+						frappe.hide_progress();
+						return;
+					}
+					frappe.show_progress(
+						__("Renaming Organization-Bank Rules"),
+						msg.done,
+						msg.total,
+						msg.rule
+					);
+				});
+
 				loadComment();
 			});
 
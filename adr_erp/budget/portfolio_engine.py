@@ -0,0 +1,309 @@
+from datetime import timedelta
+
+import frappe
+import numpy as np
+from frappe.utils import flt, now
+
+from .archive import clamp_to_open_period, fetch_sealed_remaining
+from .budget_api import (
+	SPARSE_BALANCE_TYPES,
+	bump_budget_data_version,
+	get_budget_horizon_end,
+	is_sparse_movements_storage,
+	publish_budget_change,
+	recompute_movements_range,
+)
+from .derived_balances import FLOW_TYPES, is_derived_balances, rebuild_remaining_checkpoints
+from .ledger import BALANCE_TYPES, fetch_ledger_operations, get_entry_sign, get_today_msk
+from .recompute_lock import acquire_recompute_lock, release_recompute_lock, renew_recompute_locks
+
+# Деньги в движке хранятся целыми копейками, чтобы суммы по всем дням были точными
+MINOR_UNITS = 100
+MOVEMENT_INSERT_FIELDS = (
+	"date",
+	"organization_bank_rule",
+	"budget_balance_type",
+	"sum",
+	"creation",
+	"modified",
+	"owner",
+	"modified_by",
+	"docstatus",
+	"idx",
+)
+WRITE_CHUNK_SIZE = 5000
+
+
+def to_minor_units(value):
+	return int(round(flt(value) * MINOR_UNITS))
+
+
+def build_portfolio_matrices(rules, ops, start_date, days, today, opening=None):
+	"""
+	Считает движения всех правил сразу матрицами правила × дни (в копейках).
+
+	Операции разрешаются так же, как в aggregate_daily_flows: будущие дни — План,
+	прошедшие — Факт, сегодня внутри группы Факт перекрывает План. Транзит применяется
+	как разреженная матрица «получатель × день» из троек (получатель, день, сумма).
+
+	opening — остатки правил на конец дня перед start_date (в копейках).
+
+	Возвращает {budget_balance_type: np.ndarray[len(rules), days]}.
+	"""
+	rule_index = {rule: idx for idx, rule in enumerate(rules)}
+	count = len(ops)
+
+	def column(values, dtype):
+		return np.fromiter(values, dtype=dtype, count=count)
+
+	op_rule = column((rule_index.get(op.organization_bank_rule, -1) for op in ops), np.int64)
+	op_recipient = column((rule_index.get(op.recipient_of_transit_payment, -1) for op in ops), np.int64)
+	op_day = column(((op.date - start_date).days for op in ops), np.int64)
+	op_amount = column((to_minor_units(op.sum) for op in ops), np.int64)
+	op_sign = column((get_entry_sign(op.entry_type) for op in ops), np.int64)
+	op_is_plan = column((op.budget_operation_type == "План" for op in ops), np.bool_)
+
+	# Группы за сегодня, в которых есть Факт: только сегодняшние операции, их немного
+	movement_fact_groups, transfer_fact_groups = set(), set()
+	for op in ops:
+		if op.date == today and op.budget_operation_type == "Факт":
+			group = (op.organization_bank_rule, op.expense_item, op.group_index)
+			movement_fact_groups.add(group)
+			transfer_fact_groups.add((*group, op.recipient_of_transit_payment))
+	in_movement_fact_group = column(
+		((op.organization_bank_rule, op.expense_item, op.group_index) in movement_fact_groups for op in ops),
+		np.bool_,
+	)
+	in_transfer_fact_group = column(
+		(
+			(op.organization_bank_rule, op.expense_item, op.group_index, op.recipient_of_transit_payment)
+			in transfer_fact_groups
+			for op in ops
+		),
+		np.bool_,
+	)
+
+	today_idx = (today - start_date).days
+	is_future, is_today = op_day > today_idx, op_day == today_idx
+	movement_mask = (op_is_plan == (is_future | (is_today & ~in_movement_fact_group))) & (op_rule >= 0)
+	transfer_mask = (op_is_plan == (is_future | (is_today & ~in_transfer_fact_group))) & (op_recipient >= 0)
+
+	movement = np.zeros((len(rules), days), dtype=np.int64)
+	np.add.at(
+		movement,
+		(op_rule[movement_mask], op_day[movement_mask]),
+		(op_sign * op_amount)[movement_mask],
+	)
+	transfer = np.zeros((len(rules), days), dtype=np.int64)
+	np.add.at(transfer, (op_recipient[transfer_mask], op_day[transfer_mask]), op_amount[transfer_mask])
+
+	remaining = np.cumsum(movement + transfer, axis=1)
+	if opening is not None:
+		remaining += opening[:, np.newaxis]
+	return {
+		"Balance": remaining - movement - transfer,
+		"Movement": movement,
+		"Transfer": transfer,
+		"Remaining": remaining,
+	}
+
+
+def load_stored_matrices(rules, start_date, days):
+	"""
+	Загружает сохранённые движения правил в те же матрицы:
+	{budget_balance_type: (sums, present, names)}.
+	"""
+	rule_index = {rule: idx for idx, rule in enumerate(rules)}
+	stored = {
+		balance_type: (
+			np.zeros((len(rules), days), dtype=np.int64),
+			np.zeros((len(rules), days), dtype=np.bool_),
+			{},
+		)
+		for balance_type in BALANCE_TYPES
+	}
+	for name, rule, day, balance_type, value in frappe.db.sql(
+		"""
+		select name, organization_bank_rule, `date`, budget_balance_type, `sum`
+		from `tabMovements of Budget Operations`
+		where organization_bank_rule in %(rules)s and `date` >= %(start_date)s
+		""",
+		{"rules": tuple(rules), "start_date": start_date},
+	):
+		day_idx = (day - start_date).days
+		if day_idx >= days or balance_type not in stored:
+			continue
+		sums, present, names = stored[balance_type]
+		r = rule_index[rule]
+		sums[r, day_idx] = to_minor_units(value)
+		present[r, day_idx] = True
+		names[(r, day_idx)] = name
+	return stored
+
+
+def write_portfolio_movements(rules, start_date, matrices, stored, heartbeat=None):
+	"""
+	Записывает только отличающиеся ячейки: новые — bulk insert, изменившиеся — bulk update,
+	ставшие нулевыми при разреженном хранении — удаление. heartbeat вызывается
+	перед каждой порцией записи.
+	"""
+	sparse = is_sparse_movements_storage()
+	balance_types = FLOW_TYPES if is_derived_balances() else BALANCE_TYPES
+	timestamp, user = now(), frappe.session.user
+
+	inserts, updates, deletes = [], {}, []
+	for balance_type in balance_types:
+		expected = matrices[balance_type]
+		sums, present, names = stored[balance_type]
+
+		removable = present & (expected == 0) if sparse and balance_type in SPARSE_BALANCE_TYPES else None
+		changed = present & (expected != sums)
+		if removable is not None:
+			changed &= ~removable
+			deletes.extend(names[(r, d)] for r, d in zip(*np.nonzero(removable), strict=True))
+
+		for r, d in zip(*np.nonzero(changed), strict=True):
+			updates[names[(r, d)]] = {"sum": expected[r, d] / MINOR_UNITS}
+		for r, d in zip(*np.nonzero(~present & (expected != 0)), strict=True):
+			inserts.append(
+				(
+					start_date + timedelta(days=int(d)),
+					rules[r],
+					balance_type,
+					expected[r, d] / MINOR_UNITS,
+					timestamp,
+					timestamp,
+					user,
+					user,
+					0,
+					0,
+				)
+			)
+
+	heartbeat = heartbeat or (lambda: None)
+	for idx in range(0, len(inserts), WRITE_CHUNK_SIZE):
+		heartbeat()
+		frappe.db.bulk_insert(
+			"Movements of Budget Operations",
+			MOVEMENT_INSERT_FIELDS,
+			inserts[idx : idx + WRITE_CHUNK_SIZE],
+			chunk_size=WRITE_CHUNK_SIZE,
+		)
+	update_names = list(updates)
+	for idx in range(0, len(update_names), WRITE_CHUNK_SIZE):
+		heartbeat()
+		frappe.db.bulk_update(
+			"Movements of Budget Operations",
+			{name: updates[name] for name in update_names[idx : idx + WRITE_CHUNK_SIZE]},
+			chunk_size=WRITE_CHUNK_SIZE,
+		)
+	for idx in range(0, len(deletes), WRITE_CHUNK_SIZE):
+		heartbeat()
+		frappe.db.delete(
+			"Movements of Budget Operations", {"name": ("in", deletes[idx : idx + WRITE_CHUNK_SIZE])}
+		)
+
+	return len(inserts) + len(updates) + len(deletes)
+
+
+def get_portfolio_date_bounds(rules):
+	"""
+	Первый и последний день портфеля: от самой ранней операции или движения
+	до конца горизонта (или последней даты, если она позже).
+	"""
+	first_date, last_date = frappe.db.sql(
+		"""
+		select min(`date`), max(`date`) from (
+			select `date` from `tabBudget Operations` where organization_bank_rule in %(rules)s
+			union all
+			select `date` from `tabMovements of Budget Operations` where organization_bank_rule in %(rules)s
+		) t
+		""",
+		{"rules": tuple(rules)},
+	)[0]
+	if first_date is None:
+		return None, None
+	# Закрытый период не пересчитывается
+	return clamp_to_open_period(first_date), max(last_date, get_budget_horizon_end())
+
+
+def rebuild_portfolio_movements():
+	"""
+	Полный пересчёт движений всех правил одним проходом: операции читаются один раз,
+	Balance/Remaining всех правил считаются нарастающими суммами по матрице.
+
+	Правила, которые сейчас пересчитываются другим процессом, пропускаются:
+	их текущий пересчёт расширяется до всего периода. Блокировки остальных правил
+	продлеваются по ходу работы; правило, чья блокировка всё же истекла, не пишется
+	из уже прочитанного снимка, а пересчитывается заново после снятия блокировок.
+	"""
+	all_rules = frappe.get_all("Organization-Bank Rules", pluck="name")
+	if not all_rules:
+		return
+	start_date, end_date = get_portfolio_date_bounds(all_rules)
+	if start_date is None:
+		return
+
+	tokens = {}
+	for rule in all_rules:
+		token = acquire_recompute_lock(rule)
+		if token:
+			tokens[rule] = token
+
+	lost_rules = set()
+
+	def heartbeat():
+		lost = renew_recompute_locks(tokens)
+		if lost - lost_rules:
+			frappe.logger("adr_erp").warning(
+				f"Portfolio rebuild lost recompute locks: {sorted(lost - lost_rules)}"
+			)
+		lost_rules.update(lost)
+		return lost
+
+	try:
+		busy_rules = [rule for rule in all_rules if rule not in tokens]
+		for rule in busy_rules:
+			recompute_movements_range(rule, start_date, end_date)
+			heartbeat()
+
+		rules = [rule for rule in tokens if rule not in lost_rules]
+		if rules:
+			days = (end_date - start_date).days + 1
+			# Операции всех правил: транзит связывает правила, поэтому читаем портфель целиком
+			ops = fetch_ledger_operations(None, start_date, end_date)
+			sealed_remaining = fetch_sealed_remaining(rules)
+			opening = np.fromiter(
+				(to_minor_units(sealed_remaining.get(rule)) for rule in rules),
+				dtype=np.int64,
+				count=len(rules),
+			)
+			matrices = build_portfolio_matrices(rules, ops, start_date, days, get_today_msk(), opening)
+
+			# Перед записью: правила без блокировки исключаются из матриц
+			heartbeat()
+			kept = [idx for idx, rule in enumerate(rules) if rule not in lost_rules]
+			rules = [rules[idx] for idx in kept]
+			matrices = {balance_type: matrix[kept] for balance_type, matrix in matrices.items()}
+			written = 0
+			if rules:
+				written = write_portfolio_movements(
+					rules, start_date, matrices, load_stored_matrices(rules, start_date, days), heartbeat
+				)
+				if is_derived_balances():
+					rebuild_remaining_checkpoints(rules, locked=True)
+			frappe.db.commit()
+			frappe.logger("adr_erp").info(
+				f"Portfolio rebuild: {len(rules)} rules, {days} days, {written} rows written"
+			)
+	finally:
+		pending = {rule: release_recompute_lock(rule, token) for rule, token in tokens.items()}
+
+	bump_budget_data_version()
+	for rule, pending_range in pending.items():
+		if rule in lost_rules:
+			recompute_movements_range(rule, start_date, end_date)
+		elif pending_range:
+			recompute_movements_range(rule, *pending_range)
+	for rule in all_rules:
+		publish_budget_change(rule)
@@ -0,0 +1,181 @@
+import frappe
+from frappe.utils import getdate
+
+RECOMPUTE_LOCK_CACHE_KEY = "adr_erp:recompute_lock"
+RECOMPUTE_PENDING_CACHE_KEY = "adr_erp:recompute_pending"
+# Блокировка продлевается на каждом посчитанном дне; если владелец умер,
+# она истекает сама и следующий запрос забирает накопленный диапазон.
+RECOMPUTE_LOCK_TTL_MS = 5 * 60 * 1000
+
+# KEYS[1] — pending; ARGV: start, end. Расширяет ожидающий диапазон.
+MERGE_PENDING_SCRIPT = """
+local start = redis.call('HGET', KEYS[1], 'start')
+if not start or ARGV[1] < start then redis.call('HSET', KEYS[1], 'start', ARGV[1]) end
+local finish = redis.call('HGET', KEYS[1], 'end')
+if not finish or ARGV[2] > finish then redis.call('HSET', KEYS[1], 'end', ARGV[2]) end
+return 1
+"""
+
+# KEYS[1] — pending. Забирает и удаляет ожидающий диапазон.
+POP_PENDING_SCRIPT = """
+local pending = redis.call('HMGET', KEYS[1], 'start', 'end')
+redis.call('DEL', KEYS[1])
+return pending
+"""
+
+# KEYS[1] — lock, KEYS[2] — pending; ARGV[1] — token.
+# Снимает блокировку, только если она наша и новых запросов не появилось.
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return -1 end
+if redis.call('EXISTS', KEYS[2]) == 1 then return 0 end
+redis.call('DEL', KEYS[1])
+return 1
+"""
+
+# KEYS[1] — lock; ARGV: token, ttl. Продлевает блокировку, если она всё ещё наша
+# (или истекла и никем не занята).
+HEARTBEAT_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] then return 0 end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 1
+"""
+
+# KEYS[1] — lock; ARGV: token, ttl. Продлевает блокировку, только если она всё ещё наша:
+# истёкшую не забираем — её владелец мог успеть записать свежие данные.
+RENEW_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# KEYS[1] — lock; ARGV[1] — token. Снимает блокировку, если она наша.
+DELETE_OWN_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+redis.call('DEL', KEYS[1])
+return 1
+"""
+
+
+def get_recompute_keys(organization_bank_rule_name):
+	return (
+		frappe.cache.make_key(f"{RECOMPUTE_LOCK_CACHE_KEY}:{organization_bank_rule_name}"),
+		frappe.cache.make_key(f"{RECOMPUTE_PENDING_CACHE_KEY}:{organization_bank_rule_name}"),
+	)
+
+
+def merge_pending_recompute(pending_key, start_date, end_date):
+	frappe.cache.register_script(MERGE_PENDING_SCRIPT)(
+		keys=[pending_key], args=[str(getdate(start_date)), str(getdate(end_date))]
+	)
+
+
+def pop_pending_recompute(pending_key):
+	start_date, end_date = (
+		frappe.safe_decode(value) if value is not None else None
+		for value in frappe.cache.register_script(POP_PENDING_SCRIPT)(keys=[pending_key])
+	)
+	if not start_date:
+		return None
+	return getdate(start_date), getdate(end_date)
+
+
+def run_single_flight_recompute(organization_bank_rule_name, start_date, end_date, recompute):
+	"""
+	Запускает recompute(start_date, end_date, heartbeat) так, чтобы по одному
+	правилу одновременно шёл только один пересчёт.
+
+	Запрос сначала расширяет ожидающий диапазон правила. Если пересчёт уже идёт в другом
+	процессе, тот заберёт диапазон после текущего прохода и функция вернёт False.
+	Иначе текущий процесс берёт блокировку и считает, пока ожидающие диапазоны не кончатся.
+	"""
+	lock_key, pending_key = get_recompute_keys(organization_bank_rule_name)
+	merge_pending_recompute(pending_key, start_date, end_date)
+
+	token = frappe.generate_hash(length=16)
+	if not frappe.cache.set(lock_key, token, px=RECOMPUTE_LOCK_TTL_MS, nx=True):
+		return False
+
+	heartbeat_script = frappe.cache.register_script(HEARTBEAT_SCRIPT)
+
+	def heartbeat():
+		return bool(heartbeat_script(keys=[lock_key], args=[token, RECOMPUTE_LOCK_TTL_MS]))
+
+	release_script = frappe.cache.register_script(RELEASE_LOCK_SCRIPT)
+	passes = 0
+	while True:
+		pending = pop_pending_recompute(pending_key)
+		if pending is None:
+			released = release_script(keys=[lock_key, pending_key], args=[token])
+			if released == 0:
+				# Пока снимали блокировку, пришёл новый запрос — считаем и его
+				continue
+			break
+
+		pending_start, pending_end = pending
+		try:
+			completed = recompute(pending_start, pending_end, heartbeat)
+			if completed:
+				# Фиксируем проход до следующего: под REPEATABLE READ следующий проход иначе
+				# читает снимок первого, а новый владелец блокировки — незафиксированные данные
+				frappe.db.commit()
+		except Exception:
+			# Диапазон возвращается в ожидающие, блокировка снимается сразу, а не по TTL
+			merge_pending_recompute(pending_key, pending_start, pending_end)
+			frappe.cache.register_script(DELETE_OWN_LOCK_SCRIPT)(keys=[lock_key], args=[token])
+			raise
+
+		if not completed:
+			# Блокировку забрал другой процесс (мы считали дольше TTL) — отдаём ему диапазон
+			merge_pending_recompute(pending_key, pending_start, pending_end)
+			frappe.logger("adr_erp").warning(
+				f"Recompute lock for {organization_bank_rule_name} was lost, range handed over"
+			)
+			return False
+
+		passes += 1
+		if passes > 1:
+			# Дополнительный проход выполнен за другие процессы — им уже некому сообщить
+			from .budget_api import publish_budget_change
+
+			publish_budget_change(organization_bank_rule_name)
+
+	return True
+
+
+def acquire_recompute_lock(organization_bank_rule_name):
+	"""
+	Берёт блокировку пересчёта правила для работы, которая не сводится к пересчёту
+	диапазона (например, ежедневный сдвиг горизонта). Возвращает токен или None,
+	если правило сейчас пересчитывается.
+	"""
+	lock_key, _pending_key = get_recompute_keys(organization_bank_rule_name)
+	token = frappe.generate_hash(length=16)
+	if frappe.cache.set(lock_key, token, px=RECOMPUTE_LOCK_TTL_MS, nx=True):
+		return token
+	return None
+
+
+def release_recompute_lock(organization_bank_rule_name, token):
+	"""
+	Снимает блокировку, взятую acquire_recompute_lock, и возвращает диапазон,
+	запрошенный другими процессами за это время (его нужно досчитать), или None.
+	"""
+	lock_key, pending_key = get_recompute_keys(organization_bank_rule_name)
+	frappe.cache.register_script(DELETE_OWN_LOCK_SCRIPT)(keys=[lock_key], args=[token])
+	return pop_pending_recompute(pending_key)
+
+
+def renew_recompute_locks(tokens):
+	"""
+	Продлевает блокировки {rule: token}, взятые acquire_recompute_lock, перед записью
+	долгой работы. Возвращает правила, чьи блокировки уже потеряны: их данные
+	писать нельзя — правило мог пересчитать другой процесс.
+	"""
+	renew_script = frappe.cache.register_script(RENEW_LOCK_SCRIPT)
+	lost = set()
+	for rule, token in tokens.items():
+		lock_key, _pending_key = get_recompute_keys(rule)
+		if not renew_script(keys=[lock_key], args=[token, RECOMPUTE_LOCK_TTL_MS]):
+			lost.add(rule)
+	return lost
@@ -0,0 +1,208 @@
+from datetime import timedelta
+
+import frappe
+from frappe.utils import add_months, cint, flt, getdate
+
+from .ledger import get_entry_sign
+
+RECURRING_DOCTYPE = "Recurring Budget Operations"
+# Группы повторяющихся операций не пересекаются с обычными: group_index = база + номер правила
+RECURRING_GROUP_INDEX_BASE = 10000
+FREQUENCY_DAYS = {"Daily": 1, "Weekly": 7}
+FREQUENCY_MONTHS = {"Monthly": 1, "Quarterly": 3, "Yearly": 12}
+
+
+def is_recurring_group_index(group_index):
+	return group_index is not None and cint(group_index) >= RECURRING_GROUP_INDEX_BASE
+
+
+def get_recurring_group_index(recurring_operation_name):
+	return RECURRING_GROUP_INDEX_BASE + cint(recurring_operation_name)
+
+
+def iter_occurrence_dates(definition, start_date, end_date):
+	"""
+	Даты повторения в пределах [start_date, end_date]. Месячные даты считаются от даты
+	начала (add_months), поэтому 31-е число не «сползает» после коротких месяцев.
+	"""
+	first = getdate(definition.start_date)
+	last = min(end_date, getdate(definition.end_date)) if definition.end_date else end_date
+	start_date = max(start_date, first) if start_date else first
+
+	if definition.frequency in FREQUENCY_DAYS:
+		step = FREQUENCY_DAYS[definition.frequency]
+		day = first + timedelta(days=-(-(start_date - first).days // step) * step)
+		while day <= last:
+			yield day
+			day += timedelta(days=step)
+		return
+
+	step = FREQUENCY_MONTHS[definition.frequency]
+	k = max(0, ((start_date.year - first.year) * 12 + start_date.month - first.month) // step - 1)
+	while (day := getdate(add_months(first, k * step))) <= last:
+		if day >= start_date:
+			yield day
+		k += 1
+
+
+def fetch_recurring_definitions(rules, start_date=None, end_date=None, name=None):
+	"""
+	Действующие повторяющиеся операции, которые касаются правил rules
+	(собственные и транзитные в их адрес) и пересекаются с периодом.
+	"""
+	conditions = ["r.enabled = 1"]
+	if rules is not None:
+		if not rules:
+			return []
+		conditions.append(
+			"(r.organization_bank_rule in %(rules)s or r.recipient_of_transit_payment in %(rules)s)"
+		)
+	if start_date:
+		conditions.append("(r.end_date is null or r.end_date >= %(start_date)s)")
+	if end_date:
+		conditions.append("r.start_date <= %(end_date)s")
+	if name is not None:
+		conditions.append("r.name = %(name)s")
+
+	return frappe.db.sql(
+		f"""
+		select r.name, r.organization_bank_rule, r.expense_item, r.`sum`, r.frequency,
+			r.start_date, r.end_date,
+			ifnull(r.recipient_of_transit_payment, '') as recipient_of_transit_payment,
+			ifnull(r.external_recipient, '') as external_recipient,
+			ifnull(r.description, '') as description,
+			e.entry_type
+		from `tabRecurring Budget Operations` r
+		left join `tabExpense Items` e on e.name = r.expense_item
+		where {" and ".join(conditions)}
+		""",
+		{
+			"rules": tuple(rules or ()),
+			"start_date": start_date,
+			"end_date": end_date,
+			"name": name,
+		},
+		as_dict=True,
+	)
+
+
+def fetch_materialized_slots(rules, start_date, end_date):
+	"""
+	Слоты (rule, date, group_index) повторяющихся операций, у которых уже есть сохранённые
+	строки или пустые группы: такие повторения больше не разворачиваются виртуально.
+	"""
+	values = {
+		"rules": tuple(rules),
+		"start_date": start_date,
+		"end_date": end_date,
+		"base": RECURRING_GROUP_INDEX_BASE,
+	}
+	conditions = """
+		organization_bank_rule in %(rules)s and group_index >= %(base)s
+		and `date` between %(start_date)s and %(end_date)s
+	"""
+	return set(
+		frappe.db.sql(
+			f"""
+			select organization_bank_rule, `date`, group_index from `tabBudget Operations` where {conditions}
+			union
+			select organization_bank_rule, `date`, group_index from `tabBudget Operation Groups` where {conditions}
+			""",
+			values,
+		)
+	)
+
+
+def expand_recurring_operations(rules, start_date=None, end_date=None):
+	"""
+	Разворачивает повторяющиеся операции в виртуальные операции План за период
+	в том же виде, что и fetch_ledger_operations. Ничего не сохраняется.
+	"""
+	if end_date is None:
+		from .budget_api import get_budget_horizon_end
+
+		end_date = get_budget_horizon_end()
+	start_date, end_date = getdate(start_date) if start_date else None, getdate(end_date)
+
+	definitions = fetch_recurring_definitions(rules, start_date, end_date)
+	if not definitions:
+		return []
+	slots = fetch_materialized_slots(
+		{d.organization_bank_rule for d in definitions},
+		start_date or min(getdate(d.start_date) for d in definitions),
+		end_date,
+	)
+
+	ops = []
+	for definition in definitions:
+		group_index = get_recurring_group_index(definition.name)
+		for day in iter_occurrence_dates(definition, start_date, end_date):
+			if (definition.organization_bank_rule, day, group_index) in slots:
+				continue
+			ops.append(
+				frappe._dict(
+					name="",
+					organization_bank_rule=definition.organization_bank_rule,
+					date=day,
+					budget_operation_type="План",
+					sum=flt(definition.sum),
+					expense_item=definition.expense_item,
+					group_index=group_index,
+					recipient_of_transit_payment=definition.recipient_of_transit_payment,
+					external_recipient=definition.external_recipient,
+					description=definition.description,
+					comment="",
+					entry_type=definition.entry_type,
+				)
+			)
+	return ops
+
+
+def get_recurring_day_flows(organization_bank_rule_name, target_date):
+	"""
+	Вклад виртуальных повторений дня в Movement и Transfer правила.
+	"""
+	movement, transfer = 0.0, 0.0
+	for op in expand_recurring_operations([organization_bank_rule_name], target_date, target_date):
+		if op.organization_bank_rule == organization_bank_rule_name:
+			movement += get_entry_sign(op.entry_type) * op.sum
+		if op.recipient_of_transit_payment == organization_bank_rule_name:
+			transfer += op.sum
+	return movement, transfer
+
+
+def materialize_recurring_operation(organization_bank_rule_name, target_date, group_index):
+	"""
+	Сохраняет виртуальную операцию План группы повторения, когда пользователь правит её
+	или вносит Факт в эту группу. Возвращает созданную операцию или None, если
+	слот уже сохранён или повторения на эту дату нет.
+	"""
+	target_date = getdate(target_date)
+	slot = (organization_bank_rule_name, target_date, cint(group_index))
+	if slot in fetch_materialized_slots([organization_bank_rule_name], target_date, target_date):
+		return None
+
+	definitions = fetch_recurring_definitions(
+		None, target_date, target_date, name=cint(group_index) - RECURRING_GROUP_INDEX_BASE
+	)
+	definition = definitions[0] if definitions else None
+	if (
+		not definition
+		or definition.organization_bank_rule != organization_bank_rule_name
+		or target_date not in iter_occurrence_dates(definition, target_date, target_date)
+	):
+		return None
+
+	doc = frappe.new_doc("Budget Operations")
+	doc.date = target_date
+	doc.budget_operation_type = "План"
+	doc.organization_bank_rule = organization_bank_rule_name
+	doc.group_index = cint(group_index)
+	doc.expense_item = definition.expense_item
+	doc.sum = flt(definition.sum)
+	doc.recipient_of_transit_payment = definition.recipient_of_transit_payment
+	doc.external_recipient = definition.external_recipient
+	doc.description = definition.description
+	doc.comment = ""
+	doc.insert()
+	return doc
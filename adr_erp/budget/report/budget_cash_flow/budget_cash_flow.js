@@ -0,0 +1,59 @@
+// Copyright (c) 2026, GeorgyTaskabulov and contributors
+// For license information, please see license.txt
+
+frappe.query_reports["Budget Cash Flow"] = {
+	filters: [
+		{
+			fieldname: "from_date",
+			label: __("From Date"),
+			fieldtype: "Date",
+			default: frappe.datetime.year_start(),
+		},
+		{
+			fieldname: "to_date",
+			label: __("To Date"),
+			fieldtype: "Date",
+			default: frappe.datetime.year_end(),
+		},
+		{
+			fieldname: "organization",
+			label: __("Organization"),
+			fieldtype: "Link",
+			options: "Organizations",
+		},
+		{
+			fieldname: "bank",
+			label: __("Bank"),
+			fieldtype: "Link",
+			options: "Banks",
+		},
+		{
+			fieldname: "expense_item",
+			label: __("Expense item"),
+			fieldtype: "Link",
+			options: "Expense Items",
+		},
+		{
+			fieldname: "entry_type",
+			label: __("Entry type"),
+			fieldtype: "Select",
+			options: "\nCredit\nDebit",
+		},
+		{
+			fieldname: "budget_operation_type",
+			label: __("Budget operation type"),
+			fieldtype: "Select",
+			options: "\nПлан\nФакт",
+		},
+	],
+
+	onload(report) {
+		if (frappe.user.has_role("System Manager")) {
+			report.page.add_inner_button(__("Rebuild Cube"), () => {
+				frappe
+					.call("adr_erp.budget.cash_flow_cube.rebuild_cash_flow_cube")
+					.then(() => frappe.show_alert(__("Cube rebuild queued")));
+			});
+		}
+	},
+};
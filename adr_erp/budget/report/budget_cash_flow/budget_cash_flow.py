@@ -0,0 +1,71 @@
+# Copyright (c) 2026, GeorgyTaskabulov and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.utils import get_first_day, getdate
+
+from adr_erp.budget.cash_flow_cube import CUBE_DOCTYPE, CUBE_FIELDS
+from adr_erp.budget.utils import read_from_replica
+
+FILTER_FIELDS = ("organization", "bank", "expense_item", "entry_type", "budget_operation_type")
+
+
+@read_from_replica
+def execute(filters=None):
+	"""
+	Денежный поток по месяцам из куба Budget Cash Flow Cube: один индексный запрос
+	вместо агрегации операций за весь период.
+	"""
+	filters = frappe._dict(filters or {})
+	return get_columns(), get_data(filters)
+
+
+def get_columns():
+	return [
+		{"fieldname": "month", "label": _("Month"), "fieldtype": "Date", "width": 100},
+		{
+			"fieldname": "organization",
+			"label": _("Organization"),
+			"fieldtype": "Link",
+			"options": "Organizations",
+			"width": 180,
+		},
+		{"fieldname": "bank", "label": _("Bank"), "fieldtype": "Link", "options": "Banks", "width": 140},
+		{
+			"fieldname": "expense_item",
+			"label": _("Expense item"),
+			"fieldtype": "Link",
+			"options": "Expense Items",
+			"width": 200,
+		},
+		{"fieldname": "entry_type", "label": _("Entry type"), "fieldtype": "Data", "width": 90},
+		{
+			"fieldname": "budget_operation_type",
+			"label": _("Budget operation type"),
+			"fieldtype": "Data",
+			"width": 90,
+		},
+		{"fieldname": "sum", "label": _("Sum"), "fieldtype": "Currency", "width": 140},
+		{"fieldname": "operations_count", "label": _("Operations Count"), "fieldtype": "Int", "width": 90},
+	]
+
+
+def get_data(filters):
+	conditions = {field: filters[field] for field in FILTER_FIELDS if filters.get(field)}
+	if filters.get("from_date") and filters.get("to_date"):
+		conditions["month"] = (
+			"between",
+			[get_first_day(filters.from_date), getdate(filters.to_date)],
+		)
+	elif filters.get("from_date"):
+		conditions["month"] = (">=", get_first_day(filters.from_date))
+	elif filters.get("to_date"):
+		conditions["month"] = ("<=", getdate(filters.to_date))
+
+	return frappe.get_all(
+		CUBE_DOCTYPE,
+		filters=conditions,
+		fields=list(CUBE_FIELDS),
+		order_by="month, organization, bank, expense_item, budget_operation_type",
+	)
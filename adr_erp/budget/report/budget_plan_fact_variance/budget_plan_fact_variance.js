@@ -0,0 +1,37 @@
+// Copyright (c) 2026, GeorgyTaskabulov and contributors
+// For license information, please see license.txt
+
+frappe.query_reports["Budget Plan Fact Variance"] = {
+	filters: [
+		{
+			fieldname: "from_date",
+			label: __("From Date"),
+			fieldtype: "Date",
+			default: frappe.datetime.year_start(),
+			reqd: 1,
+		},
+		{
+			fieldname: "to_date",
+			label: __("To Date"),
+			fieldtype: "Date",
+			default: frappe.datetime.year_end(),
+			reqd: 1,
+		},
+		{
+			fieldname: "organization_bank_rules",
+			label: __("Organization-Bank Rules"),
+			fieldtype: "MultiSelectList",
+			get_data(txt) {
+				return frappe.db.get_link_options("Organization-Bank Rules", txt);
+			},
+		},
+		{
+			fieldname: "period",
+			label: __("Period"),
+			fieldtype: "Select",
+			options: "Group\nDay\nMonth",
+			default: "Month",
+			reqd: 1,
+		},
+	],
+};
@@ -0,0 +1,57 @@
+# Copyright (c) 2026, GeorgyTaskabulov and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+
+from adr_erp.budget.budget_api import resolve_budget_window
+from adr_erp.budget.budget_reports import fetch_plan_fact_variance
+from adr_erp.budget.utils import read_from_replica
+
+
+@read_from_replica
+def execute(filters=None):
+	"""
+	Отклонения Факта от Плана по группам или по статьям за день/месяц.
+	"""
+	filters = frappe._dict(filters or {})
+	period = filters.period or "Month"
+	rules = filters.organization_bank_rules or frappe.get_all("Organization-Bank Rules", pluck="name")
+	start_date, end_date = resolve_budget_window(0, filters.from_date, filters.to_date)
+	return get_columns(period), fetch_plan_fact_variance(rules, start_date, end_date, period)
+
+
+def get_columns(period):
+	if period == "Group":
+		columns = [
+			{"fieldname": "date", "label": _("Date"), "fieldtype": "Date", "width": 100},
+			{
+				"fieldname": "organization_bank_rule",
+				"label": _("Organization-Bank Rule"),
+				"fieldtype": "Link",
+				"options": "Organization-Bank Rules",
+				"width": 200,
+			},
+			{"fieldname": "group_index", "label": _("Group index"), "fieldtype": "Int", "width": 80},
+		]
+	else:
+		columns = [{"fieldname": "period", "label": _("Period"), "fieldtype": "Date", "width": 100}]
+
+	columns += [
+		{
+			"fieldname": "expense_item",
+			"label": _("Expense item"),
+			"fieldtype": "Link",
+			"options": "Expense Items",
+			"width": 200,
+		},
+		{"fieldname": "plan", "label": _("План"), "fieldtype": "Currency", "width": 140},
+		{"fieldname": "fact", "label": _("Факт"), "fieldtype": "Currency", "width": 140},
+		{"fieldname": "variance", "label": _("Variance"), "fieldtype": "Currency", "width": 140},
+		{"fieldname": "variance_percent", "label": _("Variance (%)"), "fieldtype": "Percent", "width": 100},
+	]
+	if period != "Group":
+		columns.append(
+			{"fieldname": "groups_count", "label": _("Groups Count"), "fieldtype": "Int", "width": 80}
+		)
+	return columns
@@ -0,0 +1,243 @@
+from datetime import timedelta
+
+import frappe
+from frappe import _
+from frappe.utils import cint, flt, getdate
+
+from .archive import clamp_to_open_period
+from .derived_balances import fetch_opening_remaining, is_derived_balances
+from .ledger import aggregate_daily_flows, compute_rule_ledger, fetch_ledger_operations, get_today_msk
+
+SCENARIO_DOCTYPE = "Budget Scenarios"
+# Поля операции, которые правка сценария может переопределить
+OVERLAY_FIELDS = (
+	"date",
+	"budget_operation_type",
+	"organization_bank_rule",
+	"group_index",
+	"sum",
+	"expense_item",
+	"recipient_of_transit_payment",
+)
+
+
+def is_group_index_set(change):
+	# 0 в группе правки — «не задана», если не отмечен флажок set_group_index
+	return bool(change.set_group_index or cint(change.group_index))
+
+
+def get_changed_fields(change):
+	"""
+	Поля, которые правка Change задаёт операции: незаполненные оставляют живое значение.
+	Числовые поля хранятся как 0, а не NULL: нулевая сумма тоже оставляет живую
+	(убрать операцию — Remove), а группа 0 задаётся флажком set_group_index.
+	"""
+	fields = {
+		field: change.get(field)
+		for field in OVERLAY_FIELDS
+		if field not in ("group_index", "sum") and change.get(field) not in (None, "")
+	}
+	if is_group_index_set(change):
+		fields["group_index"] = change.group_index
+	if flt(change.sum):
+		fields["sum"] = change.sum
+	return fields
+
+
+def get_scenario_overlay(scenario_name):
+	"""
+	Разреженный слой сценария поверх живых данных:
+	  overridden — имена операций, которые сценарий убирает или меняет,
+	  ops — изменённые и добавленные операции в виде fetch_ledger_operations.
+	"""
+	changes = frappe.get_all(
+		"Budget Scenario Changes",
+		filters={"parent": scenario_name, "parenttype": SCENARIO_DOCTYPE},
+		fields=["idx", "action", "budget_operation", "set_group_index", *OVERLAY_FIELDS],
+		order_by="idx",
+	)
+	base_names = [ch.budget_operation for ch in changes if ch.action != "Add" and ch.budget_operation]
+	base_ops = {}
+	if base_names:
+		for op in frappe.get_all(
+			"Budget Operations", filters={"name": ("in", base_names)}, fields=["name", *OVERLAY_FIELDS]
+		):
+			base_ops[str(op.name)] = op
+
+	overridden, ops = set(), []
+	for ch in changes:
+		if ch.action == "Add":
+			# Без group_index добавленная операция получает свою группу, не совпадающую с живыми
+			op = frappe._dict({field: ch.get(field) for field in OVERLAY_FIELDS}, name="")
+			op.group_index = ch.group_index if is_group_index_set(ch) else -ch.idx
+		else:
+			base = base_ops.get(str(ch.budget_operation))
+			if not base:
+				continue
+			overridden.add(str(base.name))
+			if ch.action == "Remove":
+				continue
+			# Copy-on-write: незаполненные поля правки берутся из живой операции
+			op = frappe._dict(base)
+			op.update(get_changed_fields(ch))
+			op.name = ""
+		op.date = getdate(op.date)
+		op.sum = flt(op.sum)
+		op.expense_item = op.expense_item or ""
+		op.recipient_of_transit_payment = op.recipient_of_transit_payment or ""
+		ops.append(op)
+
+	entry_types = dict(
+		frappe.get_all(
+			"Expense Items",
+			filters={"name": ("in", list({op.expense_item for op in ops if op.expense_item}) or [""])},
+			fields=["name", "entry_type"],
+			as_list=True,
+		)
+	)
+	for op in ops:
+		op.entry_type = entry_types.get(op.expense_item)
+
+	touched_dates = [op.date for op in ops] + [getdate(base_ops[name].date) for name in overridden]
+	touched_rules = {
+		rule
+		for op in [*ops, *(base_ops[name] for name in overridden)]
+		for rule in (op.organization_bank_rule, op.recipient_of_transit_payment)
+		if rule
+	}
+	return frappe._dict(
+		overridden=overridden, ops=ops, touched_dates=touched_dates, touched_rules=touched_rules
+	)
+
+
+def fetch_live_opening_remaining(rules, before_date):
+	"""
+	Живой остаток правил на конец дня перед before_date: {rule: remaining}.
+	"""
+	if is_derived_balances():
+		return {rule: fetch_opening_remaining(before_date, rules=[rule]) for rule in rules}
+	return dict(
+		frappe.db.sql(
+			"""
+			select organization_bank_rule, `sum`
+			from `tabMovements of Budget Operations`
+			where organization_bank_rule in %(rules)s and `date` = %(date)s and budget_balance_type = 'Remaining'
+			""",
+			{"rules": tuple(rules), "date": before_date - timedelta(days=1)},
+		)
+	)
+
+
+def evaluate_budget_scenario(scenario_name, rules, start_date, end_date):
+	"""
+	Считает в памяти движения правил по живым операциям с наложенным слоем сценария.
+	Ничего не записывается. Правила, которых касается сценарий (включая получателей
+	транзита), считаются всегда.
+
+	Возвращает {rule: {date: {"live": {...}, "scenario": {...}}}} за [start_date, end_date].
+	"""
+	overlay = get_scenario_overlay(scenario_name)
+	rules = sorted(set(rules or ()) | overlay.touched_rules)
+	start_date, end_date = getdate(start_date), getdate(end_date)
+	if not rules:
+		return {}
+
+	# Изменения раньше окна сдвигают остатки в окне — считаем с самой ранней правки
+	calc_start = clamp_to_open_period(min([start_date, *overlay.touched_dates]))
+	if calc_start > end_date:
+		return {}
+
+	live_ops = fetch_ledger_operations(rules, calc_start, end_date)
+	scenario_ops = [op for op in live_ops if str(op.name) not in overlay.overridden]
+	scenario_ops += [
+		op
+		for op in overlay.ops
+		if calc_start <= op.date <= end_date
+		and (op.organization_bank_rule in rules or op.recipient_of_transit_payment in rules)
+	]
+
+	today = get_today_msk()
+	live_flows = aggregate_daily_flows(live_ops, today)
+	scenario_flows = aggregate_daily_flows(scenario_ops, today)
+	opening = fetch_live_opening_remaining(rules, calc_start)
+
+	result = {}
+	for rule in rules:
+		live = compute_rule_ledger(rule, calc_start, end_date, *live_flows, flt(opening.get(rule)))
+		scenario = compute_rule_ledger(rule, calc_start, end_date, *scenario_flows, flt(opening.get(rule)))
+		result[rule] = {
+			day: {"live": live[day], "scenario": scenario[day]} for day in live if day >= start_date
+		}
+	return result
+
+
+def apply_scenario_to_grid_ops(scenario_name, organization_bank_rule_name, budget_ops, start_date, end_date):
+	"""
+	Подменяет операции редактора операциями сценария: убранные и изменённые живые строки
+	скрываются, изменённые и добавленные показываются без name.
+	"""
+	overlay = get_scenario_overlay(scenario_name)
+	ops = [op for op in budget_ops if str(op.get("name") or "") not in overlay.overridden]
+	for op in overlay.ops:
+		if op.organization_bank_rule == organization_bank_rule_name and start_date <= op.date <= end_date:
+			ops.append({**op, "date": op.date.strftime("%Y-%m-%d")})
+	return ops
+
+
+@frappe.whitelist()
+def get_budget_scenario_balances(scenario, organization_bank_rule_name=None, from_date=None, to_date=None):
+	"""
+	Balance/Movement/Transfer/Remaining по дням для правил сценария (и правила
+	organization_bank_rule_name): живые, по сценарию и разница Remaining.
+	"""
+	frappe.has_permission(SCENARIO_DOCTYPE, "read", scenario, throw=True)
+	start_date = getdate(from_date) if from_date else get_today_msk()
+	if to_date:
+		end_date = getdate(to_date)
+	else:
+		from .budget_api import get_budget_horizon_end
+
+		end_date = get_budget_horizon_end()
+
+	rules = [organization_bank_rule_name] if organization_bank_rule_name else []
+	result = evaluate_budget_scenario(scenario, rules, start_date, end_date)
+	return {
+		"fromDate": start_date.strftime("%Y-%m-%d"),
+		"toDate": end_date.strftime("%Y-%m-%d"),
+		"rules": {
+			rule: [
+				{
+					"date": day.strftime("%Y-%m-%d"),
+					"live": values["live"],
+					"scenario": values["scenario"],
+					"remainingDelta": flt(values["scenario"]["Remaining"] - values["live"]["Remaining"], 2),
+				}
+				for day, values in days.items()
+			]
+			for rule, days in result.items()
+		},
+	}
+
+
+def validate_scenario_change(change):
+	"""
+	Добавление требует всех полей операции, изменение и удаление — ссылку на операцию.
+	"""
+	if change.action == "Add":
+		missing = [
+			field
+			for field in ("date", "budget_operation_type", "organization_bank_rule", "expense_item")
+			if not change.get(field)
+		]
+		if missing or flt(change.sum) <= 0:
+			frappe.throw(
+				_("Row {0}: an added operation needs date, type, rule, expense item and sum").format(
+					change.idx
+				)
+			)
+	elif not change.budget_operation:
+		frappe.throw(_("Row {0}: select the Budget Operation to change or remove").format(change.idx))
+	elif change.action == "Change" and not get_changed_fields(change):
+		frappe.throw(
+			_("Row {0}: the change sets no fields. To drop the operation use Remove").format(change.idx)
+		)
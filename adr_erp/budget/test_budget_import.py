@@ -0,0 +1,24 @@
+# Copyright (c) 2026, GeorgyTaskabulov and Contributors
+# See license.txt
+
+from frappe.tests import UnitTestCase
+
+from adr_erp.budget.budget_import import parse_statement_amount
+
+
+class UnitTestParseStatementAmount(UnitTestCase):
+	"""
+	Суммы выписки в форматах банков: десятичная запятая и пробелы между разрядами.
+	"""
+
+	def test_decimal_comma_and_grouping_spaces(self):
+		for value in ("1234,56", "1 234,56", "1\xa0234,56", "1 234,56", "1.234,56", "1,234.56"):
+			self.assertEqual(parse_statement_amount(value), 1234.56, msg=repr(value))
+
+	def test_sign_is_dropped(self):
+		self.assertEqual(parse_statement_amount("-500"), 500)
+		self.assertEqual(parse_statement_amount(-12.5), 12.5)
+
+	def test_unparseable_sum(self):
+		for value in (None, "", "abc", "nan"):
+			self.assertIsNone(parse_statement_amount(value), msg=repr(value))
@@ -0,0 +1,97 @@
+# Copyright (c) 2026, GeorgyTaskabulov and Contributors
+# See license.txt
+
+import random
+from datetime import date, timedelta
+
+import frappe
+import numpy as np
+from frappe.tests import UnitTestCase
+
+from adr_erp.budget.ledger import BALANCE_TYPES, aggregate_daily_flows, compute_rule_ledger
+from adr_erp.budget.portfolio_engine import MINOR_UNITS, build_portfolio_matrices, to_minor_units
+
+RULES = ("Rule A", "Rule B", "Rule C")
+ENTRY_TYPES = {"Income": "Debit", "Rent": "Credit", "Transit": "Credit", "Unknown": None}
+
+
+def make_operations(rng, start_date, days, count):
+	"""
+	Случайные операции: План и Факт в одних группах, транзит между правилами
+	и в адрес правила вне портфеля, операции без типа статьи.
+	"""
+	ops = []
+	for _i in range(count):
+		expense_item = rng.choice(list(ENTRY_TYPES))
+		recipient = rng.choice(("", "", *RULES, "Outside Rule")) if expense_item == "Transit" else ""
+		ops.append(
+			frappe._dict(
+				organization_bank_rule=rng.choice(RULES),
+				date=start_date + timedelta(days=rng.randrange(days)),
+				budget_operation_type=rng.choice(("План", "Факт")),
+				sum=rng.randrange(1, 10**7) / 100,
+				expense_item=expense_item,
+				group_index=rng.randrange(3),
+				recipient_of_transit_payment=recipient,
+				entry_type=ENTRY_TYPES[expense_item],
+			)
+		)
+	return ops
+
+
+class UnitTestPortfolioEngine(UnitTestCase):
+	"""
+	Матричный движок должен совпадать с построчным расчётом aggregate_daily_flows + compute_rule_ledger.
+	"""
+
+	def assert_matches_ledger(self, ops, start_date, days, today, opening):
+		matrices = build_portfolio_matrices(
+			list(RULES),
+			ops,
+			start_date,
+			days,
+			today,
+			np.array([to_minor_units(opening[rule]) for rule in RULES], dtype=np.int64),
+		)
+		movements, transfers = aggregate_daily_flows(ops, today)
+		end_date = start_date + timedelta(days=days - 1)
+		for r, rule in enumerate(RULES):
+			ledger = compute_rule_ledger(rule, start_date, end_date, movements, transfers, opening[rule])
+			for d in range(days):
+				day = start_date + timedelta(days=d)
+				for balance_type in BALANCE_TYPES:
+					self.assertAlmostEqual(
+						matrices[balance_type][r, d] / MINOR_UNITS,
+						ledger[day][balance_type],
+						places=2,
+						msg=f"{rule} {day} {balance_type}",
+					)
+
+	def test_matches_ledger_on_random_operations(self):
+		rng = random.Random(20261019)
+		start_date, days = date(2026, 1, 1), 40
+		for _i in range(25):
+			today = start_date + timedelta(days=rng.randrange(-5, days + 5))
+			opening = {rule: rng.randrange(-(10**6), 10**6) / 100 for rule in RULES}
+			ops = make_operations(rng, start_date, days, rng.randrange(0, 300))
+			self.assert_matches_ledger(ops, start_date, days, today, opening)
+
+	def test_today_fact_replaces_plan_within_group(self):
+		today = date(2026, 1, 10)
+		ops = [
+			frappe._dict(
+				organization_bank_rule="Rule A",
+				date=today,
+				budget_operation_type=op_type,
+				sum=amount,
+				expense_item="Income",
+				group_index=group_index,
+				recipient_of_transit_payment="",
+				entry_type="Debit",
+			)
+			for op_type, amount, group_index in (("План", 100, 0), ("Факт", 70, 0), ("План", 50, 1))
+		]
+		opening = dict.fromkeys(RULES, 0)
+		matrices = build_portfolio_matrices(list(RULES), ops, today, 1, today)
+		self.assertEqual(matrices["Movement"][0, 0], to_minor_units(120))
+		self.assert_matches_ledger(ops, today, 1, today, opening)
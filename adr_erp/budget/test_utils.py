@@ -0,0 +1,79 @@
+# Copyright (c) 2026, GeorgyTaskabulov and Contributors
+# See license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests import UnitTestCase
+
+from adr_erp.budget.utils import (
+	PRIMARY_READS_CACHE_KEY,
+	read_from_replica,
+	stick_to_primary,
+	stick_version_to_primary,
+)
+
+
+def fake_read_only():
+	# Помечает чтения, выполненные «на реплике»
+	def decorator(fn):
+		def replica_fn(*args, **kwargs):
+			return ("replica", fn(*args, **kwargs))
+
+		return replica_fn
+
+	return decorator
+
+
+class UnitTestReadFromReplica(UnitTestCase):
+	"""
+	Маршрутизация тяжёлых чтений между репликой и основной базой.
+	"""
+
+	def setUp(self):
+		self.data_version = frappe.generate_hash(length=8)
+		self.patches = [
+			patch.object(frappe, "read_only", fake_read_only),
+			patch.dict(frappe.conf, {"read_from_replica": 1}),
+			patch.object(frappe.local, "form_dict", frappe._dict(), create=True),
+		]
+		for p in self.patches:
+			p.start()
+
+		@read_from_replica
+		def load(value):
+			return value
+
+		self.load = load
+
+	def tearDown(self):
+		for p in reversed(self.patches):
+			p.stop()
+		frappe.cache.delete_value(
+			[
+				f"{PRIMARY_READS_CACHE_KEY}:{frappe.session.user}",
+				f"{PRIMARY_READS_CACHE_KEY}:version:{self.data_version}",
+			]
+		)
+
+	def test_reads_from_replica_by_default(self):
+		self.assertEqual(self.load(1), ("replica", 1))
+
+	def test_reads_from_primary_without_replica(self):
+		frappe.conf.read_from_replica = 0
+		self.assertEqual(self.load(1), 1)
+
+	def test_saving_user_reads_from_primary(self):
+		stick_to_primary()
+		self.assertEqual(self.load(1), 1)
+
+	def test_reload_after_published_change_reads_from_primary(self):
+		# Другой редактор получил budget_data_updated с этой версией и перечитывает данные
+		stick_version_to_primary(self.data_version)
+		frappe.local.form_dict.data_version = self.data_version
+		self.assertEqual(self.load(1), 1)
+
+	def test_unpublished_version_reads_from_replica(self):
+		stick_version_to_primary(self.data_version)
+		frappe.local.form_dict.data_version = f"{self.data_version}-other"
+		self.assertEqual(self.load(1), ("replica", 1))
@@ -14,3 +14,56 @@ def timed(fn):
 		return result
 
 	return wrapper
+
+
+PRIMARY_READS_CACHE_KEY = "adr_erp:primary_reads"
+# Сколько секунд после своего сохранения пользователь читает с основной базы,
+# пока реплика догоняет изменения
+PRIMARY_READS_TTL = 30
+
+
+def stick_to_primary(user=None):
+	"""
+	Отправляет ближайшие чтения пользователя на основную базу: после своего сохранения
+	он должен видеть изменения, даже если реплика ещё отстаёт.
+	"""
+	frappe.cache.set_value(
+		f"{PRIMARY_READS_CACHE_KEY}:{user or frappe.session.user}", 1, expires_in_sec=PRIMARY_READS_TTL
+	)
+
+
+def stick_version_to_primary(data_version):
+	"""
+	Чтения, пришедшие с версией данных data_version (редакторы перечитывают данные
+	по событию об изменении), идут на основную базу, пока реплика может отставать.
+	"""
+	frappe.cache.set_value(
+		f"{PRIMARY_READS_CACHE_KEY}:version:{data_version}", 1, expires_in_sec=PRIMARY_READS_TTL
+	)
+
+
+def is_primary_read_required():
+	"""
+	Пользователь недавно сам сохранял или запрос перечитывает только что опубликованную версию данных.
+	"""
+	if frappe.cache.get_value(f"{PRIMARY_READS_CACHE_KEY}:{frappe.session.user}"):
+		return True
+	data_version = frappe.form_dict.get("data_version")
+	return bool(data_version and frappe.cache.get_value(f"{PRIMARY_READS_CACHE_KEY}:version:{data_version}"))
+
+
+def read_from_replica(fn):
+	"""
+	Выполняет тяжёлое чтение на реплике (frappe.read_only), если она настроена
+	в site_config (read_from_replica) и чтение не должно видеть свежие изменения
+	(is_primary_read_required).
+	"""
+	replica_fn = frappe.read_only()(fn)
+
+	@functools.wraps(fn)
+	def wrapper(*args, **kwargs):
+		if frappe.conf.read_from_replica and not is_primary_read_required():
+			return replica_fn(*args, **kwargs)
+		return fn(*args, **kwargs)
+
+	return wrapper
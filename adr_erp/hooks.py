@@ -154,17 +154,27 @@ doc_events = {
 		"after_rename": "adr_erp.budget.budget_api.publish_budget_change_by_rename_bank",
 	},
 	"Expense Items": {
-		"on_update": "adr_erp.budget.budget_api.publish_budget_change_by_update_expense_item",
+		"on_update": [
+			"adr_erp.budget.budget_api.publish_budget_change_by_update_expense_item",
+			"adr_erp.budget.cash_flow_cube.sync_cube_entry_type",
+		],
 	},
 	"Organization-Bank Rules": {
 		"after_rename": "adr_erp.budget.budget_api.publish_budget_change_by_rename_organization_bank_rule",
-		"on_update": "adr_erp.budget.budget_api.publish_budget_change_by_update_organization_bank_rule",
+		"on_update": [
+			"adr_erp.budget.budget_api.publish_budget_change_by_update_organization_bank_rule",
+			"adr_erp.budget.cash_flow_cube.mark_cube_dirty_by_organization_bank_rule",
+		],
 		"on_trash": "adr_erp.budget.budget_api.publish_budget_change_by_trash_organization_bank_rule",
 	},
 	# "Budget Operations": {
 	# 	"on_update": "adr_erp.budget.budget_api.publish_budget_change_by_update_budget_operation",
 	# 	"on_trash": "adr_erp.budget.budget_api.publish_budget_change_by_update_budget_operation",
 	# },
+	"Budget Operations": {
+		"on_update": "adr_erp.budget.cash_flow_cube.mark_cube_dirty_by_budget_operation",
+		"on_trash": "adr_erp.budget.cash_flow_cube.mark_cube_dirty_by_budget_operation",
+	},
 }
 
 # Scheduled Tasks
@@ -174,15 +184,21 @@ scheduler_events = {
 	"all": [
 		# "adr_erp.tasks.all"
 	],
-	"daily": ["adr_erp.tasks.prepare_budget_movement_data"],
+	"daily": [
+		"adr_erp.tasks.roll_budget_horizon",
+		"adr_erp.budget.movements_audit.audit_and_repair_movements",
+	],
 	"hourly": [
 		# "adr_erp.tasks.hourly"
 	],
 	"weekly": [
-		# "adr_erp.tasks.weekly"
+		"adr_erp.tasks.prepare_budget_movement_data",
+		"adr_erp.budget.compaction.compact_budget_operation_placeholders",
+		"adr_erp.budget.compaction.compact_zero_movements",
+		"adr_erp.budget.derived_balances.refresh_remaining_checkpoints",
 	],
 	"monthly": [
-		# "adr_erp.tasks.monthly"
+		"adr_erp.budget.archive.archive_budget_history",
 	],
 }
 
@@ -0,0 +1,11 @@
+import frappe
+
+
+def execute():
+	# Куб строится по всем операциям, включая архив, — в фоне
+	frappe.enqueue(
+		"adr_erp.budget.cash_flow_cube.run_cash_flow_cube_rebuild",
+		queue="long",
+		timeout=6 * 60 * 60,
+		enqueue_after_commit=True,
+	)
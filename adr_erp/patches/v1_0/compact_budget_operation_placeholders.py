@@ -0,0 +1,11 @@
+import frappe
+
+
+def execute():
+	# Пустые строки-заготовки переносятся в Budget Operation Groups в фоне: таблица может быть большой
+	frappe.enqueue(
+		"adr_erp.budget.compaction.compact_budget_operation_placeholders",
+		queue="long",
+		timeout=6 * 60 * 60,
+		enqueue_after_commit=True,
+	)
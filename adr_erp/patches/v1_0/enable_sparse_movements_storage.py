@@ -0,0 +1,17 @@
+import frappe
+
+
+def execute():
+	# get_single_value не читает default из JSON: пока настройки не сохранены, флаг выключен.
+	# Включаем его явно, если администратор ещё не задавал значение, и сжимаем нули в фоне.
+	if frappe.db.sql(
+		"select 1 from `tabSingles` where doctype = 'Budget Settings' and field = 'sparse_movements_storage'"
+	):
+		return
+	frappe.db.set_single_value("Budget Settings", "sparse_movements_storage", 1)
+	frappe.enqueue(
+		"adr_erp.budget.compaction.compact_zero_movements",
+		queue="long",
+		timeout=6 * 60 * 60,
+		enqueue_after_commit=True,
+	)
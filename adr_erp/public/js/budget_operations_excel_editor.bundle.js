@@ -165,7 +165,11 @@ function getContextMenuSettings(operationTypeNames = [], organization_bank_rule_
 
 				frappe.call({
 					method: "adr_erp.budget.budget_api.save_budget_changes",
-					args: { organization_bank_rule_name, changes: payload },
+					args: {
+						organization_bank_rule_name,
+						changes: payload,
+						visible_to_date: window.budgetGridSession?.toDate,
+					},
 				});
 			},
 		};
@@ -367,6 +371,8 @@ function initHandsontableInstance(message, organization_bank_rule_name, force_re
 	const hotSettings = {
 		data: message.data,
 		columns: message.columns,
+		// сценарий только показывает «что если» — живые данные из него не правятся
+		readOnly: Boolean(window.budgetGridSession?.scenario),
 		fixedColumnsStart: 7,
 		rowHeaders: true,
 		autoWrapRow: false,
@@ -391,6 +397,7 @@ function initHandsontableInstance(message, organization_bank_rule_name, force_re
 		maxRows: message.data.length,
 		allowInvalid: false,
 		comments: true,
+		afterScrollVertically: () => loadNeighbourChunks(),
 		afterGetColHeader: function (col, TH) {
 			if (col >= 0) {
 				TH.style.fontWeight = "bold";
@@ -478,7 +485,11 @@ function initHandsontableInstance(message, organization_bank_rule_name, force_re
 			if (!payload.length) return;
 			frappe.call({
 				method: "adr_erp.budget.budget_api.save_budget_changes",
-				args: { organization_bank_rule_name, changes: payload },
+				args: {
+					organization_bank_rule_name,
+					changes: payload,
+					visible_to_date: window.budgetGridSession?.toDate,
+				},
 			});
 		},
 
@@ -530,9 +541,172 @@ function attachResizeListener() {
 	});
 }
 
+// Размер порции данных в днях и расстояние до края загруженных строк,
+// при котором подгружается соседняя порция
+const PAGE_SIZE_DAYS = 14;
+const LAZY_LOAD_THRESHOLD_ROWS = 20;
+
+// Сессия редактора: выбранное правило, окно дат, макет и уже загруженные строки
+window.budgetGridSession = null;
+
+const minDateStr = (a, b) => (a < b ? a : b);
+const maxDateStr = (a, b) => (a > b ? a : b);
+
+/**
+ * Разворачивает строки из компактного формата (см. encode_compact_rows на сервере).
+ */
+function expandCompactRows(payload) {
+	const { width, dateColumn, typeColumn, dates, types, strings, rows } = payload;
+	return rows.map(([dateCode, typeCode, cells]) => {
+		const row = new Array(width).fill(null);
+		row[dateColumn] = dates[dateCode];
+		row[typeColumn] = types[typeCode];
+		for (let i = 0; i < cells.length; i += 2) {
+			const col = cells[i];
+			if (col < 0) {
+				row[-col - 1] = strings[cells[i + 1]];
+			} else {
+				row[col] = cells[i + 1];
+			}
+		}
+		return row;
+	});
+}
+
+/**
+ * Загружает строки таблицы за период [fromDate, toDate] без макета.
+ */
+function fetchChunk(session, fromDate, toDate) {
+	return frappe
+		.call("adr_erp.budget.budget_api.get_budget_plannig_data_for_handsontable", {
+			organization_bank_rule_name: session.rule,
+			from_date: fromDate,
+			to_date: toDate,
+			include_layout: 0,
+			compact: 1,
+			scenario: session.scenario,
+			data_version: window.budget_data_version,
+		})
+		.then((r) => (r.message.compactData ? expandCompactRows(r.message.compactData) : []));
+}
+
+/**
+ * Перерисовывает таблицу по макету сессии и загруженным строкам.
+ */
+function renderSession(session, force_render = false) {
+	initHandsontableInstance({ ...session.layout, data: session.data }, session.rule, force_render);
+}
+
+/**
+ * Начинает новую сессию: макет, метрики и статусы дней запрашиваются один раз
+ * на всё окно, а строки — только для видимой порции вокруг текущей даты.
+ */
+function startGridSession(organization_bank_rule_name, number_of_days, force_render) {
+	const today = frappe.datetime.get_today();
+	const session = {
+		rule: organization_bank_rule_name,
+		numberOfDays: number_of_days,
+		fromDate: frappe.datetime.add_days(today, -number_of_days),
+		toDate: frappe.datetime.add_days(today, +number_of_days),
+		layout: null,
+		data: [],
+		loadedFrom: null,
+		loadedTo: null,
+		loading: false,
+		scenario: window.current_budget_scenario || null,
+	};
+	window.budgetGridSession = session;
+
+	const half = Math.floor(PAGE_SIZE_DAYS / 2);
+	const chunkFrom = maxDateStr(session.fromDate, frappe.datetime.add_days(today, -half));
+	const chunkTo = minDateStr(session.toDate, frappe.datetime.add_days(today, half));
+
+	return Promise.all([
+		frappe.call("adr_erp.budget.budget_api.get_budget_plannig_layout_for_handsontable", {
+			organization_bank_rule_name: session.rule,
+			from_date: session.fromDate,
+			to_date: session.toDate,
+			data_version: window.budget_data_version,
+		}),
+		fetchChunk(session, chunkFrom, chunkTo),
+	]).then(([layoutResponse, rows]) => {
+		// пока грузились данные, пользователь мог выбрать другое правило
+		if (window.budgetGridSession !== session) return;
+		session.layout = layoutResponse.message;
+		session.data = rows;
+		session.loadedFrom = chunkFrom;
+		session.loadedTo = chunkTo;
+		renderSession(session, force_render);
+		scrollToCurrentDate();
+	});
+}
+
+/**
+ * Перезапрашивает уже загруженный диапазон дат (после изменения данных на сервере).
+ */
+function reloadLoadedRange(session) {
+	return fetchChunk(session, session.loadedFrom, session.loadedTo).then((rows) => {
+		if (window.budgetGridSession !== session) return;
+		session.data = rows;
+		renderSession(session);
+	});
+}
+
+/**
+ * Подгружает соседнюю порцию, когда пользователь прокрутил таблицу к краю загруженных строк.
+ */
+function loadNeighbourChunks() {
+	const session = window.budgetGridSession;
+	const hot = window.hotInstance;
+	if (!session || !session.layout || session.loading || !hot) return;
+
+	const firstRow = hot.view.getFirstFullyVisibleRow();
+	const lastRow = hot.view.getLastFullyVisibleRow();
+	const rowCount = hot.countRows();
+
+	if (firstRow <= LAZY_LOAD_THRESHOLD_ROWS && session.loadedFrom > session.fromDate) {
+		const toDate = frappe.datetime.add_days(session.loadedFrom, -1);
+		const fromDate = maxDateStr(
+			session.fromDate,
+			frappe.datetime.add_days(session.loadedFrom, -PAGE_SIZE_DAYS)
+		);
+		session.loading = true;
+		fetchChunk(session, fromDate, toDate)
+			.then((rows) => {
+				if (window.budgetGridSession !== session) return;
+				session.data = rows.concat(session.data);
+				session.loadedFrom = fromDate;
+				renderSession(session);
+				// сохраняем положение прокрутки после добавления строк сверху
+				window.hotInstance.scrollViewportTo(firstRow + rows.length);
+			})
+			.finally(() => {
+				session.loading = false;
+			});
+	} else if (rowCount - lastRow <= LAZY_LOAD_THRESHOLD_ROWS && session.loadedTo < session.toDate) {
+		const fromDate = frappe.datetime.add_days(session.loadedTo, 1);
+		const toDate = minDateStr(
+			session.toDate,
+			frappe.datetime.add_days(session.loadedTo, PAGE_SIZE_DAYS)
+		);
+		session.loading = true;
+		fetchChunk(session, fromDate, toDate)
+			.then((rows) => {
+				if (window.budgetGridSession !== session) return;
+				session.data = session.data.concat(rows);
+				session.loadedTo = toDate;
+				renderSession(session);
+			})
+			.finally(() => {
+				session.loading = false;
+			});
+	}
+}
+
 /**
  * Основная функция для обновления Excel-редактора.
- * Запрашивает данные с сервера и обновляет экземпляр Handsontable.
+ * При смене правила или окна дат начинает новую сессию, иначе перезапрашивает
+ * только уже загруженные строки.
  *
  * @param {String} organization_bank_rule_name - Имя документа правил организации.
  */
@@ -544,14 +718,17 @@ function setup_excel_editor_table(
 	if (organization_bank_rule_name == undefined || number_of_days == undefined) {
 		return Promise.reject();
 	}
-	return frappe
-		.call("adr_erp.budget.budget_api.get_budget_plannig_data_for_handsontable", {
-			organization_bank_rule_name: organization_bank_rule_name,
-			number_of_days: number_of_days,
-		})
-		.then((r) => {
-			initHandsontableInstance(r.message, organization_bank_rule_name, force_render);
-		});
+	const session = window.budgetGridSession;
+	if (
+		!force_render &&
+		session &&
+		session.layout &&
+		session.rule === organization_bank_rule_name &&
+		session.numberOfDays == number_of_days
+	) {
+		return reloadLoadedRange(session);
+	}
+	return startGridSession(organization_bank_rule_name, +number_of_days, force_render);
 }
 
 function safeUpdateInstance(message, hotSettings) {
@@ -602,6 +779,51 @@ function forceReload() {
 
 const debouncedForceReload = debounce(forceReload, 1000);
 
+/**
+ * Подставляет строки, подготовленные задачей пересчёта, вместо загруженных строк за тот же период.
+ * Возвращает false, если сообщение без готовых строк и таблицу нужно перечитать целиком.
+ */
+function applyPushedRows(msg) {
+	const session = window.budgetGridSession;
+	if (!msg.rowsToken || !session || !session.layout || session.rule !== msg.organization_bank_rule_name) {
+		return false;
+	}
+	// готовые строки посчитаны без сценария
+	if (session.scenario) return false;
+	const fromDate = maxDateStr(msg.fromDate, session.loadedFrom);
+	const toDate = minDateStr(msg.toDate, session.loadedTo);
+	// изменения вне загруженных строк
+	if (fromDate > toDate) return true;
+
+	frappe
+		.call({
+			method: "adr_erp.budget.budget_api.get_pushed_budget_rows",
+			type: "GET",
+			args: { rows_token: msg.rowsToken },
+		})
+		.then((r) => {
+			if (window.budgetGridSession !== session) return;
+			const payload = r.message;
+			// строки истекли или собраны по другому макету — перечитываем сами
+			if (!payload || payload.width !== session.layout.columns.length) {
+				reloadLoadedRange(session);
+				return;
+			}
+			const dateColumn = payload.dateColumn;
+			const rows = expandCompactRows(payload).filter(
+				(row) => row[dateColumn] >= fromDate && row[dateColumn] <= toDate
+			);
+			session.data = session.data
+				.filter((row) => row[dateColumn] < fromDate)
+				.concat(
+					rows,
+					session.data.filter((row) => row[dateColumn] > toDate)
+				);
+			renderSession(session);
+		});
+	return true;
+}
+
 frappe.realtime.on("budget_data_updated", (msg) => {
 	// обновление только нужного
 	if (window.current_organization_bank_rules_select != msg.organization_bank_rule_name) {
@@ -609,12 +831,35 @@ frappe.realtime.on("budget_data_updated", (msg) => {
 	}
 	// если придёт 100 событий подряд, за 5 сек вызовется только один раз
 	debouncedUpdateNotification();
+	// Перечитывание после события идёт на основную базу, пока реплика может отставать
+	window.budget_data_version = msg.dataVersion;
+	if (applyPushedRows(msg)) return;
 	window.setup_excel_editor_table(
 		msg.organization_bank_rule_name,
 		window.current_number_of_days_select || "7"
 	);
 });
 
+// Изменились колонки таблицы (статьи расходов, правила) — перечитываем макет и данные
+const debouncedLayoutReload = debounce(() => {
+	window.setup_excel_editor_table(
+		window.current_organization_bank_rules_select,
+		window.current_number_of_days_select || "7",
+		true
+	);
+}, 1000);
+
+frappe.realtime.on("budget_layout_updated", (msg) => {
+	if (
+		msg.organization_bank_rule_name &&
+		window.current_organization_bank_rules_select != msg.organization_bank_rule_name
+	) {
+		return;
+	}
+	debouncedUpdateNotification();
+	debouncedLayoutReload();
+});
+
 frappe.realtime.on("require_budget-operations-excel-editor_refresh", (msg) => {
 	debouncedForceReload();
 });
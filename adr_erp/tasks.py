@@ -1,20 +1,57 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 
 import frappe
 import pytz
 
-from .budget.budget_api import calculate_movements_of_budget_operations, publish_budget_change
+from .budget.budget_api import (
+	calculate_movements_of_budget_operations,
+	get_budget_horizon_end,
+	publish_budget_change,
+	roll_movements_of_budget_operations,
+)
+from .budget.forecast_snapshots import take_forecast_snapshot
+from .budget.portfolio_engine import rebuild_portfolio_movements
 
 
 def prepare_budget_movement_data(rule=None, target_date=None):
-	today = datetime.now(pytz.timezone("Europe/Moscow")).date()
-	next_month_date = today + timedelta(days=30)
 	if rule is None:
-		all_ob_rules = frappe.get_all("Organization-Bank Rules", pluck="name")
+		# Полный пересчёт всех правил — одним проходом матричного движка
+		rebuild_portfolio_movements()
+		return
 
-		for rule in all_ob_rules:
-			calculate_movements_of_budget_operations(rule, next_month_date, True)
-			publish_budget_change(rule)
-	else:
-		calculate_movements_of_budget_operations(rule, next_month_date, True, target_date)
+	calculate_movements_of_budget_operations(rule, get_budget_horizon_end(), True, target_date)
 	publish_budget_change(rule)
+
+
+def roll_budget_horizon():
+	"""
+	Ежедневный сдвиг горизонта: пересчитываются только вчера, сегодня и новый день горизонта,
+	остальные дни получают разницу остатка. Полный пересчёт — раз в неделю.
+	После сдвига снимается прогноз правила на горизонте.
+	Ошибка одного правила не останавливает сдвиг остальных: она пишется в Error Log,
+	а правило досчитается следующим сдвигом (он увидит пропущенный день) или полным пересчётом.
+	"""
+	today = datetime.now(pytz.timezone("Europe/Moscow")).date()
+	horizon_end = get_budget_horizon_end()
+	failed_rules = []
+	for rule in frappe.get_all("Organization-Bank Rules", pluck="name"):
+		try:
+			roll_movements_of_budget_operations(rule, today, horizon_end)
+			frappe.db.commit()
+			publish_budget_change(rule)
+			take_forecast_snapshot(rule, today, horizon_end)
+			frappe.db.commit()
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(
+				title=f"Budget horizon roll failed for {rule}",
+				reference_doctype="Organization-Bank Rules",
+				reference_name=rule,
+			)
+			frappe.db.commit()
+			failed_rules.append(rule)
+
+	if failed_rules:
+		frappe.logger("adr_erp").warning(
+			f"Budget horizon roll failed for {len(failed_rules)} rules: {sorted(failed_rules)}"
+		)